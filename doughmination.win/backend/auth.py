@@ -9,6 +9,8 @@ import logging
 from dotenv import load_dotenv
 from users import verify_user, get_user_by_username
 from models import UserResponse
+from telemetry import observe_upstream
+from http_clients import get_client
 
 load_dotenv()
 
@@ -61,19 +63,22 @@ async def verify_turnstile_token(token: str, remote_ip: str = None) -> bool:
         data["remoteip"] = remote_ip
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(verify_url, data=data)
-            response.raise_for_status()
-            
-            result = TurnstileResponse(**response.json())
-            
-            if not result.success:
-                logger.warning(f"Turnstile verification failed: {result.error_codes}")
-                return False
-            
-            logger.info("Turnstile verification successful")
-            return True
-            
+        client = get_client("turnstile")
+        response = await observe_upstream(
+            "turnstile", "POST /turnstile/v0/siteverify",
+            client.post(verify_url, data=data)
+        )
+        response.raise_for_status()
+        
+        result = TurnstileResponse(**response.json())
+        
+        if not result.success:
+            logger.warning(f"Turnstile verification failed: {result.error_codes}")
+            return False
+        
+        logger.info("Turnstile verification successful")
+        return True
+        
     except httpx.RequestError as e:
         logger.error(f"Failed to verify Turnstile token: {e}")
         raise HTTPException(status_code=500, detail="Failed to verify security token")
@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from PIL import Image, ImageOps
+from dotenv import load_dotenv
+from cache import recent_failure, remember_failure
+from http_clients import get_client
+from telemetry import observe_upstream
+
+load_dotenv()
+
+# Resized copies of member avatars, stored under the sha256 of the original
+# image so their URLs never change content and can be cached forever
+AVATAR_CACHE_DIR = Path(os.getenv("AVATAR_CACHE_DIR", str(Path("dough-data") / "avatar-cache")))
+AVATAR_SIZES = (64, 128, 256, 512)
+AVATAR_FORMATS = {"webp": "image/webp", "png": "image/png"}
+AVATAR_MAX_BYTES = int(os.getenv("AVATAR_MAX_BYTES", 10 * 1024 * 1024))
+AVATAR_WEBP_QUALITY = int(os.getenv("AVATAR_WEBP_QUALITY", 85))
+# How long an avatar that couldn't be downloaded or decoded is left alone
+# before it is tried again, in seconds
+AVATAR_FAILURE_TTL = int(os.getenv("AVATAR_FAILURE_TTL", 300))
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_INDEX_FILE = AVATAR_CACHE_DIR / "index.json"
+
+# upstream avatar URL -> content digest of the image it served
+_digests: Optional[Dict[str, str]] = None
+_locks: Dict[str, asyncio.Lock] = {}
+# Digests whose thumbnails are being written, so pruning leaves them alone
+_rendering: Set[str] = set()
+
+
+class AvatarError(Exception):
+    """An avatar that couldn't be downloaded or decoded"""
+
+
+def _load_index() -> Dict[str, str]:
+    global _digests
+    if _digests is None:
+        try:
+            with open(_INDEX_FILE, "r") as f:
+                _digests = json.load(f)
+        except (OSError, ValueError):
+            _digests = {}
+    return _digests
+
+
+def _save_index():
+    AVATAR_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = _INDEX_FILE.with_name(f"index.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(_digests, f, indent=2)
+    os.replace(tmp_path, _INDEX_FILE)
+
+
+def is_valid_digest(digest: str) -> bool:
+    return len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+
+def _digest_dir(digest: str) -> Path:
+    return AVATAR_CACHE_DIR / digest[:2] / digest
+
+
+def thumbnail_path(digest: str, size: int, fmt: str) -> Path:
+    return _digest_dir(digest) / f"{size}.{fmt}"
+
+
+def thumbnail_url(digest: str, size: int, fmt: str) -> str:
+    return f"/api/avatars/{digest}/{size}.{fmt}"
+
+
+def proxy_url(member_id: str, size: int = 256, fmt: str = "webp") -> str:
+    """Stable URL for a member's avatar, redirecting to the current thumbnail"""
+    return f"/api/avatars/member/{member_id}/{size}.{fmt}"
+
+
+def parse_filename(filename: str) -> Optional[Tuple[int, str]]:
+    """Size and format from a thumbnail filename like "256.webp", if valid"""
+    size, _, fmt = filename.partition(".")
+    if not size.isdigit() or int(size) not in AVATAR_SIZES or fmt not in AVATAR_FORMATS:
+        return None
+    return int(size), fmt
+
+
+def cached_thumbnail_url(avatar_url: str, size: int, fmt: str) -> Optional[str]:
+    """Immutable thumbnail URL if this upstream URL has already been processed"""
+    digest = _load_index().get(avatar_url)
+    return thumbnail_url(digest, size, fmt) if digest else None
+
+
+def _render_thumbnails(original: bytes, digest: str):
+    """Write every size and format of an avatar, skipping files that already exist"""
+    try:
+        with Image.open(io.BytesIO(original)) as image:
+            # Animated avatars use their first frame
+            image.seek(0)
+            image = ImageOps.exif_transpose(image).convert("RGBA")
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise AvatarError(f"Could not decode avatar: {e}") from e
+
+    for size in AVATAR_SIZES:
+        # Crop to a centred square the way the avatars are displayed
+        resized = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        for fmt in AVATAR_FORMATS:
+            path = thumbnail_path(digest, size, fmt)
+            if path.exists():
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            if fmt == "webp":
+                resized.save(tmp_path, "WEBP", quality=AVATAR_WEBP_QUALITY, method=4)
+            else:
+                resized.save(tmp_path, "PNG", optimize=True)
+            os.replace(tmp_path, path)
+
+
+async def _download(avatar_url: str) -> bytes:
+    if not avatar_url.startswith(("https://", "http://")):
+        raise AvatarError(f"Unsupported avatar URL: {avatar_url}")
+
+    client = get_client("avatars")
+    request = client.build_request("GET", avatar_url)
+    resp = await observe_upstream(
+        "avatars", "GET avatar", client.send(request, stream=True, follow_redirects=True)
+    )
+    try:
+        if resp.status_code != 200:
+            raise AvatarError(f"Avatar download failed: {resp.status_code}")
+        chunks = []
+        received = 0
+        async for chunk in resp.aiter_bytes():
+            received += len(chunk)
+            if received > AVATAR_MAX_BYTES:
+                raise AvatarError(f"Avatar larger than {AVATAR_MAX_BYTES} bytes")
+            chunks.append(chunk)
+    finally:
+        await resp.aclose()
+    return b"".join(chunks)
+
+
+def _failure_key(avatar_url: str) -> str:
+    return f"avatar:{avatar_url}"
+
+
+def _has_thumbnails(digest: str) -> bool:
+    # Another worker may have pruned them since this one loaded the index
+    return thumbnail_path(digest, AVATAR_SIZES[-1], "png").exists()
+
+
+async def ensure_thumbnails(avatar_url: str) -> str:
+    """
+    Download an avatar once per upstream URL and render its thumbnails,
+    returning the content digest they're stored under. A member whose
+    avatar_url changes gets a new download. An avatar that fails is not
+    tried again for AVATAR_FAILURE_TTL seconds; UpstreamFailure is raised
+    meanwhile.
+    """
+    digests = _load_index()
+    if avatar_url in digests and _has_thumbnails(digests[avatar_url]):
+        return digests[avatar_url]
+    if failure := recent_failure(_failure_key(avatar_url)):
+        raise failure
+
+    lock = _locks.setdefault(avatar_url, asyncio.Lock())
+    try:
+        async with lock:
+            if avatar_url in digests and _has_thumbnails(digests[avatar_url]):
+                return digests[avatar_url]
+            if failure := recent_failure(_failure_key(avatar_url)):
+                raise failure
+
+            try:
+                original = await _download(avatar_url)
+                digest = hashlib.sha256(original).hexdigest()
+                _rendering.add(digest)
+                try:
+                    await asyncio.to_thread(_render_thumbnails, original, digest)
+                finally:
+                    _rendering.discard(digest)
+            except Exception as e:
+                remember_failure(_failure_key(avatar_url), e, AVATAR_FAILURE_TTL)
+                raise
+
+            digests[avatar_url] = digest
+            await asyncio.to_thread(_save_index)
+            return digest
+    finally:
+        # Also when the download failed, so a lock isn't kept per broken URL
+        if _locks.get(avatar_url) is lock:
+            del _locks[avatar_url]
+
+
+def _stored_digests() -> List[str]:
+    return [
+        digest_dir.name for digest_dir in AVATAR_CACHE_DIR.glob("??/*")
+        if digest_dir.is_dir() and is_valid_digest(digest_dir.name)
+    ]
+
+
+def _remove_digests(unused: List[str]):
+    for digest in unused:
+        shutil.rmtree(_digest_dir(digest), ignore_errors=True)
+
+
+async def prune_thumbnails(avatar_urls: Iterable[Optional[str]]) -> int:
+    """
+    Forget every upstream URL not in avatar_urls, i.e. no longer used by
+    any member, and delete the thumbnails only those URLs used.
+    Returns the number of URLs forgotten.
+    """
+    digests = _load_index()
+    current = {url for url in avatar_urls if url}
+    unused = [url for url in digests if url not in current]
+    if not unused:
+        return 0
+    for url in unused:
+        del digests[url]
+    await asyncio.to_thread(_save_index)
+
+    stored = await asyncio.to_thread(_stored_digests)
+    used = set(digests.values()) | _rendering
+    await asyncio.to_thread(_remove_digests, [digest for digest in stored if digest not in used])
+    return len(unused)
@@ -1,16 +1,774 @@
+import hashlib
+import json
+import os
+import random
+import socket
+import sqlite3
+import threading
 import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+from telemetry import record_cache_event
 
-_cache = {}
+load_dotenv()
 
-def get_from_cache(key):
-    if key in _cache:
-        value, expire_time = _cache[key]
-        if time.time() < expire_time:
+# "memory" keeps a separate cache per process. "sqlite" stores entries in a
+# file shared by every uvicorn worker on the host, so PluralKit data is
+# fetched once rather than once per worker.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", str(Path("dough-data") / "cache.sqlite3"))
+# SQLite calls run on the event loop, so a locked database holds up every
+# request and websocket for up to this many seconds before the call fails
+CACHE_SQLITE_TIMEOUT = float(os.getenv("CACHE_SQLITE_TIMEOUT", 1))
+# Reads record their access time for LRU eviction at most this often per
+# key and process, so a cache hit doesn't take the write lock every time
+CACHE_SQLITE_TOUCH_INTERVAL = float(os.getenv("CACHE_SQLITE_TOUCH_INTERVAL", 30))
+
+# Limits keep memory flat no matter how many distinct keys get written
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 1024))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 32 * 1024 * 1024))  # 32MB
+CACHE_SWEEP_INTERVAL = int(os.getenv("CACHE_SWEEP_INTERVAL", 60))
+
+DEFAULT_NAMESPACE = "default"
+
+# Lifetime of bookkeeping entries such as content versions
+DEPENDENCY_TTL = 24 * 3600
+
+# Remember upstream failures for opted-in keys so an outage doesn't turn
+# into a retry on every page view. The window is stretched by a random
+# jitter fraction so workers don't all retry at the same moment.
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", 10))
+NEGATIVE_CACHE_JITTER = float(os.getenv("NEGATIVE_CACHE_JITTER", 0.5))
+NEGATIVE_NAMESPACE = "upstream_failures"
+
+
+class _Missing:
+    """Sentinel for a cache miss, so falsy values like [] or None can still be hits"""
+
+    def __repr__(self):
+        return "MISSING"
+
+    def __bool__(self):
+        return False
+
+
+MISSING = _Missing()
+
+
+class UpstreamFailure(Exception):
+    """Raised for a key whose last upstream fetch failed and is still backing off"""
+
+    def __init__(self, key: str, message: str, status_code: Optional[int] = None):
+        super().__init__(f"Upstream request for '{key}' recently failed: {message}")
+        self.key = key
+        self.status_code = status_code
+
+
+def content_hash(value: Any) -> str:
+    """Stable SHA-256 of a JSON-serializable value, independent of dict key order"""
+    encoded = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def _approx_size(value: Any) -> int:
+    """Rough size of a cached value in bytes, based on its JSON encoding"""
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return len(repr(value))
+
+
+class CacheBackend(ABC):
+    """
+    Interface shared by the cache backends.
+
+    Values must be JSON-serializable so any backend can store them. A
+    backend missing one of these methods can't be instantiated.
+    """
+
+    @abstractmethod
+    def get(self, key: str, namespace: str = DEFAULT_NAMESPACE, default: Any = None) -> Any:
+        """Return the cached value, or default if it is missing or expired"""
+
+    @abstractmethod
+    def get_entry(self, key: str, namespace: str = DEFAULT_NAMESPACE) -> Any:
+        """Return (value, is_fresh) for a key, or MISSING if it is not cached"""
+
+    @abstractmethod
+    def set(
+        self,
+        key: str,
+        value: Any,
+        ttl: float = 30,
+        namespace: str = DEFAULT_NAMESPACE,
+        stale_ttl: float = 0
+    ):
+        """Store a value for ttl seconds, kept stale_ttl longer for get_entry()"""
+
+    @abstractmethod
+    def delete(self, key: str, namespace: str = DEFAULT_NAMESPACE) -> bool:
+        """Remove a key, returning True if it was present"""
+
+    @abstractmethod
+    def clear(self, namespace: Optional[str] = None):
+        """Remove every entry, or only the entries of one namespace"""
+
+    @abstractmethod
+    def sweep(self) -> int:
+        """Drop all entries past their stale window, returning how many were removed"""
+
+    # Dependency edges (source -> dependent keys) are kept apart from the
+    # entries: they don't expire and are never evicted, so invalidating a
+    # source always reaches what was derived from it
+
+    @abstractmethod
+    def add_dependency(self, source: str, dependent: str, namespace: str = DEFAULT_NAMESPACE):
+        """Record that dependent was derived from source"""
+
+    @abstractmethod
+    def get_dependents(self, source: str, namespace: str = DEFAULT_NAMESPACE) -> List[str]:
+        """Keys directly derived from source"""
+
+    @abstractmethod
+    def pop_dependents(self, source: str, namespace: str = DEFAULT_NAMESPACE) -> List[str]:
+        """Remove and return the keys directly derived from source"""
+
+    @abstractmethod
+    def try_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """
+        Take or renew the lease called name for ttl seconds, returning True
+        if owner now holds it. Only one owner holds a lease at a time
+        among the processes sharing this cache.
+        """
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        """Current size, limits and counters"""
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Bounded in-memory cache with per-entry TTLs and LRU eviction.
+
+    Entries live in named namespaces. Expired entries are removed when read
+    and by a periodic sweep, and the least recently used entries are evicted
+    once either the entry-count or the byte limit is exceeded.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        max_bytes: int = CACHE_MAX_BYTES,
+        sweep_interval: int = CACHE_SWEEP_INTERVAL
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+
+        # (namespace, key) -> (value, expire_time, stale_until, size)
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._bytes = 0
+        # (namespace, source) -> dependent keys, in the order they were added
+        self._dependencies: Dict[tuple, Dict[str, None]] = {}
+        self._lock = threading.RLock()
+        self._last_sweep = time.monotonic()
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "stale_hits": 0,
+            "sets": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+
+    def get(self, key: str, namespace: str = DEFAULT_NAMESPACE, default: Any = None) -> Any:
+        """Return the cached value, or default if it is missing or expired"""
+        with self._lock:
+            self._maybe_sweep()
+            entry_key = (namespace, key)
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return default
+
+            value, expire_time, stale_until, _ = entry
+            now = time.monotonic()
+            if now >= expire_time:
+                if now >= stale_until:
+                    self._remove(entry_key)
+                    self._counters["expirations"] += 1
+                    record_cache_event(key, "expiration", namespace)
+                self._counters["misses"] += 1
+                return default
+
+            self._entries.move_to_end(entry_key)
+            self._counters["hits"] += 1
             return value
-        else:
-            del _cache[key]  # expired
-    return None
 
-def set_in_cache(key, value, ttl=30):
-    expire_time = time.time() + ttl
-    _cache[key] = (value, expire_time)
+    def get_entry(self, key: str, namespace: str = DEFAULT_NAMESPACE) -> Any:
+        """
+        Return (value, is_fresh) for a key, or MISSING if it is not cached.
+        Expired entries are still returned, marked stale, until their stale window ends.
+        """
+        with self._lock:
+            self._maybe_sweep()
+            entry_key = (namespace, key)
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return MISSING
+
+            value, expire_time, stale_until, _ = entry
+            now = time.monotonic()
+            if now >= stale_until:
+                self._remove(entry_key)
+                self._counters["expirations"] += 1
+                record_cache_event(key, "expiration", namespace)
+                self._counters["misses"] += 1
+                return MISSING
+
+            self._entries.move_to_end(entry_key)
+            if now >= expire_time:
+                self._counters["stale_hits"] += 1
+                return value, False
+            self._counters["hits"] += 1
+            return value, True
+
+    def set(
+        self,
+        key: str,
+        value: Any,
+        ttl: float = 30,
+        namespace: str = DEFAULT_NAMESPACE,
+        stale_ttl: float = 0
+    ):
+        """
+        Store a value for ttl seconds. A ttl of 0 or less removes the key.
+        With stale_ttl the entry is kept that much longer for get_entry() to serve stale.
+        """
+        with self._lock:
+            self._maybe_sweep()
+            entry_key = (namespace, key)
+            if entry_key in self._entries:
+                self._remove(entry_key)
+
+            if ttl <= 0:
+                return
+
+            size = _approx_size(value)
+            if size > self.max_bytes:
+                # Would evict everything else and still not fit
+                print(f"Cache: not storing {namespace}:{key}, {size} bytes exceeds limit")
+                return
+
+            expire_time = time.monotonic() + ttl
+            self._entries[entry_key] = (value, expire_time, expire_time + max(stale_ttl, 0), size)
+            self._bytes += size
+            self._counters["sets"] += 1
+            self._evict()
+
+    def delete(self, key: str, namespace: str = DEFAULT_NAMESPACE) -> bool:
+        """Remove a key, returning True if it was present"""
+        with self._lock:
+            entry_key = (namespace, key)
+            if entry_key in self._entries:
+                self._remove(entry_key)
+                return True
+            return False
+
+    def clear(self, namespace: Optional[str] = None):
+        """Remove every entry, or only the entries of one namespace"""
+        with self._lock:
+            if namespace is None:
+                self._entries.clear()
+                self._dependencies.clear()
+                self._bytes = 0
+                return
+            for entry_key in [k for k in self._entries if k[0] == namespace]:
+                self._remove(entry_key)
+            for dep_key in [k for k in self._dependencies if k[0] == namespace]:
+                del self._dependencies[dep_key]
+
+    def sweep(self) -> int:
+        """Drop all entries past their stale window, returning how many were removed"""
+        with self._lock:
+            now = time.monotonic()
+            expired = [k for k, (_, _, stale_until, _) in self._entries.items() if now >= stale_until]
+            for entry_key in expired:
+                self._remove(entry_key)
+                record_cache_event(entry_key[1], "expiration", entry_key[0])
+            self._counters["expirations"] += len(expired)
+            self._last_sweep = now
+            return len(expired)
+
+    def stats(self) -> Dict[str, Any]:
+        """Current size, limits and lifetime counters"""
+        with self._lock:
+            namespaces: Dict[str, Dict[str, int]] = {}
+            for (namespace, _), (_, _, _, size) in self._entries.items():
+                ns = namespaces.setdefault(namespace, {"entries": 0, "bytes": 0})
+                ns["entries"] += 1
+                ns["bytes"] += size
+
+            return {
+                "backend": "memory",
+                "entries": len(self._entries),
+                "dependencies": sum(len(d) for d in self._dependencies.values()),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "namespaces": namespaces,
+                **self._counters
+            }
+
+    def add_dependency(self, source: str, dependent: str, namespace: str = DEFAULT_NAMESPACE):
+        with self._lock:
+            self._dependencies.setdefault((namespace, source), {})[dependent] = None
+
+    def get_dependents(self, source: str, namespace: str = DEFAULT_NAMESPACE) -> List[str]:
+        with self._lock:
+            return list(self._dependencies.get((namespace, source), ()))
+
+    def pop_dependents(self, source: str, namespace: str = DEFAULT_NAMESPACE) -> List[str]:
+        with self._lock:
+            return list(self._dependencies.pop((namespace, source), ()))
+
+    def try_lease(self, name: str, owner: str, ttl: float) -> bool:
+        # Nothing else shares this cache, so this process always holds it
+        return True
+
+    def _remove(self, entry_key: tuple):
+        _, _, _, size = self._entries.pop(entry_key)
+        self._bytes -= size
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            # OrderedDict keeps least recently used entries first
+            entry_key = next(iter(self._entries))
+            self._remove(entry_key)
+            self._counters["evictions"] += 1
+            record_cache_event(entry_key[1], "eviction", entry_key[0])
+
+    def _maybe_sweep(self):
+        if time.monotonic() - self._last_sweep >= self.sweep_interval:
+            self.sweep()
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Cache stored in a SQLite file so several processes can share it.
+
+    Values are JSON-encoded once when stored, along with a hash of the
+    encoding. Each process keeps the values it has decoded under that hash,
+    so a hit on an unchanged entry only reads its metadata. Times are
+    wall-clock so every process agrees on expiry, and LRU eviction uses the
+    last access time, which reads update at most every touch_interval
+    seconds per key. Hit/miss counters are per process; sizes are shared.
+
+    Calls are synchronous and made from the event loop. They are quick
+    while the file is on local disk, but while another process holds the
+    write lock they wait up to CACHE_SQLITE_TIMEOUT seconds, and so does
+    everything else the worker is serving.
+    """
+
+    def __init__(
+        self,
+        path: str = CACHE_SQLITE_PATH,
+        timeout: float = CACHE_SQLITE_TIMEOUT,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        max_bytes: int = CACHE_MAX_BYTES,
+        sweep_interval: int = CACHE_SWEEP_INTERVAL,
+        touch_interval: float = CACHE_SQLITE_TOUCH_INTERVAL
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.touch_interval = touch_interval
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB NOT NULL,
+                expire_time REAL NOT NULL,
+                stale_until REAL NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                version TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(cache_entries)")]
+        if "version" not in columns:
+            try:
+                self._conn.execute("ALTER TABLE cache_entries ADD COLUMN version TEXT NOT NULL DEFAULT ''")
+            except sqlite3.OperationalError:
+                pass  # Another worker added it first
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_entries_last_access ON cache_entries (last_access)"
+        )
+        # One row per edge, so processes adding edges at once can't overwrite each other
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_dependencies (
+                namespace TEXT NOT NULL,
+                source TEXT NOT NULL,
+                dependent TEXT NOT NULL,
+                PRIMARY KEY (namespace, source, dependent)
+            )
+        """)
+        # Work only one process should do at a time, e.g. polling PluralKit
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL
+            )
+        """)
+        # (namespace, key) -> (version, decoded value), least recently used first
+        self._decoded: "OrderedDict[tuple, tuple]" = OrderedDict()
+        # (namespace, key) -> when this process last wrote its last_access
+        self._touched: Dict[tuple, float] = {}
+        self._last_sweep = time.time()
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "stale_hits": 0,
+            "sets": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+
+    def get(self, key: str, namespace: str = DEFAULT_NAMESPACE, default: Any = None) -> Any:
+        entry = self.get_entry(key, namespace)
+        if entry is MISSING:
+            return default
+        value, is_fresh = entry
+        return value if is_fresh else default
+
+    def get_entry(self, key: str, namespace: str = DEFAULT_NAMESPACE) -> Any:
+        with self._lock:
+            self._maybe_sweep()
+            entry_key = (namespace, key)
+            row = self._conn.execute(
+                "SELECT version, expire_time, stale_until FROM cache_entries WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+            if row is None:
+                self._forget(entry_key)
+                self._counters["misses"] += 1
+                return MISSING
+
+            version, expire_time, stale_until = row
+            now = time.time()
+            if now >= stale_until:
+                self._conn.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key)
+                )
+                self._forget(entry_key)
+                self._counters["expirations"] += 1
+                record_cache_event(key, "expiration", namespace)
+                self._counters["misses"] += 1
+                return MISSING
+
+            value = self._decode(entry_key, version)
+            if value is MISSING:
+                # Removed by another process between the two reads
+                self._counters["misses"] += 1
+                return MISSING
+            if now - self._touched.get(entry_key, 0) >= self.touch_interval:
+                self._conn.execute(
+                    "UPDATE cache_entries SET last_access = ? WHERE namespace = ? AND key = ?",
+                    (now, namespace, key)
+                )
+                self._touched[entry_key] = now
+            if now >= expire_time:
+                self._counters["stale_hits"] += 1
+                return value, False
+            self._counters["hits"] += 1
+            return value, True
+
+    def set(
+        self,
+        key: str,
+        value: Any,
+        ttl: float = 30,
+        namespace: str = DEFAULT_NAMESPACE,
+        stale_ttl: float = 0
+    ):
+        with self._lock:
+            self._maybe_sweep()
+            if ttl <= 0:
+                self.delete(key, namespace)
+                return
+
+            blob = json.dumps(value, separators=(",", ":"), default=str).encode("utf-8")
+            if len(blob) > self.max_bytes:
+                print(f"Cache: not storing {namespace}:{key}, {len(blob)} bytes exceeds limit")
+                self.delete(key, namespace)
+                return
+
+            now = time.time()
+            expire_time = now + ttl
+            version = hashlib.sha256(blob).hexdigest()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache_entries "
+                "(namespace, key, value, expire_time, stale_until, size, last_access, version) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (namespace, key, blob, expire_time, expire_time + max(stale_ttl, 0), len(blob), now, version)
+            )
+            # The next read decodes the stored copy, so it can't differ from what other processes see
+            self._forget((namespace, key))
+            self._touched[(namespace, key)] = now
+            self._counters["sets"] += 1
+            self._evict()
+
+    def delete(self, key: str, namespace: str = DEFAULT_NAMESPACE) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key)
+            )
+            self._forget((namespace, key))
+            return cursor.rowcount > 0
+
+    def clear(self, namespace: Optional[str] = None):
+        with self._lock:
+            if namespace is None:
+                self._conn.execute("DELETE FROM cache_entries")
+                self._conn.execute("DELETE FROM cache_dependencies")
+                self._decoded.clear()
+                self._touched.clear()
+            else:
+                self._conn.execute("DELETE FROM cache_entries WHERE namespace = ?", (namespace,))
+                self._conn.execute("DELETE FROM cache_dependencies WHERE namespace = ?", (namespace,))
+                for entry_key in [k for k in {**self._touched, **self._decoded} if k[0] == namespace]:
+                    self._forget(entry_key)
+
+    def sweep(self) -> int:
+        with self._lock:
+            now = time.time()
+            expired = self._conn.execute(
+                "SELECT namespace, key FROM cache_entries WHERE stale_until <= ?", (now,)
+            ).fetchall()
+            self._conn.execute("DELETE FROM cache_entries WHERE stale_until <= ?", (now,))
+            for namespace, key in expired:
+                self._forget((namespace, key))
+                record_cache_event(key, "expiration", namespace)
+            self._counters["expirations"] += len(expired)
+            self._last_sweep = now
+            return len(expired)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            namespaces: Dict[str, Dict[str, int]] = {}
+            rows = self._conn.execute(
+                "SELECT namespace, COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries GROUP BY namespace"
+            ).fetchall()
+            for namespace, entries, size in rows:
+                namespaces[namespace] = {"entries": entries, "bytes": size}
+            dependencies, = self._conn.execute("SELECT COUNT(*) FROM cache_dependencies").fetchone()
+
+            return {
+                "backend": "sqlite",
+                "entries": sum(ns["entries"] for ns in namespaces.values()),
+                "dependencies": dependencies,
+                "bytes": sum(ns["bytes"] for ns in namespaces.values()),
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "decoded_entries": len(self._decoded),
+                "namespaces": namespaces,
+                **self._counters
+            }
+
+    def add_dependency(self, source: str, dependent: str, namespace: str = DEFAULT_NAMESPACE):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO cache_dependencies VALUES (?, ?, ?)", (namespace, source, dependent)
+            )
+
+    def get_dependents(self, source: str, namespace: str = DEFAULT_NAMESPACE) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT dependent FROM cache_dependencies WHERE namespace = ? AND source = ? ORDER BY rowid",
+                (namespace, source)
+            ).fetchall()
+            return [row[0] for row in rows]
+
+    def pop_dependents(self, source: str, namespace: str = DEFAULT_NAMESPACE) -> List[str]:
+        with self._lock:
+            # One transaction, so an edge another process adds meanwhile is either returned or kept
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                dependents = self.get_dependents(source, namespace)
+                self._conn.execute(
+                    "DELETE FROM cache_dependencies WHERE namespace = ? AND source = ?", (namespace, source)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return dependents
+
+    def try_lease(self, name: str, owner: str, ttl: float) -> bool:
+        with self._lock:
+            now = time.time()
+            # One statement, so two processes can't both take an expired lease
+            cursor = self._conn.execute(
+                "INSERT INTO cache_leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE "
+                "SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE cache_leases.owner = excluded.owner OR cache_leases.expires <= ?",
+                (name, owner, now + ttl, now)
+            )
+            return cursor.rowcount > 0
+
+    def _evict(self):
+        entries, total = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries"
+        ).fetchone()
+        while entries > self.max_entries or total > self.max_bytes:
+            row = self._conn.execute(
+                "SELECT namespace, key, size FROM cache_entries ORDER BY last_access LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self._conn.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (row[0], row[1])
+            )
+            self._forget((row[0], row[1]))
+            entries -= 1
+            total -= row[2]
+            self._counters["evictions"] += 1
+            record_cache_event(row[1], "eviction", row[0])
+
+    def _decode(self, entry_key: tuple, version: str) -> Any:
+        """The entry's value, decoded once per process for each version stored"""
+        decoded = self._decoded.get(entry_key)
+        if decoded is not None and version and decoded[0] == version:
+            self._decoded.move_to_end(entry_key)
+            return decoded[1]
+
+        row = self._conn.execute(
+            "SELECT value, version FROM cache_entries WHERE namespace = ? AND key = ?", entry_key
+        ).fetchone()
+        if row is None:
+            self._forget(entry_key)
+            return MISSING
+        value = json.loads(row[0])
+        # Rows written before versions were stored have an empty one and aren't kept
+        if row[1]:
+            self._decoded[entry_key] = (row[1], value)
+            self._decoded.move_to_end(entry_key)
+            while len(self._decoded) > self.max_entries:
+                self._decoded.popitem(last=False)
+        return value
+
+    def _forget(self, entry_key: tuple):
+        self._decoded.pop(entry_key, None)
+        self._touched.pop(entry_key, None)
+
+    def _maybe_sweep(self):
+        if time.time() - self._last_sweep >= self.sweep_interval:
+            self.sweep()
+
+
+def _create_backend() -> CacheBackend:
+    if CACHE_BACKEND == "sqlite":
+        print(f"Using shared SQLite cache at {CACHE_SQLITE_PATH}")
+        return SQLiteBackend()
+    if CACHE_BACKEND != "memory":
+        print(f"Unknown CACHE_BACKEND '{CACHE_BACKEND}', falling back to memory")
+    return MemoryBackend()
+
+
+_cache = _create_backend()
+# Identifies this process as the holder of leases
+_LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+def get_backend() -> CacheBackend:
+    return _cache
+
+def get_from_cache(key, namespace=DEFAULT_NAMESPACE):
+    value = lookup_in_cache(key, namespace)
+    return None if value is MISSING else value
+
+def lookup_in_cache(key, namespace=DEFAULT_NAMESPACE):
+    """Like get_from_cache, but returns MISSING on a miss so cached empty values count as hits"""
+    value = _cache.get(key, namespace, MISSING)
+    record_cache_event(key, "miss" if value is MISSING else "hit", namespace)
+    return value
+
+def get_cache_entry(key, namespace=DEFAULT_NAMESPACE):
+    entry = _cache.get_entry(key, namespace)
+    if entry is MISSING:
+        record_cache_event(key, "miss", namespace)
+    else:
+        record_cache_event(key, "hit" if entry[1] else "stale", namespace)
+    return entry
+
+def set_in_cache(key, value, ttl=30, namespace=DEFAULT_NAMESPACE, stale_ttl=0, depends_on=None):
+    """
+    Store a value. depends_on lists the keys (in the same namespace) it was
+    derived from; invalidating any of them also invalidates this key.
+    """
+    _cache.set(key, value, ttl, namespace, stale_ttl)
+    for source in depends_on or ():
+        add_dependency(source, key, namespace)
+
+def add_dependency(source, dependent, namespace=DEFAULT_NAMESPACE):
+    """Record that dependent was derived from source"""
+    _cache.add_dependency(source, dependent, namespace)
+
+def get_dependents(source, namespace=DEFAULT_NAMESPACE):
+    """Keys directly derived from source"""
+    return _cache.get_dependents(source, namespace)
+
+def invalidate_in_cache(key, namespace=DEFAULT_NAMESPACE):
+    """
+    Remove a key and, transitively, every key derived from it.
+    Returns the invalidated keys, starting with key itself.
+    """
+    invalidated = []
+    pending = [key]
+    while pending:
+        current = pending.pop()
+        if current in invalidated:
+            continue
+        invalidated.append(current)
+        _cache.delete(current, namespace)
+        pending.extend(_cache.pop_dependents(current, namespace))
+    return invalidated
+
+def remember_failure(key, error, negative_ttl=NEGATIVE_CACHE_TTL):
+    """Remember that fetching key failed, for negative_ttl seconds plus jitter"""
+    backoff = negative_ttl * (1 + random.uniform(0, NEGATIVE_CACHE_JITTER))
+    failure = {"error": str(error), "status_code": getattr(error, "status_code", None)}
+    _cache.set(key, failure, backoff, NEGATIVE_NAMESPACE)
+
+def recent_failure(key) -> Optional[UpstreamFailure]:
+    """The failure remembered for key, if it is still backing off"""
+    failure = lookup_in_cache(key, NEGATIVE_NAMESPACE)
+    if failure is MISSING:
+        return None
+    return UpstreamFailure(key, failure["error"], failure["status_code"])
+
+def forget_failure(key):
+    """Stop backing off from key, so the next request fetches it again"""
+    _cache.delete(key, NEGATIVE_NAMESPACE)
+
+def acquire_lease(name, ttl):
+    """
+    Take or renew a lease for this process, returning True if it holds it.
+    Unless renewed, it passes to another process after ttl seconds.
+    """
+    return _cache.try_lease(name, _LEASE_OWNER, ttl)
+
+def get_cache_stats():
+    return _cache.stats()
@@ -0,0 +1,132 @@
+import asyncio
+import gzip
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Last PluralKit data we received, kept on disk so a restart starts warm
+# and an outage can still be answered from it
+DISK_SNAPSHOT_ENABLED = os.getenv("DISK_SNAPSHOT_ENABLED", "true").lower() == "true"
+DISK_SNAPSHOT_PATH = Path(os.getenv("DISK_SNAPSHOT_PATH", str(Path("dough-data") / "pluralkit_snapshot.json.gz")))
+# Changes are batched for this many seconds before the file is rewritten
+DISK_SNAPSHOT_DELAY = float(os.getenv("DISK_SNAPSHOT_DELAY", 2))
+
+SNAPSHOT_FORMAT = 1
+
+# Cache keys worth persisting; members are rebuilt from these, and the
+# switch history keeps its own file (see switch_store.py)
+PERSISTED_KEYS = ("system", "members_raw", "fronters")
+
+# key -> {"data", "hash", "changed_at"}
+_entries: Dict[str, Dict[str, Any]] = {}
+_lock = threading.Lock()
+_dirty = False
+_flush_task: Optional[asyncio.Task] = None
+# Entries of the file as any worker last wrote it, and the mtime they were read at
+_file_entries: Dict[str, Dict[str, Any]] = {}
+_file_mtime: Optional[int] = None
+
+
+def is_persisted(key: str) -> bool:
+    return key in PERSISTED_KEYS
+
+
+def _read_file() -> Dict[str, Dict[str, Any]]:
+    try:
+        with gzip.open(DISK_SNAPSHOT_PATH, "rt", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        if snapshot.get("format") != SNAPSHOT_FORMAT:
+            print(f"Ignoring PluralKit snapshot with unknown format {snapshot.get('format')}")
+            return {}
+    except (OSError, ValueError) as e:
+        print(f"Could not read PluralKit snapshot {DISK_SNAPSHOT_PATH}: {e}")
+        return {}
+    return {key: entry for key, entry in snapshot.get("entries", {}).items() if is_persisted(key)}
+
+
+def load_snapshot() -> Dict[str, Dict[str, Any]]:
+    """Read the snapshot file into memory, returning its entries"""
+    if not DISK_SNAPSHOT_ENABLED or not DISK_SNAPSHOT_PATH.exists():
+        return {}
+    entries = _read_file()
+    with _lock:
+        _entries.update(entries)
+    return entries
+
+
+def last_known_good(key: str) -> Optional[Dict[str, Any]]:
+    """Most recent snapshot entry for a key, if there is one"""
+    with _lock:
+        return _entries.get(key)
+
+
+def shared_entry(key: str) -> Optional[Dict[str, Any]]:
+    """
+    Entry for a key as the snapshot file currently holds it, which may have
+    been written by another worker since this one started. The file is
+    read again only when it has changed.
+    """
+    global _file_entries, _file_mtime
+    if not DISK_SNAPSHOT_ENABLED:
+        return None
+    try:
+        mtime = DISK_SNAPSHOT_PATH.stat().st_mtime_ns
+    except OSError:
+        return last_known_good(key)
+    if mtime != _file_mtime:
+        _file_entries, _file_mtime = _read_file(), mtime
+    return _file_entries.get(key) or last_known_good(key)
+
+
+def save_snapshot():
+    """Write every entry to disk, replacing the file atomically"""
+    global _dirty
+    with _lock:
+        if not _dirty:
+            return
+        payload = {"format": SNAPSHOT_FORMAT, "saved_at": time.time(), "entries": dict(_entries)}
+        _dirty = False
+
+    tmp_path = DISK_SNAPSHOT_PATH.with_name(f"{DISK_SNAPSHOT_PATH.name}.{os.getpid()}.tmp")
+    try:
+        DISK_SNAPSHOT_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, DISK_SNAPSHOT_PATH)
+    except OSError as e:
+        print(f"Could not write PluralKit snapshot {DISK_SNAPSHOT_PATH}: {e}")
+        tmp_path.unlink(missing_ok=True)
+
+
+async def _flush_later():
+    global _flush_task
+    try:
+        await asyncio.sleep(DISK_SNAPSHOT_DELAY)
+        await asyncio.to_thread(save_snapshot)
+    finally:
+        _flush_task = None
+
+
+def remember(key: str, data: Any, version: Dict[str, Any]):
+    """Record freshly fetched data for a key, writing the file soon if it changed"""
+    global _dirty, _flush_task
+    if not DISK_SNAPSHOT_ENABLED or not is_persisted(key):
+        return
+    with _lock:
+        previous = _entries.get(key)
+        if previous is not None and previous["hash"] == version["hash"]:
+            return
+        _entries[key] = {"data": data, "hash": version["hash"], "changed_at": version["changed_at"]}
+        _dirty = True
+
+    if _flush_task is None:
+        try:
+            _flush_task = asyncio.get_running_loop().create_task(_flush_later())
+        except RuntimeError:
+            save_snapshot()
@@ -0,0 +1,313 @@
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+
+# Fixed windows reported next to the totals, in seconds
+TIMEFRAMES = {
+    "24h": 24 * 3600,
+    "48h": 48 * 3600,
+    "5d": 5 * 24 * 3600,
+    "7d": 7 * 24 * 3600,
+    "30d": 30 * 24 * 3600,
+}
+
+
+# End of a run that is still going on
+OPEN = 2 ** 63 - 1
+
+
+def round_seconds(seconds: float) -> float:
+    """
+    Seconds rounded to whole microseconds, the precision switches are
+    stored at. Adding up float seconds can be off in the last digits, so
+    every path reporting fronting time rounds with this to agree exactly.
+    """
+    return round(seconds, 6)
+
+
+class FrontingIndex:
+    """
+    For each member, the runs of time it fronted without a break and the
+    microseconds it had fronted before each run began. That prefix sum
+    makes the time fronted in any range two binary searches per member.
+    Switches are appended as they arrive, and the newest ones can be
+    dropped again when PluralKit edits or deletes them.
+    """
+
+    def __init__(self):
+        # member code -> (run starts, run ends, microseconds fronted before each run)
+        self.runs: Dict[int, Tuple[List[int], List[int], List[int]]] = {}
+        # Members of the latest switch, whose runs are open
+        self.current: set = set()
+
+    def append(self, start_us: int, codes: List[int]):
+        """Add a switch made at start_us; it must be newer than every other"""
+        fronting = set(codes)
+        for code in self.current - fronting:
+            self.runs[code][1][-1] = start_us
+        for code in fronting - self.current:
+            starts, ends, before = self.runs.setdefault(code, ([], [], []))
+            before.append(before[-1] + ends[-1] - starts[-1] if starts else 0)
+            starts.append(start_us)
+            ends.append(OPEN)
+        self.current = fronting
+
+    def truncate(self, at_us: int):
+        """Forget every switch made at or after at_us"""
+        self.current = set()
+        for code, (starts, ends, before) in self.runs.items():
+            while starts and starts[-1] >= at_us:
+                starts.pop()
+                ends.pop()
+                before.pop()
+            # Runs that reached at_us belonged to the switch before it, now the latest
+            if starts and ends[-1] >= at_us:
+                ends[-1] = OPEN
+                self.current.add(code)
+
+    def fronted_before(self, code: int, t_us: int) -> int:
+        """Microseconds the member had fronted before t_us (no later than now)"""
+        starts, ends, before = self.runs[code]
+        i = bisect_right(starts, t_us) - 1
+        if i < 0:
+            return 0
+        return before[i] + min(t_us, ends[i]) - starts[i]
+
+    def fronted_between(self, from_us: int, to_us: int) -> Dict[int, int]:
+        """Microseconds each member fronted within [from_us, to_us), leaving out zeros"""
+        result = {}
+        for code in self.runs:
+            fronted = self.fronted_before(code, to_us) - self.fronted_before(code, from_us)
+            if fronted > 0:
+                result[code] = fronted
+        return result
+
+
+class FrontingTimeline:
+    """
+    The switch history as arrays, oldest first:
+
+        starts        int64 epoch microseconds of each switch
+        offsets       int64, the members of switch i are codes[offsets[i]:offsets[i + 1]]
+        codes         int32 index of each of those members into member_ids
+
+    Every switch starts an interval lasting until the next one (or now for
+    the latest), which its members are credited with. A FrontingIndex of
+    the same history answers arbitrary ranges.
+
+    Followers, like the running metrics, are given the same append() and
+    truncate() calls as the index when the history is updated in place.
+    A full rebuild drops them and bumps generation instead.
+    """
+
+    def __init__(self, switches: List[Dict[str, Any]]):
+        self.member_ids: List[str] = []
+        self._code_of: Dict[str, int] = {}
+        self.followers: List[Any] = []
+        self.generation = 0
+        self._build(switches)
+
+    def _code(self, member_id: str) -> int:
+        code = self._code_of.get(member_id)
+        if code is None:
+            code = self._code_of[member_id] = len(self.member_ids)
+            self.member_ids.append(member_id)
+        return code
+
+    @staticmethod
+    def _columns(switches: List[Dict[str, Any]]) -> Tuple[np.ndarray, List[List[Any]]]:
+        """Start times, parsed when the switches were stored, and member lists"""
+        timestamps = np.fromiter((switch["timestamp_us"] for switch in switches), dtype=np.int64, count=len(switches))
+        return timestamps, [switch.get("members") or [] for switch in switches]
+
+    def _build(self, switches: List[Dict[str, Any]]):
+        # Kept so the timeline is only rebuilt when the history changes
+        self.switches = switches
+        self.followers = []
+        self.generation += 1
+
+        newest_first, member_lists = self._columns(switches)
+        # Switches can only be updated in place while they map one to one,
+        # in reverse, onto the store's newest-first list
+        self._in_list_order = bool(np.all(newest_first[:-1] > newest_first[1:]))
+
+        # Stable, so switches sharing a timestamp keep their order like sorted() would
+        order = np.argsort(newest_first, kind="stable")
+        self.starts = newest_first[order]
+
+        counts = np.zeros(len(order), dtype=np.int64)
+        codes = []
+        self.index = FrontingIndex()
+        for position, i in enumerate(order.tolist()):
+            members = member_lists[i]
+            counts[position] = len(members)
+            switch_codes = [self._code(member_id) for member_id in members]
+            codes.extend(switch_codes)
+            self.index.append(int(self.starts[position]), switch_codes)
+
+        self.offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.codes = np.array(codes, dtype=np.int32)
+
+    def _unchanged_count(self, switches: List[Dict[str, Any]]) -> Optional[int]:
+        """
+        How many of the oldest switches the new history shares with this one,
+        or None if it differs further back than the newest end.
+
+        The switch store keeps the switches it didn't refetch as the same
+        objects, so the shared part is found by identity from the oldest
+        end and then by comparing the few refetched ones.
+        """
+        old = self.switches
+        if not old or not switches or switches[-1] is not old[-1]:
+            return None
+        shift = len(switches) - len(old)
+        newest_kept = 0
+        while newest_kept < len(old):
+            i = newest_kept + shift
+            if 0 <= i and switches[i] is old[newest_kept]:
+                break
+            newest_kept += 1
+        while newest_kept > 0:
+            i = newest_kept - 1 + shift
+            if i < 0 or switches[i] != old[newest_kept - 1]:
+                break
+            newest_kept -= 1
+        return len(old) - newest_kept
+
+    def update(self, switches: List[Dict[str, Any]]) -> bool:
+        """
+        Bring the timeline up to date with a new version of the history,
+        replacing only the switches that changed at the newest end. Falls
+        back to a full rebuild, returning False, when that isn't possible.
+        """
+        kept = self._unchanged_count(switches) if self._in_list_order else None
+        if kept is not None:
+            added, member_lists = self._columns(list(reversed(switches[:len(switches) - kept])))
+            previous = self.starts[kept - 1] if kept else None
+            in_order = bool(np.all(added[1:] > added[:-1]))
+            if in_order and (previous is None or not len(added) or added[0] > previous):
+                followers = [self.index, *self.followers]
+                if kept < len(self.starts):
+                    for follower in followers:
+                        follower.truncate(int(self.starts[kept]))
+                codes = []
+                for start_us, members in zip(added.tolist(), member_lists):
+                    switch_codes = [self._code(member_id) for member_id in members]
+                    codes.extend(switch_codes)
+                    for follower in followers:
+                        follower.append(start_us, switch_codes)
+
+                counts = np.array([len(members) for members in member_lists], dtype=np.int64)
+                self.offsets = np.concatenate((self.offsets[:kept + 1], self.offsets[kept] + np.cumsum(counts)))
+                self.codes = np.concatenate((self.codes[:self.offsets[kept]], np.array(codes, dtype=np.int32)))
+                self.starts = np.concatenate((self.starts[:kept], added))
+                self.switches = switches
+                return True
+
+        self._build(switches)
+        return False
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def first_since(self, cutoff_us: int) -> int:
+        """Index of the oldest switch at or after cutoff_us"""
+        return int(np.searchsorted(self.starts, cutoff_us, side="left"))
+
+    def fronting_seconds(
+        self, cutoff_us: int, now_us: int, windows: Dict[str, int]
+    ) -> Optional[Tuple[float, List[Tuple[str, float, Dict[str, Any]]]]]:
+        """
+        Time fronted per member by the switches made since cutoff_us, as
+        (total_time, [(member_id, seconds, {window: seconds})]) with members in
+        the order they first fronted. None if there were no such switches.
+
+        An interval counts towards a window, in full, when it started no
+        more than that many seconds before now_us. A window a member never
+        fronted in is reported as 0, matching the original loop.
+        """
+        first = self.first_since(cutoff_us)
+        last = len(self.starts)
+        if first == last:
+            return None
+
+        starts = self.starts[first:]
+        ends = np.empty_like(starts)
+        ends[:-1] = starts[1:]
+        ends[-1] = now_us
+        # Microsecond integers divided like timedelta.total_seconds() does
+        durations = (ends - starts) / 1e6
+
+        # One entry per (interval, member fronting in it), in chronological order
+        lo, hi = self.offsets[first], self.offsets[last]
+        entry_codes = self.codes[lo:hi]
+        entry_counts = np.diff(self.offsets[first:last + 1])
+        entry_durations = np.repeat(durations, entry_counts)
+        entry_ago = np.repeat(now_us - starts, entry_counts)
+
+        # bincount adds the weights one after another, so each member's total
+        # comes out exactly as the sequential sum of its intervals
+        size = len(self.member_ids)
+        totals = np.bincount(entry_codes, weights=entry_durations, minlength=size)
+        per_window = {}
+        for name, seconds in windows.items():
+            inside = entry_ago <= seconds * 1_000_000
+            per_window[name] = (
+                np.bincount(entry_codes, weights=np.where(inside, entry_durations, 0.0), minlength=size),
+                np.bincount(entry_codes[inside], minlength=size),
+            )
+
+        # Members in the order they first fronted within the period
+        present, first_seen = np.unique(entry_codes, return_index=True)
+        ordered = present[np.argsort(first_seen, kind="stable")].tolist()
+
+        members = []
+        for code in ordered:
+            member_windows = {
+                name: round_seconds(float(sums[code])) if hits[code] else 0
+                for name, (sums, hits) in per_window.items()
+            }
+            members.append((self.member_ids[code], round_seconds(float(totals[code])), member_windows))
+
+        # cumsum adds in order too, unlike sum(), which pairs values up
+        total_time = round_seconds(float(np.cumsum(durations)[-1]))
+        return total_time, members
+
+    def fronting_between(self, from_us: int, to_us: int, now_us: int) -> Tuple[float, List[Tuple[str, float]]]:
+        """
+        Seconds each member fronted within [from_us, to_us), clipped to the
+        range, most first, along with the seconds of the range the history
+        covers. Uses the prefix sums instead of scanning the switches.
+        """
+        to_us = min(to_us, now_us)
+        if not len(self.starts) or to_us <= from_us:
+            return 0.0, []
+        covered = max(0, to_us - max(from_us, int(self.starts[0])))
+        fronted = self.index.fronted_between(from_us, to_us)
+        members = [
+            (self.member_ids[code], microseconds / 1e6)
+            for code, microseconds in sorted(fronted.items(), key=lambda item: -item[1])
+        ]
+        return covered / 1e6, members
+
+    def switch_counts(self, cutoff_us: int, now_us: int, windows: Dict[str, int]) -> Tuple[int, Dict[str, int]]:
+        """Switches made since cutoff_us, in total and within each window of now_us"""
+        first = self.first_since(cutoff_us)
+        ago = now_us - self.starts[first:]
+        counts = {name: int(np.count_nonzero(ago <= seconds * 1_000_000)) for name, seconds in windows.items()}
+        return len(self.starts) - first, counts
+
+
+_timeline: Optional[FrontingTimeline] = None
+
+
+def get_timeline(switches: List[Dict[str, Any]]) -> FrontingTimeline:
+    """Timeline of the given history, updated once per version of it"""
+    global _timeline
+    # The switch store replaces its list whenever the history changes
+    if _timeline is None:
+        _timeline = FrontingTimeline(switches)
+    elif _timeline.switches is not switches:
+        _timeline.update(switches)
+    return _timeline
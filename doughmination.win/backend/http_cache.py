@@ -0,0 +1,104 @@
+import hashlib
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Optional, Union
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+
+# Clients may keep a copy but must revalidate it, which costs a 304 when unchanged
+CACHE_CONTROL = "public, no-cache"
+
+
+def encode_json(payload: Any) -> bytes:
+    """Encode a payload the same way FastAPI's JSONResponse does"""
+    return json.dumps(
+        jsonable_encoder(payload),
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":")
+    ).encode("utf-8")
+
+
+def make_etag(body: bytes) -> str:
+    """Strong ETag derived from the response body"""
+    return f'"{hashlib.sha256(body).hexdigest()}"'
+
+
+def _to_datetime(value: Union[datetime, float, str, None]) -> Optional[datetime]:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        dt = datetime.fromtimestamp(value, tz=timezone.utc)
+    elif isinstance(value, str):
+        try:
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    else:
+        dt = value
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    # HTTP dates have whole-second precision
+    return dt.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def latest(*values: Union[datetime, float, str, None]) -> Optional[datetime]:
+    """Most recent of several timestamps, ignoring missing ones"""
+    parsed = [dt for dt in (_to_datetime(v) for v in values) if dt is not None]
+    return max(parsed) if parsed else None
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison, so ignore W/ prefixes
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in candidates
+
+
+def _not_modified_since(if_modified_since: str, last_modified: datetime) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return last_modified <= since
+
+
+def conditional_response(
+    request: Request,
+    body: bytes,
+    media_type: str = "application/json",
+    etag: Optional[str] = None,
+    last_modified: Union[datetime, float, str, None] = None,
+    headers: Optional[dict] = None
+) -> Response:
+    """
+    Build a response with ETag and Last-Modified headers, or a 304 Not Modified
+    if the client's If-None-Match / If-Modified-Since show it already has this body.
+    """
+    etag = etag or make_etag(body)
+    if not etag.startswith(('"', 'W/"')):
+        etag = f'"{etag}"'
+    last_modified = _to_datetime(last_modified)
+
+    response_headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, **(headers or {})}
+    if last_modified:
+        response_headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    # If-None-Match takes precedence over If-Modified-Since when both are sent
+    if if_none_match is not None:
+        not_modified = _etag_matches(if_none_match, etag)
+    elif if_modified_since is not None and last_modified:
+        not_modified = _not_modified_since(if_modified_since, last_modified)
+    else:
+        not_modified = False
+
+    if not_modified:
+        return Response(status_code=304, headers=response_headers)
+    return Response(content=body, media_type=media_type, headers=response_headers)
@@ -0,0 +1,64 @@
+import importlib.util
+import os
+from typing import Dict
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Connection pool and timeout settings shared by every upstream client
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 10))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+
+# One long-lived client per upstream, e.g. "pluralkit" and "turnstile"
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _http2_available() -> bool:
+    if not HTTP2_ENABLED:
+        return False
+    if importlib.util.find_spec("h2") is None:
+        print("HTTP2_ENABLED is set but the h2 package is not installed, using HTTP/1.1")
+        return False
+    return True
+
+
+def _create_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=_http2_available(),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    )
+
+
+def get_client(upstream: str) -> httpx.AsyncClient:
+    """
+    Shared client for an upstream, keeping its connections alive between calls.
+    Created on first use if the app lifespan hasn't opened it already.
+    """
+    client = _clients.get(upstream)
+    if client is None or client.is_closed:
+        client = _clients[upstream] = _create_client()
+    return client
+
+
+def open_clients(*upstreams: str):
+    """Create the clients for the given upstreams up front"""
+    for upstream in upstreams:
+        get_client(upstream)
+
+
+async def close_clients():
+    """Close every client and its pooled connections"""
+    for client in list(_clients.values()):
+        await client.aclose()
+    _clients.clear()
@@ -9,12 +9,14 @@ import json
 import asyncio
 import re
 import weakref
-from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import List, Optional, Set, Dict, Any
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-from fastapi import FastAPI, HTTPException, Request, Depends, Security, status, File, UploadFile, WebSocket, WebSocketDisconnect, Body
-from fastapi.responses import JSONResponse, FileResponse, RedirectResponse, Response, HTMLResponse
+from fastapi import FastAPI, HTTPException, Request, Depends, Security, status, File, UploadFile, WebSocket, WebSocketDisconnect, Body, BackgroundTasks, Query
+from fastapi.responses import JSONResponse, FileResponse, RedirectResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.base import BaseHTTPMiddleware
@@ -23,7 +25,17 @@ from jose import JWTError
 from dotenv import load_dotenv
 
 # Local imports
-from pluralkit import get_system, get_members, get_fronters, set_front
+from pluralkit import (
+    get_system, get_members, get_fronters, get_member_index, set_front, invalidate, get_data_version,
+    stale_since, warm_start, add_change_listener, get_switch_queue_stats
+)
+from disk_snapshot import save_snapshot
+from avatar_proxy import (
+    AVATAR_FORMATS, IMMUTABLE_CACHE_CONTROL, cached_thumbnail_url, ensure_thumbnails,
+    is_valid_digest, parse_filename, prune_thumbnails, proxy_url, thumbnail_path, thumbnail_url
+)
+from webhooks import apply_dispatch, verify_signing_token, webhook_enabled
+from pluralkit_client import PluralKitError
 from auth import router as auth_router, get_current_user, oauth2_scheme
 from tags import (
     get_member_tags, update_member_tags, add_member_tag, remove_member_tag,
@@ -33,7 +45,15 @@ from models import (
     UserCreate, UserResponse, UserUpdate, MentalState
 )
 from users import get_users, create_user, delete_user, initialize_admin_user, update_user, get_user_by_id
-from metrics import get_fronting_time_metrics, get_switch_frequency_metrics
+from metrics import get_fronting_time_metrics, get_fronting_range_metrics, get_fronting_timeline_metrics, get_switch_frequency_metrics
+from metrics_rollups import METRICS_MAX_TIMEZONES, METRICS_TIMELINE_MAX_BUCKETS, METRICS_TIMEZONE, RESOLUTIONS, has_rollups
+from switch_store import parse_timestamp
+from snapshots import get_members_snapshot, get_fronters_snapshot, data_changed_at
+from http_cache import conditional_response, encode_json, latest
+from prefetch import create_scheduler, mark_activity
+from http_clients import open_clients, close_clients
+from telemetry import get_telemetry, render_prometheus
+from cache import get_cache_stats
 from member_status import (
     get_member_status, set_member_status, clear_member_status,
     enrich_members_with_status, initialize_status_storage
@@ -44,7 +64,27 @@ from member_status import (
 # ============================================================================
 load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled, keep-alive HTTP client per upstream for the app's lifetime
+    open_clients("pluralkit", "turnstile", "avatars")
+    
+    # Serve the last PluralKit data we saw until the first refreshes land
+    restored = warm_start()
+    if restored:
+        print(f"Restored {restored} PluralKit cache keys from disk")
+    
+    # Keep the PluralKit caches warm in the background while the app runs
+    scheduler = create_scheduler()
+    if scheduler:
+        scheduler.start()
+    yield
+    if scheduler:
+        await scheduler.stop()
+    save_snapshot()
+    await close_clients()
+
+app = FastAPI(lifespan=lifespan)
 
 # Initialize the admin user if no users exist
 initialize_admin_user()
@@ -81,6 +121,12 @@ class FileSizeLimitMiddleware(BaseHTTPMiddleware):
         response = await call_next(request)
         return response
 
+# Request activity middleware, lets the prefetch scheduler pause while nobody is visiting
+class ActivityMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        mark_activity()
+        return await call_next(request)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -97,11 +143,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Data-Stale"],
 )
 
 # Add the file size limit middleware
 app.add_middleware(FileSizeLimitMiddleware)
 
+# Add the activity middleware
+app.add_middleware(ActivityMiddleware)
+
 # Include login route
 app.include_router(auth_router)
 
@@ -125,6 +175,16 @@ DATA_DIR = Path("dough-data")
 DATA_DIR.mkdir(exist_ok=True)
 MENTAL_STATE_FILE = DATA_DIR / "mental_state.json"
 
+# Persist the default mental state once, so its updated_at (and the ETag of
+# responses that include it) stays stable until an admin changes it
+if not MENTAL_STATE_FILE.exists():
+    with open(MENTAL_STATE_FILE, "w") as f:
+        json.dump({
+            "level": "safe",
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "notes": None
+        }, f, indent=2)
+
 # Check if we have a built frontend to serve
 if FRONTEND_BUILD_DIR.exists() and (FRONTEND_BUILD_DIR / "index.html").exists():
     # Copy frontend build to static directory
@@ -187,6 +247,17 @@ Sitemap: https://www.doughmination.win/sitemap.xml
 """
     return Response(content=robots_content, media_type="text/plain")
 
+SITE_URL = "https://www.doughmination.win"
+FALLBACK_AVATAR_URL = "https://www.yuri-lover.win/cdn/pfp/fallback_avatar.png"
+
+def public_avatar_url(member: Dict[str, Any], size: int = 512, fmt: str = "png") -> str:
+    """Absolute URL of a member's proxied avatar, for crawlers and link embeds"""
+    avatar_url = member.get("avatar_url")
+    if not avatar_url:
+        return FALLBACK_AVATAR_URL
+    # The immutable thumbnail once it exists, otherwise the redirecting proxy URL
+    return SITE_URL + (cached_thumbnail_url(avatar_url, size, fmt) or proxy_url(member.get("id", ""), size, fmt))
+
 @app.get("/sitemap.xml")
 async def sitemap_xml():
     """Generate dynamic sitemap with all member pages"""
@@ -218,7 +289,7 @@ async def sitemap_xml():
         # Add each member page
         for member in members:
             member_name = member.get('name', '').replace(' ', '%20')
-            avatar_url = member.get('avatar_url', '')
+            avatar_url = public_avatar_url(member) if member.get('avatar_url') else ''
             
             sitemap += f"""  <!-- Member: {member.get('display_name') or member.get('name')} -->
   <url>
@@ -279,8 +350,6 @@ async def websocket_endpoint(websocket: WebSocket):
     WebSocket endpoint with improved error handling and connection management
     """
 
-    manager = ConnectionManager()
-
     # Accept the WebSocket connection first
     await manager.connect(websocket, "all")
     
@@ -432,12 +501,63 @@ class ConnectionManager:
         message = json.dumps(data)
         await self.broadcast(message, group)
 
+# One manager shared by every connection, so broadcasts reach all clients
+manager = ConnectionManager()
+
+def _update_message(message_type: str, encoded_data: bytes) -> str:
+    """{type, timestamp, data} message around an already encoded JSON payload"""
+    timestamp = datetime.now(timezone.utc).isoformat()
+    return f'{{"type":"{message_type}","timestamp":"{timestamp}","data":{encoded_data.decode("utf-8")}}}'
+
+async def broadcast_frontend_update(message_type: str, data: Any = None):
+    """Send an update of the given type to every connected client"""
+    await manager.broadcast(_update_message(message_type, encode_json(data)))
+
+async def broadcast_fronting_update():
+    """Push the current fronters, as served by /api/fronters"""
+    snapshot = await get_fronters_snapshot()
+    await manager.broadcast(_update_message("fronting_update", snapshot.body))
+
+async def broadcast_members_update():
+    """Push the current member list, as served by /api/members"""
+    snapshot = await get_members_snapshot()
+    await manager.broadcast(_update_message("members_update", b'{"members":' + snapshot.body + b"}"))
+
+async def broadcast_members_delta(delta: Dict[str, Any]):
+    """Push only what changed in the member list, with new members enriched like /api/members"""
+    if delta["added"]:
+        delta = {**delta, "added": enrich_members_with_status(enrich_members_with_tags(delta["added"]))}
+    await broadcast_frontend_update("members_delta", delta)
+
+async def broadcast_mental_state_update(state_data: Dict[str, Any]):
+    await broadcast_frontend_update("mental_state_update", state_data)
+
+async def broadcast_pluralkit_change(key: str, data: Any):
+    """Push fronters and members to clients whenever their cached content changes"""
+    if key == "fronters":
+        await broadcast_fronting_update()
+    elif key == "members_delta":
+        await broadcast_members_delta(data)
+    elif key == "members":
+        await broadcast_members_update()
+
+add_change_listener(broadcast_pluralkit_change)
+
+async def prune_avatar_cache(key: str, data: Any):
+    """Drop resized avatars no member uses any more once the member list changes"""
+    if key == "members_raw":
+        pruned = await prune_thumbnails(member.get("avatar_url") for member in data)
+        if pruned:
+            print(f"Pruned {pruned} unused avatar URLs from the thumbnail cache")
+
+add_change_listener(prune_avatar_cache)
+
 # ============================================================================
 # MENTAL STATE API ENDPOINTS
 # ============================================================================
 
 @app.get("/api/mental-state")
-async def get_mental_state():
+async def get_mental_state(request: Request):
     """Get current mental state from database"""
     try:
         # Check if mental_state.json exists
@@ -446,21 +566,23 @@ async def get_mental_state():
                 state_data = json.load(f)
                 # Convert the string back to datetime
                 state_data["updated_at"] = datetime.fromisoformat(state_data["updated_at"])
-                return MentalState(**state_data)
+                state = MentalState(**state_data)
         else:
             # Default state
-            return MentalState(
+            state = MentalState(
                 level="safe",
                 updated_at=datetime.now(timezone.utc),
                 notes=None
             )
     except Exception as e:
         print(f"Error loading mental state: {e}")
-        return MentalState(
+        state = MentalState(
             level="safe",
             updated_at=datetime.now(timezone.utc),
             notes=None
         )
+    
+    return conditional_response(request, encode_json(state), last_modified=state.updated_at)
 
 @app.post("/api/mental-state")
 async def update_mental_state(state: MentalState, user = Depends(get_current_user)):
@@ -486,8 +608,15 @@ async def update_mental_state(state: MentalState, user = Depends(get_current_use
 # SYSTEM AND MEMBER API ENDPOINTS
 # ============================================================================
 
+def stale_headers(*keys: str) -> Optional[Dict[str, str]]:
+    """X-Data-Stale marker for responses built from data PluralKit can't currently refresh"""
+    since = stale_since(*keys)
+    if since is None:
+        return None
+    return {"X-Data-Stale": datetime.fromtimestamp(since, tz=timezone.utc).isoformat()}
+
 @app.get("/api/system")
-async def system_info():
+async def system_info(request: Request):
     try:
         # Get system data
         system_data = await get_system()
@@ -507,57 +636,62 @@ async def system_info():
                 notes=None
             )
         
-        # Add mental state to system data
-        system_data["mental_state"] = mental_state_data.dict()
-        
-        return system_data
+        # Add mental state to a copy of the (cached) system data
+        system_data = {**system_data, "mental_state": mental_state_data.dict()}
+        
+        system_version = get_data_version("system")
+        return conditional_response(
+            request,
+            encode_json(system_data),
+            last_modified=latest(
+                system_version["changed_at"] if system_version else None,
+                mental_state_data.updated_at
+            ),
+            headers=stale_headers("system")
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch system info: {str(e)}")
 
 @app.get("/api/members")
-async def members():
+async def members(request: Request):
     """Get members with tags and status information"""
     try:
-        # Get members
-        members_data = await get_members()
-        
-        # Enrich with tags
-        members_with_tags = enrich_members_with_tags(members_data)
-        
-        # Enrich with status information
-        members_with_status = enrich_members_with_status(members_with_tags)
-        
-        return members_with_status
+        # Pre-encoded payload, rebuilt only when members, tags or statuses change
+        snapshot = await get_members_snapshot()
+        return conditional_response(
+            request, snapshot.body, etag=snapshot.etag, last_modified=snapshot.last_modified,
+            headers=stale_headers("members_raw")
+        )
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch members: {str(e)}")
 
 @app.get("/api/fronters")
-async def fronters():
+async def fronters(request: Request):
     try:
-        fronters_data = await get_fronters()
-        
-        # Enrich fronters with tags and status
-        if "members" in fronters_data:
-            members_with_tags = enrich_members_with_tags(fronters_data["members"])
-            fronters_data["members"] = enrich_members_with_status(members_with_tags)
-        
-        return fronters_data
+        # Pre-encoded payload, rebuilt only when fronters, tags or statuses change
+        snapshot = await get_fronters_snapshot()
+        return conditional_response(
+            request, snapshot.body, etag=snapshot.etag, last_modified=snapshot.last_modified,
+            headers=stale_headers("fronters", "members_raw")
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch fronters: {str(e)}")
 
 @app.get("/api/member/{member_id}")
 async def member_detail(member_id: str):
     try:
-        members = await get_members()
-        for member in members:
-            if member["id"] == member_id or member["name"].lower() == member_id.lower():
-                # Enrich with tags and status
-                member_with_tags = enrich_members_with_tags([member])[0]
-                member_with_status = enrich_members_with_status([member_with_tags])[0]
-                return member_with_status
+        index = await get_member_index()
+        member = index.get(member_id)
+        if member:
+            # Enrich with tags and status
+            member_with_tags = enrich_members_with_tags([member])[0]
+            member_with_status = enrich_members_with_status([member_with_tags])[0]
+            return member_with_status
         raise HTTPException(status_code=404, detail="Member not found")
+    except HTTPException as http_exc:
+        raise http_exc
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch member details: {str(e)}")
 
@@ -574,13 +708,12 @@ async def switch_front(request: Request, user = Depends(get_current_user)):
         if not isinstance(member_ids, list):
             raise HTTPException(status_code=400, detail="'members' must be a list of member IDs")
 
+        # Caches the new fronters right away; the change listener broadcasts them
         await set_front(member_ids)
         
-        # Broadcast the fronting update
-        fronters_data = await get_fronters()
-        await broadcast_fronting_update(fronters_data)
-        
         return {"status": "success", "message": "Front updated successfully"}
+    except PluralKitError as e:
+        raise HTTPException(status_code=502, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -593,19 +726,18 @@ async def switch_single_front(request: Request, user = Depends(get_current_user)
         if not member_id:
             raise HTTPException(status_code=400, detail="member_id is required")
 
+        # Caches the new fronters right away; the change listener broadcasts them
         result = await set_front([member_id])
 
-        # After successful switch, broadcast the update
-        if result or True:  # Broadcast even if result is None
-            # Fetch the updated fronters data
-            fronters_data = await get_fronters()
-            await broadcast_fronting_update(fronters_data)
-
         return {"success": True, "message": "Front updated", "data": result}
 
     except HTTPException as http_exc:
         raise http_exc
 
+    except PluralKitError as e:
+        print("Error in /api/switch_front:", e)
+        raise HTTPException(status_code=502, detail=f"Failed to switch front: {str(e)}")
+
     except Exception as e:
         print("Error in /api/switch_front:", e)
         raise HTTPException(status_code=500, detail=f"Failed to switch front: {str(e)}")
@@ -626,26 +758,22 @@ async def switch_multiple_fronters(
             raise HTTPException(status_code=400, detail="'member_ids' must be a list")
         
         # Get the members to show their names in the response
-        all_members = await get_members()
+        index = await get_member_index()
         switching_members = []
         
         for member_id in member_ids:
-            for member in all_members:
-                if member.get("id") == member_id:
-                    switching_members.append({
-                        "id": member.get("id"),
-                        "name": member.get("name"),
-                        "display_name": member.get("display_name", member.get("name"))
-                    })
-                    break
+            member = index.get_by_id(member_id)
+            if member:
+                switching_members.append({
+                    "id": member.get("id"),
+                    "name": member.get("name"),
+                    "display_name": member.get("display_name", member.get("name"))
+                })
         
         # Switch the fronters
+        # Caches the new fronters right away; the change listener broadcasts them
         await set_front(member_ids)
         
-        # Broadcast the fronting update
-        fronters_data = await get_fronters()
-        await broadcast_fronting_update(fronters_data)
-        
         # Return detailed information about the switch
         return {
             "status": "success",
@@ -653,9 +781,58 @@ async def switch_multiple_fronters(
             "fronters": switching_members,
             "count": len(switching_members)
         }
+    except PluralKitError as e:
+        raise HTTPException(status_code=502, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ============================================================================
+# PLURALKIT WEBHOOK ENDPOINT
+# ============================================================================
+
+async def refresh_changed(changed: Set[str]):
+    """
+    Refetch what a dispatch event changed. Data that really differs is then
+    pushed to clients by the change listener, so echoes of our own switches
+    aren't broadcast twice.
+    """
+    try:
+        if "members" in changed:
+            await get_members()
+        if "fronters" in changed:
+            await get_fronters()
+        if "system" in changed:
+            await get_system()
+    except Exception as e:
+        print(f"Error refreshing after PluralKit dispatch event: {e}")
+
+@app.post("/api/webhooks/pluralkit")
+async def pluralkit_webhook(request: Request, background_tasks: BackgroundTasks):
+    """
+    Receive PluralKit dispatch events, dropping the cached data they change
+    and pushing the fresh data to WebSocket clients
+    """
+    if not webhook_enabled():
+        raise HTTPException(status_code=404, detail="Webhook not configured")
+
+    try:
+        event = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    if not isinstance(event, dict):
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+
+    # PluralKit expects a 401 for a wrong token, including on its initial PING
+    if not verify_signing_token(event):
+        raise HTTPException(status_code=401, detail="Invalid signing token")
+
+    changed = apply_dispatch(event)
+    # Refetching and broadcasting happens after PluralKit gets its response
+    if changed:
+        background_tasks.add_task(refresh_changed, changed)
+
+    return {"success": True, "type": event.get("type")}
+
 # ============================================================================
 # MEMBER TAGS API ENDPOINTS
 # ============================================================================
@@ -690,9 +867,8 @@ async def update_member_tag_list(
         success = update_member_tags(member_identifier, tags)
         
         if success:
-            # Clear member cache to reflect changes
-            from cache import set_in_cache
-            set_in_cache("members_raw", None, 0)
+            # Drop anything derived from member tags
+            invalidate("member_tags")
             
             return {
                 "status": "success",
@@ -721,9 +897,8 @@ async def add_single_member_tag(
         success = add_member_tag(member_identifier, tag)
         
         if success:
-            # Clear member cache to reflect changes
-            from cache import set_in_cache
-            set_in_cache("members_raw", None, 0)
+            # Drop anything derived from member tags
+            invalidate("member_tags")
             
             return {
                 "status": "success",
@@ -754,9 +929,8 @@ async def remove_single_member_tag(
         success = remove_member_tag(member_identifier, tag)
         
         if success:
-            # Clear member cache to reflect changes
-            from cache import set_in_cache
-            set_in_cache("members_raw", None, 0)
+            # Drop anything derived from member tags
+            invalidate("member_tags")
             
             return {
                 "status": "success",
@@ -968,6 +1142,44 @@ async def upload_user_avatar(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error uploading avatar: {str(e)}")
 
+@app.get("/api/avatars/member/{member_id}/{filename}")
+async def member_avatar(member_id: str, filename: str):
+    """Redirect to the current thumbnail of a member's PluralKit avatar, e.g. .../256.webp"""
+    parsed = parse_filename(filename)
+    if not parsed:
+        raise HTTPException(status_code=404, detail="Avatar not found")
+    size, fmt = parsed
+
+    index = await get_member_index()
+    member = index.get(member_id)
+    if not member:
+        raise HTTPException(status_code=404, detail="Member not found")
+
+    # Short cache, so a changed avatar is picked up soon
+    headers = {"Cache-Control": "public, max-age=300"}
+    avatar_url = member.get("avatar_url")
+    if not avatar_url:
+        return RedirectResponse(FALLBACK_AVATAR_URL, headers=headers)
+    try:
+        digest = await ensure_thumbnails(avatar_url)
+    except Exception as e:
+        print(f"Error proxying avatar for {member_id}: {e}")
+        return RedirectResponse(avatar_url, headers={"Cache-Control": "no-cache"})
+    return RedirectResponse(thumbnail_url(digest, size, fmt), headers=headers)
+
+@app.get("/api/avatars/{digest}/{filename}")
+async def avatar_thumbnail(digest: str, filename: str):
+    """Serve a content-addressed avatar thumbnail, cacheable forever"""
+    parsed = parse_filename(filename)
+    if not is_valid_digest(digest) or not parsed:
+        raise HTTPException(status_code=404, detail="Avatar not found")
+    size, fmt = parsed
+
+    path = thumbnail_path(digest, size, fmt)
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Avatar not found")
+    return FileResponse(path, media_type=AVATAR_FORMATS[fmt], headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL})
+
 @app.get("/avatars/{filename}")
 async def get_avatar(filename: str):
     """Serve avatar images with proper content type handling"""
@@ -1017,15 +1229,80 @@ async def get_avatar(filename: str):
 # METRICS API ENDPOINTS
 # ============================================================================
 
+def parse_range_bound(value: str, name: str) -> datetime:
+    """An ISO 8601 time or date from a query parameter, UTC unless it says otherwise"""
+    try:
+        return parse_timestamp(value)
+    except Exception:
+        raise HTTPException(status_code=400, detail=f"'{name}' must be an ISO 8601 date or time")
+
 @app.get("/api/metrics/fronting-time")
-async def fronting_time_metrics(days: int = 30, user = Depends(get_current_user)):
-    """Get fronting time metrics for each member over different timeframes"""
+async def fronting_time_metrics(
+    days: int = 30,
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+    user = Depends(get_current_user)
+):
+    """
+    Get fronting time metrics for each member over different timeframes,
+    or with from and/or to, for exactly that range
+    """
     try:
+        if from_ is not None or to is not None:
+            start = parse_range_bound(from_, "from") if from_ is not None else datetime.fromtimestamp(0, timezone.utc)
+            end = parse_range_bound(to, "to") if to is not None else datetime.now(timezone.utc)
+            if end <= start:
+                raise HTTPException(status_code=400, detail="'to' must be later than 'from'")
+            return await get_fronting_range_metrics(start, end)
+
         metrics = await get_fronting_time_metrics(days)
         return metrics
+    except HTTPException as http_exc:
+        raise http_exc
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch fronting metrics: {str(e)}")
 
+@app.get("/api/metrics/timeline")
+async def fronting_timeline_metrics(
+    resolution: str = "day",
+    days: int = Query(30, ge=1),
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+    tz: str = METRICS_TIMEZONE,
+    heatmap: bool = False,
+    user = Depends(get_current_user)
+):
+    """
+    Fronting time of each member per hour or day, local to tz, over the
+    last `days` or from/to; with heatmap, also by weekday and hour of day
+    """
+    if resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"'resolution' must be one of: {', '.join(RESOLUTIONS)}")
+    try:
+        zone = ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(status_code=400, detail=f"Unknown time zone: {tz}")
+    if not has_rollups(zone):
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {METRICS_MAX_TIMEZONES} time zones are kept and {tz} is not one of them"
+        )
+
+    end = parse_range_bound(to, "to") if to is not None else datetime.now(timezone.utc)
+    try:
+        start = parse_range_bound(from_, "from") if from_ is not None else end - timedelta(days=days)
+    except OverflowError:
+        raise HTTPException(status_code=400, detail="'days' reaches back further than dates go")
+    if end <= start:
+        raise HTTPException(status_code=400, detail="'to' must be later than 'from'")
+    if (end - start) / RESOLUTIONS[resolution] > METRICS_TIMELINE_MAX_BUCKETS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {METRICS_TIMELINE_MAX_BUCKETS} buckets at once; narrow the range or use a coarser resolution"
+        )
+
+    return await get_fronting_timeline_metrics(start, end, resolution, zone, heatmap)
+
 @app.get("/api/metrics/switch-frequency")
 async def switch_frequency_metrics(days: int = 30, user = Depends(get_current_user)):
     """Get switch frequency metrics over different timeframes"""
@@ -1055,27 +1332,56 @@ async def admin_refresh(user = Depends(get_current_user)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to broadcast refresh: {str(e)}")
 
+@app.get("/api/admin/stats")
+async def admin_stats(user = Depends(get_current_user)):
+    """Cache and upstream instrumentation (admin only)"""
+    if not user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    
+    return {
+        "cache": get_cache_stats(),
+        "switch_queue": get_switch_queue_stats(),
+        **get_telemetry()
+    }
+
+@app.get("/api/admin/stats/prometheus")
+async def admin_stats_prometheus(user = Depends(get_current_user)):
+    """Cache and upstream instrumentation in Prometheus text format (admin only)"""
+    if not user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    
+    return Response(
+        content=render_prometheus(get_cache_stats()),
+        media_type="text/plain; version=0.0.4"
+    )
+
 # ============================================================================
 # MEMBER STATUS ENDPOINTS
 # ============================================================================
 @app.get("/api/members/{member_identifier}/status")
-async def get_member_status_endpoint(member_identifier: str):
+async def get_member_status_endpoint(member_identifier: str, request: Request):
     """Get status for a specific member (public endpoint)"""
     try:
         status = get_member_status(member_identifier)
         
         if status:
-            return {
+            payload = {
                 "success": True,
                 "member_identifier": member_identifier,
                 "status": status
             }
         else:
-            return {
+            payload = {
                 "success": True,
                 "member_identifier": member_identifier,
                 "status": None
             }
+        
+        return conditional_response(
+            request,
+            encode_json(payload),
+            last_modified=status.get("updated_at") if status else None
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch member status: {str(e)}")
 
@@ -1102,6 +1408,9 @@ async def set_member_status_endpoint(
         
         status = set_member_status(member_identifier, status_text, emoji)
         
+        # Drop anything derived from member statuses
+        invalidate("member_status")
+        
         return {
             "success": True,
             "message": f"Status updated for {member_identifier}",
@@ -1125,6 +1434,9 @@ async def clear_member_status_endpoint(
         success = clear_member_status(member_identifier)
         
         if success:
+            # Drop anything derived from member statuses
+            invalidate("member_status")
+            
             return {
                 "success": True,
                 "message": f"Status cleared for {member_identifier}"
@@ -1181,13 +1493,8 @@ async def serve_member_page(member_name: str, request: Request):
                 .replace("'", '&#x27;'))
     
     try:
-        members = await get_members()
-        member = None
-        
-        for m in members:
-            if m.get("name", "").lower() == member_name.lower():
-                member = m
-                break
+        index = await get_member_index()
+        member = index.get_by_name(member_name)
         
         if not member:
             return FileResponse(STATIC_DIR / "index.html")
@@ -1199,7 +1506,7 @@ async def serve_member_page(member_name: str, request: Request):
         display_name = escape_html(member.get("display_name") or member.get("name"))
         raw_description = member.get("description") or f"Member of the Doughmination System®"
         description = escape_html(raw_description)
-        avatar_url = member.get("avatar_url") or "https://www.yuri-lover.win/cdn/pfp/fallback_avatar.png"
+        avatar_url = public_avatar_url(member)
         member_id = member.get("id", "")
         
         # Prepare tags for keywords
@@ -1268,8 +1575,8 @@ async def serve_member_page(member_name: str, request: Request):
     <meta property="og:title" content="{display_name} - {pronouns}" />
     <meta property="og:description" content="{description}" />
     <meta property="og:image" content="{avatar_url}" />
-    <meta property="og:image:width" content="400" />
-    <meta property="og:image:height" content="400" />
+    <meta property="og:image:width" content="512" />
+    <meta property="og:image:height" content="512" />
     <meta property="og:image:alt" content="{display_name} avatar" />
     <meta property="og:type" content="profile" />
     <meta property="og:url" content="https://www.doughmination.win/{member_name}" />
@@ -1318,7 +1625,12 @@ async def serve_member_page(member_name: str, request: Request):
             flags=re.DOTALL
         )
         
-        return HTMLResponse(content=html_content)
+        return conditional_response(
+            request,
+            html_content.encode("utf-8"),
+            media_type="text/html",
+            last_modified=latest(data_changed_at(["members_raw"]), os.path.getmtime(index_path))
+        )
         
     except Exception as e:
         print(f"Error serving member page: {e}")
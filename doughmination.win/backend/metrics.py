@@ -1,90 +1,54 @@
 from datetime import datetime, timedelta, timezone
-import httpx
-import os
-from dotenv import load_dotenv
-from cache import get_from_cache, set_in_cache
+from switch_store import get_switch_history, to_epoch_us
+from fronting_engine import TIMEFRAMES, get_timeline
+from metrics_aggregator import expire_running_metrics, get_running_metrics
+from metrics_rollups import METRICS_TIMEZONE, get_rollups, local_isoformat
 from typing import List, Dict, Any, Optional
+from zoneinfo import ZoneInfo
 import traceback
-import re
 
-load_dotenv()
-
-BASE_URL = "https://api.pluralkit.me/v2"
-TOKEN = os.getenv("SYSTEM_TOKEN")
-CACHE_TTL = int(os.getenv("CACHE_TTL", 30))
-
-HEADERS = {
-    "Authorization": TOKEN
-}
-
-def parse_timestamp(timestamp_str: str) -> datetime:
-    """Parse timestamp string into datetime with proper timezone handling"""
-    try:
-        # Handle Z timezone
-        if timestamp_str.endswith('Z'):
-            timestamp_str = timestamp_str[:-1] + '+00:00'
-        
-        # Try direct parsing first
-        try:
-            dt = datetime.fromisoformat(timestamp_str)
-        except ValueError:
-            # If direct parsing fails, try handling microsecond precision issues
-            match = re.match(r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d+)(\+\d{2}:\d{2})', timestamp_str)
-            if match:
-                # Truncate microseconds to 6 digits and rebuild the string
-                base = match.group(1)
-                if len(base.split('.')[-1]) > 6:
-                    base = base.split('.')[0] + '.' + base.split('.')[-1][:6]
-                timestamp_str = f"{base}{match.group(2)}"
-                dt = datetime.fromisoformat(timestamp_str)
-            else:
-                # Try another approach for microsecond issues
-                parts = timestamp_str.split('.')
-                if len(parts) == 2 and '+' in parts[1]:
-                    ms_part, tz_part = parts[1].split('+', 1)
-                    if len(ms_part) > 6:
-                        ms_part = ms_part[:6]
-                    timestamp_str = f"{parts[0]}.{ms_part}+{tz_part}"
-                    dt = datetime.fromisoformat(timestamp_str)
-                else:
-                    raise ValueError(f"Could not parse timestamp: {timestamp_str}")
-        
-        # Ensure it's timezone-aware
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        
-        return dt
-    except Exception as e:
-        print(f"Error parsing timestamp {timestamp_str}: {str(e)}")
-        raise
-
-async def get_switches(limit: int = 1000) -> List[Dict[str, Any]]:
-    """Get recent switches from PluralKit"""
+async def get_switches(limit: Optional[int] = None, refresh: bool = False) -> List[Dict[str, Any]]:
+    """Get switches from the local switch history, newest first, optionally only the latest limit"""
     try:
-        cache_key = f"switches_{limit}"
-        if (cached := get_from_cache(cache_key)):
-            return cached
-        
-        print(f"Fetching switches from PluralKit API, limit={limit}")
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(f"{BASE_URL}/systems/@me/switches?limit={limit}", headers=HEADERS)
-            resp.raise_for_status()
-            data = resp.json()
-            print(f"Received {len(data)} switches from API")
-            set_in_cache(cache_key, data, CACHE_TTL)
-            return data
+        switches = await get_switch_history(refresh=refresh)
+        return switches[:limit] if limit else switches
     except Exception as e:
         print(f"Error in get_switches: {str(e)}")
         print(traceback.format_exc())
         # Return empty list instead of failing
         return []
 
+async def refresh_running_metrics():
+    """Feed new switches to the running metrics and rollups, and age out old ones"""
+    timeline = get_timeline(await get_switches())
+    # Built here the first time, so the timeline endpoint doesn't wait for it
+    get_rollups(timeline, ZoneInfo(METRICS_TIMEZONE))
+    expire_running_metrics(to_epoch_us(datetime.now(timezone.utc)))
+
+async def get_member_details() -> Dict[str, Dict[str, Any]]:
+    """Name, display name and avatar of each member, by ID"""
+    member_details = {}
+    try:
+        from pluralkit import get_members
+        members = await get_members()
+        print(f"Retrieved {len(members)} members for details")
+        for member in members:
+            member_details[member["id"]] = {
+                "name": member["name"],
+                "display_name": member.get("display_name", member["name"]),
+                "avatar_url": member.get("avatar_url", None)
+            }
+    except Exception as e:
+        print(f"Error fetching member details: {e}")
+        print(traceback.format_exc())
+    return member_details
+
 async def get_fronting_time_metrics(days: int = 30) -> Dict[str, Any]:
     """Calculate fronting time metrics for each member"""
     try:
         print(f"Calculating fronting metrics for past {days} days")
         # Get all switches for the specified period
-        switches = await get_switches(1000)  # Get a large number of switches
+        switches = await get_switches()  # The complete switch history
         print(f"Retrieved {len(switches)} switches")
         
         # Get current time and calculate the cutoff time
@@ -93,45 +57,22 @@ async def get_fronting_time_metrics(days: int = 30) -> Dict[str, Any]:
         print(f"Cutoff time: {cutoff_time.isoformat()}")
         
         # Get member details for display purposes
-        member_details = {}
-        try:
-            from pluralkit import get_members
-            members = await get_members()
-            print(f"Retrieved {len(members)} members for details")
-            for member in members:
-                member_details[member["id"]] = {
-                    "name": member["name"],
-                    "display_name": member.get("display_name", member["name"]),
-                    "avatar_url": member.get("avatar_url", None)
-                }
-        except Exception as e:
-            print(f"Error fetching member details: {e}")
-            print(traceback.format_exc())
-        
-        # Filter switches to only include those within the specified period
-        filtered_switches = []
-        for switch in switches:
-            try:
-                timestamp = parse_timestamp(switch["timestamp"])
-                if timestamp >= cutoff_time:
-                    filtered_switches.append({
-                        **switch,
-                        "_parsed_timestamp": timestamp  # Store the parsed timestamp
-                    })
-            except Exception as e:
-                print(f"Error parsing timestamp {switch.get('timestamp', 'unknown')}: {str(e)}")
-                continue
+        member_details = await get_member_details()
         
-        print(f"Filtered to {len(filtered_switches)} switches within time period")
-        
-        # Sort switches by timestamp (oldest first)
-        filtered_switches.sort(key=lambda x: x["_parsed_timestamp"])
-        
-        # Calculate fronting time for each member
-        fronting_times = {}
+        # Per-member totals for the period and each timeframe, read from the
+        # running aggregates, or computed over the whole history at once for
+        # periods that don't have them (see fronting_engine.py)
+        timeline = get_timeline(switches)
+        cutoff_us = to_epoch_us(cutoff_time)
+        print(f"Filtered to {len(timeline) - timeline.first_since(cutoff_us)} switches within time period")
+        running = get_running_metrics(timeline, days, to_epoch_us(now))
+        if running:
+            fronting = running.fronting_seconds(to_epoch_us(now), timeline.member_ids)
+        else:
+            fronting = timeline.fronting_seconds(cutoff_us, to_epoch_us(now), TIMEFRAMES)
         
         # If there are no switches in the period, return empty metrics
-        if not filtered_switches:
+        if fronting is None:
             print("No switches found in the specified time period")
             return {
                 "total_time": 0,
@@ -144,67 +85,7 @@ async def get_fronting_time_metrics(days: int = 30) -> Dict[str, Any]:
                     "30d": {}
                 }
             }
-        
-        # Add a virtual "current" switch to include time up to now
-        current_members = filtered_switches[-1]["members"]
-        filtered_switches.append({
-            "timestamp": now.isoformat(),
-            "members": current_members,
-            "_parsed_timestamp": now
-        })
-        
-        # Calculate total time for each member
-        total_time_seconds = 0
-        for i in range(1, len(filtered_switches)):
-            prev_switch = filtered_switches[i-1]
-            curr_switch = filtered_switches[i]
-            
-            try:
-                # Use the parsed timestamps
-                prev_time = prev_switch["_parsed_timestamp"]
-                curr_time = curr_switch["_parsed_timestamp"]
-                
-                # Calculate duration in seconds
-                duration_seconds = (curr_time - prev_time).total_seconds()
-                total_time_seconds += duration_seconds
-                
-                # Add duration to each member that was fronting
-                for member_id in prev_switch["members"]:
-                    if member_id not in fronting_times:
-                        fronting_times[member_id] = {
-                            "total_seconds": 0,
-                            "24h": 0,
-                            "48h": 0,
-                            "5d": 0,
-                            "7d": 0,
-                            "30d": 0
-                        }
-                    
-                    fronting_times[member_id]["total_seconds"] += duration_seconds
-                    
-                    # Check which timeframes this duration falls into
-                    time_ago = (now - prev_time).total_seconds()
-                    
-                    if time_ago <= 24 * 3600:  # 24 hours
-                        fronting_times[member_id]["24h"] += duration_seconds
-                    
-                    if time_ago <= 48 * 3600:  # 48 hours
-                        fronting_times[member_id]["48h"] += duration_seconds
-                    
-                    if time_ago <= 5 * 24 * 3600:  # 5 days
-                        fronting_times[member_id]["5d"] += duration_seconds
-                    
-                    if time_ago <= 7 * 24 * 3600:  # 7 days
-                        fronting_times[member_id]["7d"] += duration_seconds
-                    
-                    if time_ago <= 30 * 24 * 3600:  # 30 days
-                        fronting_times[member_id]["30d"] += duration_seconds
-            except Exception as e:
-                print(f"Error processing switch {i}: {str(e)}")
-                print(f"Previous switch timestamp: {prev_switch.get('timestamp', 'unknown')}")
-                print(f"Current switch timestamp: {curr_switch.get('timestamp', 'unknown')}")
-                print(traceback.format_exc())
-                continue
+        total_time_seconds, member_times = fronting
         
         # Format the result
         result = {
@@ -219,7 +100,7 @@ async def get_fronting_time_metrics(days: int = 30) -> Dict[str, Any]:
             }
         }
         
-        for member_id, times in fronting_times.items():
+        for member_id, total_seconds, times in member_times:
             # Get member name and other details
             name = member_id
             display_name = member_id
@@ -231,7 +112,7 @@ async def get_fronting_time_metrics(days: int = 30) -> Dict[str, Any]:
                 avatar_url = member_details[member_id]["avatar_url"]
             
             # Calculate percentages
-            total_percent = (times["total_seconds"] / total_time_seconds) * 100 if total_time_seconds > 0 else 0
+            total_percent = (total_seconds / total_time_seconds) * 100 if total_time_seconds > 0 else 0
             
             # Add to result
             result["members"][member_id] = {
@@ -239,7 +120,7 @@ async def get_fronting_time_metrics(days: int = 30) -> Dict[str, Any]:
                 "name": name,
                 "display_name": display_name,
                 "avatar_url": avatar_url,
-                "total_seconds": times["total_seconds"],
+                "total_seconds": total_seconds,
                 "total_percent": total_percent,
                 "24h": times["24h"],
                 "48h": times["48h"],
@@ -273,62 +154,141 @@ async def get_fronting_time_metrics(days: int = 30) -> Dict[str, Any]:
             }
         }
 
+async def get_fronting_range_metrics(start: datetime, end: datetime) -> Dict[str, Any]:
+    """
+    Fronting time of each member between two moments, with time before
+    start and after end cut off. The end is capped at the current time.
+    """
+    result = {
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "total_time": 0,
+        "members": {}
+    }
+    try:
+        switches = await get_switches()  # The complete switch history
+        now = datetime.now(timezone.utc)
+        member_details = await get_member_details()
+        
+        total_time_seconds, member_times = get_timeline(switches).fronting_between(
+            to_epoch_us(start), to_epoch_us(end), to_epoch_us(now)
+        )
+        result["total_time"] = total_time_seconds
+        
+        for member_id, seconds in member_times:
+            details = member_details.get(member_id, {})
+            result["members"][member_id] = {
+                "id": member_id,
+                "name": details.get("name", member_id),
+                "display_name": details.get("display_name", member_id),
+                "avatar_url": details.get("avatar_url"),
+                "total_seconds": seconds,
+                "total_percent": (seconds / total_time_seconds) * 100 if total_time_seconds > 0 else 0
+            }
+        
+        return result
+    except Exception as e:
+        print(f"Error in get_fronting_range_metrics: {str(e)}")
+        print(traceback.format_exc())
+        # Return a basic structure so the frontend doesn't crash
+        return result
+
+async def get_fronting_timeline_metrics(
+    start: datetime, end: datetime, resolution: str, tz: ZoneInfo, heatmap: bool = False
+) -> Dict[str, Any]:
+    """
+    Fronting time of each member per local hour or day of tz, for every
+    bucket overlapping start..end, read from the rollups (see
+    metrics_rollups.py). With heatmap, also the time by weekday and hour
+    of day. from and to are widened to the edges of the buckets returned.
+    """
+    result = {
+        "resolution": resolution,
+        "timezone": tz.key,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "members": {},
+        "buckets": []
+    }
+    if heatmap:
+        result["heatmap"] = {}
+    try:
+        switches = await get_switches()  # The complete switch history
+        now_us = to_epoch_us(datetime.now(timezone.utc))
+        member_details = await get_member_details()
+        
+        timeline = get_timeline(switches)
+        rollups = get_rollups(timeline, tz)
+        if rollups is None:
+            raise ValueError(f"No rollups kept for time zone {tz.key}")
+        start_us, end_us = to_epoch_us(start), to_epoch_us(end)
+        series = rollups.series(resolution, start_us, end_us, now_us)
+        if series:
+            result["from"] = local_isoformat(series[0][0], tz)
+            result["to"] = local_isoformat(series[-1][1], tz)
+        
+        totals: Dict[int, int] = {}
+        for bucket_start, bucket_end, fronted in series:
+            result["buckets"].append({
+                "start": local_isoformat(bucket_start, tz),
+                "end": local_isoformat(bucket_end, tz),
+                "members": {timeline.member_ids[code]: microseconds / 1e6 for code, microseconds in fronted.items()}
+            })
+            for code, microseconds in fronted.items():
+                totals[code] = totals.get(code, 0) + microseconds
+        
+        for code, microseconds in sorted(totals.items(), key=lambda item: -item[1]):
+            member_id = timeline.member_ids[code]
+            details = member_details.get(member_id, {})
+            result["members"][member_id] = {
+                "id": member_id,
+                "name": details.get("name", member_id),
+                "display_name": details.get("display_name", member_id),
+                "avatar_url": details.get("avatar_url"),
+                "total_seconds": microseconds / 1e6
+            }
+        
+        if heatmap and series:
+            # Over the same whole buckets as the series, even when that is daily
+            grids = rollups.heatmap(series[0][0], series[-1][1], now_us)
+            for code, grid in grids.items():
+                result["heatmap"][timeline.member_ids[code]] = [
+                    [microseconds / 1e6 for microseconds in hours] for hours in grid
+                ]
+        
+        return result
+    except Exception as e:
+        print(f"Error in get_fronting_timeline_metrics: {str(e)}")
+        print(traceback.format_exc())
+        # Return a basic structure so the frontend doesn't crash
+        return result
+
 async def get_switch_frequency_metrics(days: int = 30) -> Dict[str, Any]:
     """Calculate switch frequency metrics"""
     try:
         # Get all switches for the specified period
-        switches = await get_switches(1000)  # Get a large number of switches
+        switches = await get_switches()  # The complete switch history
         
         # Get current time and calculate the cutoff time
         now = datetime.now(timezone.utc)
         cutoff_time = now - timedelta(days=days)
         
-        # Filter switches to only include those within the specified period
-        filtered_switches = []
-        for switch in switches:
-            try:
-                timestamp = parse_timestamp(switch["timestamp"])
-                if timestamp >= cutoff_time:
-                    filtered_switches.append({
-                        **switch,
-                        "_parsed_timestamp": timestamp
-                    })
-            except Exception as e:
-                print(f"Error parsing timestamp in switch_frequency: {str(e)}")
-                continue
-        
-        # Calculate metrics
-        total_switches = len(filtered_switches)
+        # Count the switches in the period and in each shorter timeframe
+        timeline = get_timeline(switches)
+        running = get_running_metrics(timeline, days, to_epoch_us(now))
+        if running:
+            total_switches, counts = running.switch_counts(to_epoch_us(now))
+        else:
+            total_switches, counts = timeline.switch_counts(to_epoch_us(cutoff_time), to_epoch_us(now), TIMEFRAMES)
         
-        # Calculate switches per day for the last specified days
         timeframes = {
-            "24h": 0,
-            "48h": 0,
-            "5d": 0,
-            "7d": 0,
+            "24h": counts["24h"],
+            "48h": counts["48h"],
+            "5d": counts["5d"],
+            "7d": counts["7d"],
             "30d": total_switches
         }
         
-        for switch in filtered_switches:
-            try:
-                timestamp = switch["_parsed_timestamp"]
-                time_ago = (now - timestamp).total_seconds()
-                
-                if time_ago <= 24 * 3600:  # 24 hours
-                    timeframes["24h"] += 1
-                
-                if time_ago <= 48 * 3600:  # 48 hours
-                    timeframes["48h"] += 1
-                
-                if time_ago <= 5 * 24 * 3600:  # 5 days
-                    timeframes["5d"] += 1
-                
-                if time_ago <= 7 * 24 * 3600:  # 7 days
-                    timeframes["7d"] += 1
-            except Exception as e:
-                print(f"Error calculating timeframes: {str(e)}")
-                continue
-        
         # Calculate average switches per day
         avg_switches_per_day = total_switches / days if days > 0 else 0
         
@@ -0,0 +1,221 @@
+import os
+from collections import Counter, OrderedDict, defaultdict, deque
+from typing import Any, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+from fronting_engine import TIMEFRAMES, FrontingTimeline, round_seconds
+
+load_dotenv()
+
+# Running aggregates are kept for this many different `days` periods, the
+# least recently used one making way when another period is asked for
+METRICS_MAX_PERIODS = int(os.getenv("METRICS_MAX_PERIODS", 4))
+# How often switches that have left a window are aged out in the background.
+# Reads age them out too, this just keeps the work off the request.
+METRICS_EXPIRE_INTERVAL = float(os.getenv("METRICS_EXPIRE_INTERVAL", 60))
+
+PERIOD = "period"
+
+
+class RunningMetrics:
+    """
+    Fronting time per member and switch counts over windows ending now:
+    the fixed TIMEFRAMES plus the period of `days` a request asks for.
+
+    As the metrics have always counted it, an interval belongs to a window
+    when its switch was made inside it, and then counts in full. When a
+    switch arrives, the interval it ends is added to every window holding
+    it, in O(members); when a switch ages out of a window its interval is
+    subtracted again. The still-open interval of the latest switch is added
+    when reading. Times are integer microseconds so this stays exact.
+
+    Only switches inside the period are held: older ones no longer count
+    anywhere, and an interval starting outside every window never will.
+
+    Totals are exact integer microseconds, converted to seconds once when
+    read and rounded like the timeline engine rounds its float sums, so
+    either one gives the same values for the same query.
+    """
+
+    def __init__(self, days: int):
+        self.days = days
+        period = days * 24 * 3600
+        # Only switches inside the period have ever counted, so no window is longer
+        self.windows = {**{name: min(seconds, period) for name, seconds in TIMEFRAMES.items()}, PERIOD: period}
+        self.longest_us = max(self.windows.values()) * 1_000_000
+        self.starts: List[int] = []
+        self.members: List[List[int]] = []
+        # starts[i] is switch number base + i of those ever appended
+        self.base = 0
+        # Numbers of the switches inside the period each member fronts in,
+        # oldest first, so the first one is where it first appears
+        self.appearances: Dict[int, deque] = {}
+        # Position in starts of the oldest switch still inside each window
+        self.first = {name: 0 for name in self.windows}
+        # Closed intervals inside each window: microseconds and count per member, and their total
+        self.sums = {name: defaultdict(int) for name in self.windows}
+        self.hits = {name: defaultdict(int) for name in self.windows}
+        self.closed_us = {name: 0 for name in self.windows}
+
+    @classmethod
+    def from_timeline(cls, timeline: FrontingTimeline, days: int, now_us: int) -> "RunningMetrics":
+        running = cls(days)
+        first = timeline.first_since(now_us - running.longest_us)
+        for i in range(first, len(timeline)):
+            codes = timeline.codes[timeline.offsets[i]:timeline.offsets[i + 1]].tolist()
+            running.append(int(timeline.starts[i]), codes)
+        running.expire(now_us)
+        return running
+
+    def _add_closed(self, i: int, sign: int):
+        """Add (or with sign -1 remove) the closed interval of switch i to the windows holding it"""
+        duration = self.starts[i + 1] - self.starts[i]
+        for name, first in self.first.items():
+            if first > i:
+                continue
+            sums, hits = self.sums[name], self.hits[name]
+            for code in self.members[i]:
+                sums[code] += sign * duration
+                hits[code] += sign
+            self.closed_us[name] += sign * duration
+
+    def _appear(self, i: int):
+        for code in self.members[i]:
+            self.appearances.setdefault(code, deque()).append(self.base + i)
+
+    def _disappear(self, i: int, newest: bool):
+        for code in self.members[i]:
+            appearances = self.appearances[code]
+            appearances.pop() if newest else appearances.popleft()
+            if not appearances:
+                del self.appearances[code]
+
+    def append(self, start_us: int, codes: List[int]):
+        """A new latest switch, closing the interval of the one before it"""
+        self.starts.append(start_us)
+        self.members.append(list(codes))
+        self._appear(len(self.starts) - 1)
+        if len(self.starts) > 1:
+            self._add_closed(len(self.starts) - 2, 1)
+
+    def truncate(self, at_us: int):
+        """Drop the switches made at or after at_us, reopening the one before them"""
+        while self.starts and self.starts[-1] >= at_us:
+            if len(self.starts) > 1:
+                self._add_closed(len(self.starts) - 2, -1)
+            if len(self.starts) - 1 >= self.first[PERIOD]:
+                self._disappear(len(self.starts) - 1, newest=True)
+            self.starts.pop()
+            self.members.pop()
+        for name in self.first:
+            self.first[name] = min(self.first[name], len(self.starts))
+
+    def expire(self, now_us: int):
+        """Subtract the intervals of switches that are now older than each window"""
+        last = len(self.starts) - 1
+        for name, seconds in self.windows.items():
+            cutoff = now_us - seconds * 1_000_000
+            first = self.first[name]
+            sums, hits = self.sums[name], self.hits[name]
+            while first <= last and self.starts[first] < cutoff:
+                if first < last:
+                    duration = self.starts[first + 1] - self.starts[first]
+                    for code in self.members[first]:
+                        sums[code] -= duration
+                        hits[code] -= 1
+                    self.closed_us[name] -= duration
+                if name == PERIOD:
+                    self._disappear(first, newest=False)
+                first += 1
+            self.first[name] = first
+
+        # Forget switches that have left every window
+        drop = min(self.first.values())
+        if drop > 64 and drop * 2 > len(self.starts):
+            del self.starts[:drop]
+            del self.members[:drop]
+            self.base += drop
+            for name in self.first:
+                self.first[name] -= drop
+
+    def _open_interval(self, name: str, now_us: int) -> Tuple[int, Counter]:
+        """Microseconds and members of the latest switch's interval, if it is inside the window"""
+        last = len(self.starts) - 1
+        if last < 0 or self.first[name] > last:
+            return 0, Counter()
+        return now_us - self.starts[last], Counter(self.members[last])
+
+    def fronting_seconds(
+        self, now_us: int, member_ids: List[str]
+    ) -> Optional[Tuple[float, List[Tuple[str, float, Dict[str, Any]]]]]:
+        """
+        The metrics FrontingTimeline.fronting_seconds() gives for the period,
+        read from the running totals, with members in the same order: the
+        order they first fronted within the period. None if no switch was
+        made in the period.
+        """
+        self.expire(now_us)
+        if self.first[PERIOD] >= len(self.starts):
+            return None
+
+        open_intervals = {name: self._open_interval(name, now_us) for name in self.windows}
+
+        def value(name: str, code: int):
+            open_us, open_members = open_intervals[name]
+            if self.hits[name][code] <= 0 and code not in open_members:
+                return 0
+            return round_seconds((self.sums[name][code] + open_us * open_members[code]) / 1e6)
+
+        # By the switch each member first appears in, then its place in that switch
+        first_seen = []
+        for code, appearances in self.appearances.items():
+            members_of_switch = self.members[appearances[0] - self.base]
+            first_seen.append((appearances[0], members_of_switch.index(code), code))
+        members = []
+        for _, _, code in sorted(first_seen):
+            windows = {name: value(name, code) for name in TIMEFRAMES}
+            members.append((member_ids[code], value(PERIOD, code), windows))
+
+        return round_seconds((self.closed_us[PERIOD] + open_intervals[PERIOD][0]) / 1e6), members
+
+    def switch_counts(self, now_us: int) -> Tuple[int, Dict[str, int]]:
+        """Switches made in the period, and within each of the TIMEFRAMES"""
+        self.expire(now_us)
+        counts = {name: len(self.starts) - self.first[name] for name in self.windows}
+        return counts.pop(PERIOD), counts
+
+
+# days -> running metrics, least recently used first
+_running: "OrderedDict[int, RunningMetrics]" = OrderedDict()
+# The timeline, and its generation, the running metrics are following
+_following: Optional[Tuple[FrontingTimeline, int]] = None
+
+
+def get_running_metrics(timeline: FrontingTimeline, days: int, now_us: int) -> Optional[RunningMetrics]:
+    """
+    Running metrics for a period of `days`, following the timeline from now
+    on. Once METRICS_MAX_PERIODS periods are kept, the least recently used
+    one stops following the timeline to make room.
+    """
+    global _following
+    if _following is None or _following[0] is not timeline or _following[1] != timeline.generation:
+        # Rebuilt from scratch, so the old aggregates no longer follow it
+        _running.clear()
+        _following = (timeline, timeline.generation)
+
+    running = _running.get(days)
+    if running is not None:
+        _running.move_to_end(days)
+        return running
+    if days <= 0 or METRICS_MAX_PERIODS <= 0:
+        return None
+    while len(_running) >= METRICS_MAX_PERIODS:
+        _, evicted = _running.popitem(last=False)
+        timeline.followers.remove(evicted)
+    running = _running[days] = RunningMetrics.from_timeline(timeline, days, now_us)
+    timeline.followers.append(running)
+    return running
+
+
+def expire_running_metrics(now_us: int):
+    for running in list(_running.values()):
+        running.expire(now_us)
@@ -0,0 +1,341 @@
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+import numpy as np
+from dotenv import load_dotenv
+from fronting_engine import FrontingTimeline
+from switch_store import EPOCH, to_epoch_us
+
+load_dotenv()
+
+# Time zone the hours and days of the timeline follow when a request doesn't name one
+METRICS_TIMEZONE = os.getenv("METRICS_TIMEZONE", "UTC")
+# Rollups are kept up to date for this many time zones, METRICS_TIMEZONE
+# included; requests for any other are refused, as each would rebuild them
+METRICS_MAX_TIMEZONES = int(os.getenv("METRICS_MAX_TIMEZONES", 4))
+# Most buckets /api/metrics/timeline returns at once
+METRICS_TIMELINE_MAX_BUCKETS = int(os.getenv("METRICS_TIMELINE_MAX_BUCKETS", 5000))
+
+HOUR = "hour"
+DAY = "day"
+# Bucket lengths, as they are away from DST changes
+RESOLUTIONS = {HOUR: timedelta(hours=1), DAY: timedelta(days=1)}
+
+ONE_HOUR_US = 3600 * 1_000_000
+ONE_DAY = timedelta(days=1)
+# (weekday, hour) of the hours of a day without a DST change, by weekday
+DAY_LABELS = [[(weekday, hour) for hour in range(24)] for weekday in range(7)]
+
+
+def _local(t_us: int, tz: ZoneInfo) -> datetime:
+    return (EPOCH + timedelta(microseconds=t_us)).astimezone(tz)
+
+
+def local_isoformat(t_us: int, tz: ZoneInfo) -> str:
+    return _local(t_us, tz).isoformat()
+
+
+class LocalBuckets:
+    """
+    Where the local hours and days of a time zone begin, in epoch
+    microseconds, for the dates covered so far. A bucket ends where the
+    local hour or date changes, so around a DST change a day has 23 or 25
+    hourly buckets and the hours keep their wall-clock labels.
+    """
+
+    def __init__(self, tz: ZoneInfo):
+        self.tz = tz
+        # Bucket starts, plus where the last covered date ends
+        self.starts: Dict[str, List[int]] = {HOUR: [], DAY: []}
+        # Local (weekday, hour) of each hourly bucket, Monday being 0
+        self.hour_labels: List[Tuple[int, int]] = []
+        self.first_date: Optional[date] = None
+        self.last_date: Optional[date] = None
+
+    def _day_start(self, day: date) -> int:
+        # fold=0 takes the offset from before a DST change, so a skipped
+        # midnight resolves to the moment the day actually begins
+        return to_epoch_us(datetime(day.year, day.month, day.day, tzinfo=self.tz))
+
+    def _hour_key(self, t_us: int) -> Tuple[date, int]:
+        local = _local(t_us, self.tz)
+        return local.date(), local.hour
+
+    def _hours(self, day: date, start: int, end: int) -> Tuple[List[int], List[Tuple[int, int]]]:
+        weekday = day.weekday()
+        if end - start == 24 * ONE_HOUR_US and _local(start, self.tz).utcoffset() == _local(end - 1, self.tz).utcoffset():
+            return list(range(start, end, ONE_HOUR_US)), DAY_LABELS[weekday]
+
+        # The offset changes during the day: try each hour under both
+        # offsets, and the change itself (which can fall mid-hour, as on
+        # the Chatham Islands), keeping the moments the local hour changes
+        found = {start}
+        before, after = start, end - 1
+        offset = _local(start, self.tz).utcoffset()
+        while after - before > 1:
+            middle = (before + after) // 2
+            if _local(middle, self.tz).utcoffset() == offset:
+                before = middle
+            else:
+                after = middle
+        if self._hour_key(after) != self._hour_key(after - 1):
+            found.add(after)
+        for hour in range(24):
+            for fold in (0, 1):
+                t = to_epoch_us(datetime(day.year, day.month, day.day, hour, fold=fold, tzinfo=self.tz))
+                if start < t < end and self._hour_key(t) != self._hour_key(t - 1):
+                    found.add(t)
+        hours = sorted(found)
+        return hours, [(weekday, _local(t, self.tz).hour) for t in hours]
+
+    def _dates(self, first: date, last: date) -> Tuple[List[int], List[int], List[Tuple[int, int]], int]:
+        """Day starts, hour starts and hour labels of first..last, and where last ends"""
+        days, hours, labels = [], [], []
+        day, start = first, self._day_start(first)
+        while day <= last:
+            end = self._day_start(day + ONE_DAY)
+            # Skipped when a zone moves across the date line (Samoa lost 30 December 2011)
+            if end > start:
+                day_hours, day_labels = self._hours(day, start, end)
+                days.append(start)
+                hours.extend(day_hours)
+                labels.extend(day_labels)
+            day, start = day + ONE_DAY, end
+        return days, hours, labels, start
+
+    def cover(self, from_us: int, to_us: int):
+        """Make sure there are buckets from from_us up to to_us"""
+        day_starts = self.starts[DAY]
+        if day_starts and day_starts[0] <= from_us and to_us <= day_starts[-1]:
+            return
+
+        first = _local(from_us, self.tz).date()
+        last = _local(to_us, self.tz).date()
+        if self.first_date is None:
+            days, hours, labels, end = self._dates(first, last)
+            self.starts = {HOUR: hours + [end], DAY: days + [end]}
+            self.hour_labels = labels
+            self.first_date, self.last_date = first, last
+            return
+
+        if first < self.first_date:
+            # The new dates end where the covered ones begin
+            days, hours, labels, _ = self._dates(first, self.first_date - ONE_DAY)
+            self.starts[DAY][:0] = days
+            self.starts[HOUR][:0] = hours
+            self.hour_labels[:0] = labels
+            self.first_date = first
+        if last > self.last_date:
+            days, hours, labels, end = self._dates(self.last_date + ONE_DAY, last)
+            for resolution, added in ((DAY, days), (HOUR, hours)):
+                # The old end is where the new dates begin
+                self.starts[resolution][-1:] = added + [end]
+            self.hour_labels.extend(labels)
+            self.last_date = last
+
+    def index_of(self, resolution: str, t_us: int) -> int:
+        """Index of the bucket holding t_us"""
+        return bisect_right(self.starts[resolution], t_us) - 1
+
+    def split(self, resolution: str, start_us: int, end_us: int) -> Iterator[Tuple[int, int]]:
+        """(bucket start, microseconds) of each part of [start_us, end_us), which must be covered"""
+        starts = self.starts[resolution]
+        i = bisect_right(starts, start_us) - 1
+        while start_us < end_us:
+            part_end = min(end_us, starts[i + 1])
+            yield starts[i], part_end - start_us
+            start_us = part_end
+            i += 1
+
+
+class FrontingRollups:
+    """
+    Microseconds each member fronted in every local hour and day of a time
+    zone, over the whole history. Intervals are split where they cross
+    into the next bucket, and each part is credited to the members of the
+    switch; unlike the windowed metrics, only the time inside the bucket
+    counts. Like the running metrics this follows a FrontingTimeline, so a
+    new switch only adds the interval it closes, and the still-open
+    interval of the latest switch is added when reading.
+
+    Per resolution the parts are kept like the timeline keeps switches, in
+    order, as columns:
+
+        bucket        start of the bucket
+        code          the member
+        fronted       microseconds
+
+    with interval_offsets[i] the first part of the interval switch i closed,
+    so dropping the newest switches pops the parts at the end. A bucket
+    and member can have several parts, which are added up when reading.
+    """
+
+    def __init__(self, tz: ZoneInfo):
+        self.tz = tz
+        self.buckets = LocalBuckets(tz)
+        self.starts: List[int] = []
+        self.members: List[List[int]] = []
+        self.parts = {resolution: (array("q"), array("i"), array("q")) for resolution in RESOLUTIONS}
+        self.interval_offsets = {resolution: array("q") for resolution in RESOLUTIONS}
+
+    @classmethod
+    def from_timeline(cls, timeline: FrontingTimeline, tz: ZoneInfo) -> "FrontingRollups":
+        rollups = cls(tz)
+        if not len(timeline):
+            return rollups
+        starts, offsets, codes = timeline.starts, timeline.offsets, timeline.codes
+        rollups.buckets.cover(int(starts[0]), int(starts[-1]))
+        rollups.starts = starts.tolist()
+        rollups.members = [codes[offsets[i]:offsets[i + 1]].tolist() for i in range(len(starts))]
+
+        # Every closed interval split into its parts at once, in the order append() would add them
+        interval_starts, interval_ends = starts[:-1], starts[1:]
+        member_counts = np.diff(offsets)[:-1]
+        for resolution in RESOLUTIONS:
+            bucket_starts = np.array(rollups.buckets.starts[resolution], dtype=np.int64)
+            first = np.searchsorted(bucket_starts, interval_starts, side="right") - 1
+            last = np.searchsorted(bucket_starts, interval_ends, side="left") - 1
+            spans = np.where(member_counts > 0, np.maximum(last - first + 1, 0), 0)
+            spans[interval_ends <= interval_starts] = 0
+
+            interval = np.repeat(np.arange(len(spans)), spans)
+            span_offsets = np.cumsum(spans) - spans
+            bucket = first[interval] + np.arange(len(interval)) - span_offsets[interval]
+            fronted = (np.minimum(interval_ends[interval], bucket_starts[bucket + 1])
+                       - np.maximum(interval_starts[interval], bucket_starts[bucket]))
+
+            # And each part once per member of the switch
+            per_part = member_counts[interval]
+            part = np.repeat(np.arange(len(interval)), per_part)
+            part_offsets = np.cumsum(per_part) - per_part
+            member = offsets[interval][part] + np.arange(len(part)) - part_offsets[part]
+
+            bucket_column, code_column, fronted_column = rollups.parts[resolution]
+            bucket_column.frombytes(bucket_starts[bucket][part].tobytes())
+            code_column.frombytes(codes[member].astype(np.int32).tobytes())
+            fronted_column.frombytes(fronted[part].tobytes())
+            interval_parts = np.zeros(len(spans) + 1, dtype=np.int64)
+            np.cumsum(spans * member_counts, out=interval_parts[1:])
+            rollups.interval_offsets[resolution].frombytes(interval_parts[:-1].tobytes())
+        return rollups
+
+    def append(self, start_us: int, codes: List[int]):
+        """A new latest switch, closing the interval of the one before it"""
+        if self.starts:
+            previous, members = self.starts[-1], self.members[-1]
+            self.buckets.cover(previous, start_us)
+            for resolution, (bucket_column, code_column, fronted_column) in self.parts.items():
+                self.interval_offsets[resolution].append(len(bucket_column))
+                if not members:
+                    continue
+                for bucket_start, microseconds in self.buckets.split(resolution, previous, start_us):
+                    for code in members:
+                        bucket_column.append(bucket_start)
+                        code_column.append(code)
+                        fronted_column.append(microseconds)
+        self.starts.append(start_us)
+        self.members.append(list(codes))
+
+    def truncate(self, at_us: int):
+        """Drop the switches made at or after at_us, reopening the one before them"""
+        while self.starts and self.starts[-1] >= at_us:
+            self.starts.pop()
+            self.members.pop()
+            if self.starts:
+                for resolution, columns in self.parts.items():
+                    first_part = self.interval_offsets[resolution].pop()
+                    for column in columns:
+                        del column[first_part:]
+
+    def _read(self, resolution: str, from_us: int, to_us: int, now_us: int) -> Iterator[Tuple[int, int, int, Dict[int, int]]]:
+        """
+        (index, start, end, {member code: microseconds}) of every bucket
+        overlapping [from_us, to_us), counting the latest switch up to now_us
+        """
+        to_us = min(to_us, now_us)
+        if not self.starts or to_us <= from_us:
+            return
+        # Nothing fronted before the first switch
+        from_us = max(from_us, self.starts[0])
+        if to_us <= from_us:
+            return
+        self.buckets.cover(from_us, to_us)
+
+        starts = self.buckets.starts[resolution]
+        first, last = self.buckets.index_of(resolution, from_us), bisect_left(starts, to_us)
+
+        bucket_column, code_column, fronted_column = self.parts[resolution]
+        lo, hi = bisect_left(bucket_column, starts[first]), bisect_left(bucket_column, starts[last])
+        fronted: Dict[int, Dict[int, int]] = {}
+        for bucket_start, code, microseconds in zip(bucket_column[lo:hi], code_column[lo:hi], fronted_column[lo:hi]):
+            values = fronted.setdefault(bucket_start, {})
+            values[code] = values.get(code, 0) + microseconds
+
+        # The latest switch counts up to now in each whole bucket, like the closed ones
+        open_from = max(self.starts[-1], starts[first])
+        open_to = min(now_us, starts[last])
+        if self.members[-1] and open_from < open_to:
+            for bucket_start, microseconds in self.buckets.split(resolution, open_from, open_to):
+                values = fronted.setdefault(bucket_start, {})
+                for code in self.members[-1]:
+                    values[code] = values.get(code, 0) + microseconds
+
+        for i in range(first, last):
+            yield i, starts[i], starts[i + 1], fronted.get(starts[i], {})
+
+    def series(self, resolution: str, from_us: int, to_us: int, now_us: int) -> List[Tuple[int, int, Dict[int, int]]]:
+        """(start, end, {member code: microseconds}) of every bucket overlapping the range, empty ones included"""
+        return [(start, end, values) for _, start, end, values in self._read(resolution, from_us, to_us, now_us)]
+
+    def heatmap(self, from_us: int, to_us: int, now_us: int) -> Dict[int, List[List[int]]]:
+        """Microseconds each member fronted by local weekday (Monday first) and hour of day, over the range"""
+        grids: Dict[int, List[List[int]]] = {}
+        labels = self.buckets.hour_labels
+        for i, _, _, values in self._read(HOUR, from_us, to_us, now_us):
+            weekday, hour = labels[i]
+            for code, microseconds in values.items():
+                grid = grids.get(code)
+                if grid is None:
+                    grid = grids[code] = [[0] * 24 for _ in range(7)]
+                grid[weekday][hour] += microseconds
+        return grids
+
+
+_rollups: Dict[str, FrontingRollups] = {}
+# The timeline, and its generation, the rollups are following
+_following: Optional[Tuple[FrontingTimeline, int]] = None
+
+
+def has_rollups(tz: ZoneInfo) -> bool:
+    """
+    Whether rollups are or can be kept for a time zone. One place is held
+    for METRICS_TIMEZONE, so other zones can't crowd it out.
+    """
+    if tz.key == METRICS_TIMEZONE or tz.key in _rollups:
+        return True
+    reserved = 0 if METRICS_TIMEZONE in _rollups else 1
+    return len(_rollups) + reserved < METRICS_MAX_TIMEZONES
+
+
+def get_rollups(timeline: FrontingTimeline, tz: ZoneInfo) -> Optional[FrontingRollups]:
+    """
+    Rollups of the timeline in a time zone, following the timeline from
+    the first time they are asked for. None for a zone has_rollups()
+    refuses.
+    """
+    global _following
+    if _following is None or _following[0] is not timeline or _following[1] != timeline.generation:
+        # Rebuilt from scratch, so the old rollups no longer follow it
+        _rollups.clear()
+        _following = (timeline, timeline.generation)
+
+    rollups = _rollups.get(tz.key)
+    if rollups is None:
+        if not has_rollups(tz):
+            return None
+        rollups = _rollups[tz.key] = FrontingRollups.from_timeline(timeline, tz)
+        timeline.followers.append(rollups)
+    return rollups
@@ -0,0 +1,111 @@
+"""
+Benchmark of the switch ingestion path and the metrics built on it, on a
+generated history (100k switches by default).
+
+    python perf/bench_ingest.py --switches 100000 --repeat 5
+
+Stages:
+    parse strings       parse_timestamp on every switch, which each metrics
+                        request used to do
+    ingest              normalize_switch, run once per switch when PluralKit
+                        returns it (adds timestamp_us)
+    store write / read  the gzip file the switch store keeps, as at shutdown
+                        and on a warm start
+    timeline build      FrontingTimeline from the stored integers
+    timeline update     one new switch applied in place
+    fronting 30d        vectorized metrics over the whole timeline
+    running read        fronting metrics read from the running aggregates
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, List
+
+# Run from the backend directory or from perf/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fake_pluralkit import FakeSystem  # noqa: E402
+from fronting_engine import TIMEFRAMES, FrontingTimeline  # noqa: E402
+from metrics_aggregator import RunningMetrics  # noqa: E402
+from switch_store import SwitchStore, normalize_switch, parse_timestamp, to_epoch_us  # noqa: E402
+
+
+def best_of(repeat: int, run: Callable[[], object]) -> float:
+    """Fastest of `repeat` runs, in milliseconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark switch ingestion and metrics")
+    parser.add_argument("--switches", type=int, default=100_000)
+    parser.add_argument("--members", type=int, default=150)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    raw = FakeSystem(args.members, args.switches, seed=1).switches
+    now_us = to_epoch_us(datetime.now(timezone.utc))
+    results = []
+
+    results.append(("parse strings", best_of(
+        args.repeat, lambda: [to_epoch_us(parse_timestamp(s["timestamp"])) for s in raw]
+    )))
+    results.append(("ingest", best_of(args.repeat, lambda: [normalize_switch(s) for s in raw])))
+    switches = [normalize_switch(s) for s in raw]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SwitchStore(Path(tmp) / "switches.json.gz")
+        store.switches, store.backfilled, store._loaded = switches, True, True
+        results.append(("store write", best_of(args.repeat, store._save)))
+
+        def load():
+            reloaded = SwitchStore(store.path)
+            reloaded.ensure_loaded()
+            assert len(reloaded.switches) == len(switches)
+        results.append(("store read", best_of(args.repeat, load)))
+        size = os.path.getsize(store.path)
+
+    results.append(("timeline build", best_of(args.repeat, lambda: FrontingTimeline(switches))))
+
+    timeline = FrontingTimeline(switches)
+    newest = switches[0]
+    extra = normalize_switch({
+        "id": "bench",
+        "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        "members": newest["members"][:1],
+    })
+    histories = iter([[extra] + switches if i % 2 == 0 else switches for i in range(args.repeat)])
+
+    def update():
+        # Alternates adding and removing the switch, both in place
+        assert timeline.update(next(histories))
+    results.append(("timeline update", best_of(args.repeat, update)))
+
+    cutoff_us = now_us - 30 * 24 * 3600 * 1_000_000
+    results.append(("fronting 30d", best_of(
+        args.repeat, lambda: timeline.fronting_seconds(cutoff_us, now_us, TIMEFRAMES)
+    )))
+
+    running = RunningMetrics.from_timeline(timeline, 30, now_us)
+    results.append(("running read", best_of(
+        args.repeat, lambda: running.fronting_seconds(now_us, timeline.member_ids)
+    )))
+
+    print(f"{len(switches)} switches, {args.members} members, best of {args.repeat}, "
+          f"store file {size / 1024:.0f} KiB")
+    print(f"{'stage':<18} {'ms':>10} {'us/switch':>11}")
+    for name, ms in results:
+        print(f"{name:<18} {ms:>10.2f} {ms * 1000 / len(switches):>11.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Multi-worker consistency check: a member tag or status written through one
+uvicorn worker must show up in /api/members and /api/fronters from every
+worker, straight away.
+
+Run the backend with several workers and the default per-process cache,
+against perf/fake_pluralkit.py:
+
+    python perf/fake_pluralkit.py &
+    PLURALKIT_BASE_URL=http://127.0.0.1:8100/v2 SYSTEM_TOKEN=fake CACHE_BACKEND=memory \\
+        uvicorn main:app --port 8000 --workers 4 &
+    python perf/check_workers.py --username admin --password ...
+
+Each read uses a new connection so the kernel spreads them over the workers,
+and every worker has built its snapshots before the write is made. The exit
+status is non-zero if any read still returns the data from before a write.
+"""
+import argparse
+import asyncio
+import sys
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+
+def fresh_client(base_url: str, timeout: float) -> httpx.AsyncClient:
+    # No keep-alive, so each request is accepted by whichever worker is free
+    limits = httpx.Limits(max_keepalive_connections=0)
+    return httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits)
+
+
+async def read_all(base_url: str, path: str, reads: int, timeout: float) -> List[Any]:
+    async with fresh_client(base_url, timeout) as client:
+        responses = await asyncio.gather(*(client.get(path) for _ in range(reads)))
+    for resp in responses:
+        resp.raise_for_status()
+    return [resp.json() for resp in responses]
+
+
+def find_member(payload: Any, member_id: str) -> Optional[Dict[str, Any]]:
+    members = payload.get("members", []) if isinstance(payload, dict) else payload
+    return next((m for m in members if m.get("id") == member_id), None)
+
+
+async def check(base_url: str, paths: List[str], member_id: str, reads: int, timeout: float,
+                description: str, expected: Callable[[Dict[str, Any]], bool]) -> List[str]:
+    failures = []
+    for path in paths:
+        stale = 0
+        for payload in await read_all(base_url, path, reads, timeout):
+            member = find_member(payload, member_id)
+            if member is not None and not expected(member):
+                stale += 1
+        status = "FAIL" if stale else "ok"
+        print(f"{status:<4} {path}: {description}, {stale}/{reads} stale responses")
+        if stale:
+            failures.append(f"{path}: {description}")
+    return failures
+
+
+async def run(args: argparse.Namespace) -> int:
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout) as client:
+        if args.token:
+            token = args.token
+        else:
+            # The form-encoded login skips Turnstile
+            resp = await client.post("/api/login", data={"username": args.username, "password": args.password})
+            resp.raise_for_status()
+            token = resp.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        fronters = (await client.get("/api/fronters")).json()
+        if not fronters.get("members"):
+            print("No current fronters to check against")
+            return 2
+        member_id = fronters["members"][0]["id"]
+        # Tags are looked up by name before id
+        member_name = fronters["members"][0]["name"]
+        paths = ["/api/members", "/api/fronters"]
+
+        # Let every worker build and keep its snapshots first
+        for path in paths:
+            await read_all(args.base_url, path, args.reads, args.timeout)
+
+        marker = f"check-{uuid.uuid4().hex[:8]}"
+        failures = []
+
+        resp = await client.post(f"/api/members/{member_id}/status", json={"text": marker}, headers=headers)
+        resp.raise_for_status()
+        failures += await check(args.base_url, paths, member_id, args.reads, args.timeout, "status set",
+                                lambda m: (m.get("status") or {}).get("text") == marker)
+
+        resp = await client.delete(f"/api/members/{member_id}/status", headers=headers)
+        resp.raise_for_status()
+        failures += await check(args.base_url, paths, member_id, args.reads, args.timeout, "status cleared",
+                                lambda m: not m.get("status"))
+
+        resp = await client.post(f"/api/member-tags/{member_name}/add", json={"tag": marker}, headers=headers)
+        resp.raise_for_status()
+        failures += await check(args.base_url, paths, member_id, args.reads, args.timeout, "tag added",
+                                lambda m: marker in (m.get("tags") or []))
+
+        resp = await client.delete(f"/api/member-tags/{member_name}/{marker}", headers=headers)
+        resp.raise_for_status()
+        failures += await check(args.base_url, paths, member_id, args.reads, args.timeout, "tag removed",
+                                lambda m: marker not in (m.get("tags") or []))
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Check that writes are visible from every worker")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--reads", type=int, default=40, help="reads per endpoint after each write")
+    parser.add_argument("--timeout", type=float, default=30, help="per request timeout in seconds")
+    parser.add_argument("--username", help="admin login, needed to write tags and statuses")
+    parser.add_argument("--password")
+    parser.add_argument("--token", help="admin JWT to use instead of logging in")
+    args = parser.parse_args(argv)
+    if not args.token and not (args.username and args.password):
+        parser.error("needs --token or --username/--password")
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
@@ -0,0 +1,264 @@
+"""
+Stand-in for the PluralKit v2 API, for developing and load testing the
+backend without a network connection or a real system token.
+
+It serves a generated system with the endpoints the backend uses:
+
+    GET  /v2/systems/@me
+    GET  /v2/systems/@me/members
+    GET  /v2/systems/@me/fronters
+    GET  /v2/systems/@me/switches?limit=&before=
+    POST /v2/systems/@me/switches
+
+plus GET /_fake/stats with a count of the requests it has answered.
+
+Usage (from the backend directory):
+
+    python perf/fake_pluralkit.py --members 150 --switches 20000 --latency-ms 80
+
+then start the backend with PLURALKIT_BASE_URL=http://127.0.0.1:8100/v2 and
+any SYSTEM_TOKEN. The same data is generated for the same --seed.
+"""
+import argparse
+import asyncio
+import random
+import string
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# PluralKit returns at most this many switches per request
+MAX_SWITCH_PAGE = 100
+
+# Members the backend treats specially (see SPECIAL_DISPLAY_NAMES in pluralkit.py)
+SPECIAL_MEMBER_NAMES = ["answer", "system", "sleeping"]
+
+SYLLABLES = ["ka", "ri", "mo", "su", "le", "na", "to", "vi", "el", "ra", "zu", "fi", "an", "co", "dy", "the"]
+COLOURS = ["ff69b4", "a020f0", "00bfff", "7fff00", "ffa500", "dc143c", "40e0d0", "ffd700"]
+
+
+def _timestamp(dt: datetime) -> str:
+    # PluralKit sends microseconds and a Z suffix
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class FakeSystem:
+    """A generated system, its members and its switch history (newest first)"""
+
+    def __init__(self, members: int, switches: int, seed: int, max_cofronters: int = 3):
+        rng = random.Random(seed)
+        now = datetime.now(timezone.utc)
+
+        self.system = {
+            "id": "fakes",
+            "uuid": str(uuid.UUID(int=rng.getrandbits(128))),
+            "name": "Fake System",
+            "description": "Generated by perf/fake_pluralkit.py",
+            "tag": None,
+            "pronouns": None,
+            "avatar_url": None,
+            "banner": None,
+            "color": COLOURS[0],
+            "created": _timestamp(now - timedelta(days=3 * 365)),
+            "privacy": None,
+        }
+
+        self.members: List[Dict[str, Any]] = []
+        used_ids = set()
+        for i in range(members):
+            member_id = self._short_id(rng, used_ids)
+            if i < len(SPECIAL_MEMBER_NAMES):
+                name = SPECIAL_MEMBER_NAMES[i]
+            else:
+                name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize() + f"{i}"
+            self.members.append({
+                "id": member_id,
+                "uuid": str(uuid.UUID(int=rng.getrandbits(128))),
+                "system": self.system["id"],
+                "name": name,
+                "display_name": None,
+                "color": rng.choice(COLOURS),
+                "birthday": None,
+                "pronouns": rng.choice(["she/her", "he/him", "they/them", "it/its", None]),
+                "avatar_url": None,
+                "webhook_avatar_url": None,
+                "banner": None,
+                "description": f"Generated member {i}",
+                "created": self.system["created"],
+                "keep_proxy": False,
+                "tts": False,
+                "autoproxy_enabled": True,
+                "message_count": rng.randint(0, 5000),
+                "last_message_timestamp": None,
+                "privacy": None,
+            })
+        self.members_by_id = {m["id"]: m for m in self.members}
+
+        # Walk back from now with gaps between five minutes and twelve hours
+        self.switches: List[Dict[str, Any]] = []
+        at = now - timedelta(minutes=rng.randint(1, 60))
+        member_ids = [m["id"] for m in self.members]
+        for _ in range(switches):
+            count = min(len(member_ids), rng.randint(0 if rng.random() < 0.02 else 1, max_cofronters))
+            self.switches.append({
+                "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                "timestamp": _timestamp(at),
+                "members": rng.sample(member_ids, count),
+            })
+            at -= timedelta(seconds=rng.randint(5 * 60, 12 * 3600))
+
+    @staticmethod
+    def _short_id(rng: random.Random, used: set) -> str:
+        while True:
+            candidate = "".join(rng.choice(string.ascii_lowercase) for _ in range(5))
+            if candidate not in used:
+                used.add(candidate)
+                return candidate
+
+    def fronters(self) -> Dict[str, Any]:
+        if not self.switches:
+            return {"id": None, "timestamp": None, "members": []}
+        latest = self.switches[0]
+        return {
+            "id": latest["id"],
+            "timestamp": latest["timestamp"],
+            "members": [self.members_by_id[m] for m in latest["members"] if m in self.members_by_id],
+        }
+
+    def switch_page(self, limit: int, before: Optional[str]) -> List[Dict[str, Any]]:
+        switches = self.switches
+        if before:
+            # Timestamps share one format, so they compare correctly as strings
+            cutoff = before.replace("+00:00", "Z")
+            if not cutoff.endswith("Z"):
+                cutoff += "Z"
+            lo, hi = 0, len(switches)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if switches[mid]["timestamp"] >= cutoff:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            switches = switches[lo:]
+        return switches[:limit]
+
+    def add_switch(self, member_ids: List[str]) -> Dict[str, Any]:
+        switch = {
+            "id": str(uuid.uuid4()),
+            "timestamp": _timestamp(datetime.now(timezone.utc)),
+            "members": member_ids,
+        }
+        self.switches.insert(0, switch)
+        return switch
+
+
+def create_app(args: argparse.Namespace) -> FastAPI:
+    fake = FakeSystem(args.members, args.switches, args.seed)
+    rng = random.Random(args.seed)
+    stats: Counter = Counter()
+    started = time.time()
+
+    app = FastAPI(title="Fake PluralKit")
+
+    @app.middleware("http")
+    async def inject_latency_and_errors(request: Request, call_next):
+        if request.url.path.startswith("/_fake"):
+            return await call_next(request)
+
+        endpoint = f"{request.method} {request.url.path}"
+        stats[endpoint] += 1
+
+        delay = args.latency_ms + rng.uniform(-args.jitter_ms, args.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        if not request.headers.get("authorization"):
+            stats["401"] += 1
+            return JSONResponse({"message": "401: Missing token", "code": 0}, status_code=401)
+        roll = rng.random()
+        if roll < args.rate_limit_rate:
+            stats["429"] += 1
+            return JSONResponse(
+                {"message": "429: too many requests", "code": 0, "retry_after": 250},
+                status_code=429,
+                headers={"Retry-After": "1"},
+            )
+        if roll < args.rate_limit_rate + args.error_rate:
+            stats["500"] += 1
+            return JSONResponse({"message": "500: internal server error", "code": 0}, status_code=500)
+        return await call_next(request)
+
+    @app.get("/v2/systems/@me")
+    async def get_system():
+        return fake.system
+
+    @app.get("/v2/systems/@me/members")
+    async def get_members():
+        return fake.members
+
+    @app.get("/v2/systems/@me/fronters")
+    async def get_fronters():
+        return fake.fronters()
+
+    @app.get("/v2/systems/@me/switches")
+    async def get_switches(limit: int = MAX_SWITCH_PAGE, before: Optional[str] = None):
+        return fake.switch_page(max(1, min(limit, MAX_SWITCH_PAGE)), before)
+
+    @app.post("/v2/systems/@me/switches")
+    async def post_switch(request: Request):
+        body = await request.json()
+        member_ids = body.get("members") or []
+        unknown = [m for m in member_ids if m not in fake.members_by_id]
+        if unknown:
+            return JSONResponse({"message": f"Member(s) not found: {unknown}", "code": 20002}, status_code=400)
+        if fake.switches and fake.switches[0]["members"] == member_ids:
+            # Like PluralKit, refuse a switch to the members already fronting
+            stats["40004"] += 1
+            return JSONResponse(
+                {"message": "Member list identical to current fronter list.", "code": 40004}, status_code=400
+            )
+        switch = fake.add_switch(member_ids)
+        return {**switch, "members": [fake.members_by_id[m] for m in member_ids]}
+
+    @app.get("/_fake/stats")
+    async def get_stats():
+        return {
+            "uptime_seconds": round(time.time() - started, 1),
+            "members": len(fake.members),
+            "switches": len(fake.switches),
+            "requests": dict(stats),
+        }
+
+    @app.post("/_fake/stats/reset")
+    async def reset_stats():
+        stats.clear()
+        return {"success": True}
+
+    return app
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline stand-in for the PluralKit v2 API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--members", type=int, default=100, help="number of members to generate")
+    parser.add_argument("--switches", type=int, default=5000, help="length of the switch history")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the generated data")
+    parser.add_argument("--latency-ms", type=float, default=50, help="added to every response")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="random +/- variation of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests answered with a 429")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f"Fake PluralKit with {args.members} members and {args.switches} switches "
+          f"on http://{args.host}:{args.port}/v2")
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,332 @@
+"""
+Load test for a running backend, reporting throughput and p50/p95/p99
+latency for each kind of request.
+
+Run the backend against perf/fake_pluralkit.py so PluralKit isn't touched:
+
+    python perf/fake_pluralkit.py --switches 20000 &
+    PLURALKIT_BASE_URL=http://127.0.0.1:8100/v2 SYSTEM_TOKEN=fake uvicorn main:app --port 8000 &
+    python perf/loadtest.py --duration 30 --concurrency 32 --ws-clients 100 \\
+        --username admin --password ... --fake-pk-url http://127.0.0.1:8100
+
+Scenarios:
+    members   GET /api/members
+    fronters  GET /api/fronters
+    metrics   GET /api/metrics/fronting-time and /api/metrics/switch-frequency (needs a login)
+    pages     GET /{member_name}, the server-rendered member pages
+    ws        WebSocket clients held open for the whole run; with --switch-interval
+              a switch is made periodically (needs a login) and the time until
+              each client receives the fronting_update is measured
+
+--max-p95-ms and --max-error-rate make the exit status non-zero when any
+HTTP scenario exceeds them, so the run can gate a deploy.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+from urllib.parse import quote
+
+import httpx
+import websockets
+
+HTTP_SCENARIOS = ("members", "fronters", "metrics", "pages")
+ALL_SCENARIOS = HTTP_SCENARIOS + ("ws",)
+
+# Relative weight of each scenario in the request mix, roughly like real traffic
+SCENARIO_WEIGHTS = {"members": 4, "fronters": 6, "metrics": 1, "pages": 3}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+class Recorder:
+    """Latencies (ms) and errors per request name, ignoring anything during warm-up"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.recording = False
+        self.started_at = 0.0
+        self.stopped_at = 0.0
+
+    def start(self):
+        self.recording = True
+        self.started_at = time.perf_counter()
+
+    def stop(self):
+        self.recording = False
+        self.stopped_at = time.perf_counter()
+
+    def record(self, name: str, elapsed_ms: float, status: str, ok: bool):
+        if not self.recording:
+            return
+        self.latencies[name].append(elapsed_ms)
+        self.statuses[name][status] += 1
+        if not ok:
+            self.errors[name] += 1
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        duration = max(self.stopped_at - self.started_at, 1e-9)
+        result = {}
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies[name])
+            count = len(values)
+            result[name] = {
+                "requests": count,
+                "errors": self.errors[name],
+                "error_rate": self.errors[name] / count if count else 0.0,
+                "rps": count / duration,
+                "p50_ms": percentile(values, 50),
+                "p95_ms": percentile(values, 95),
+                "p99_ms": percentile(values, 99),
+                "max_ms": values[-1] if values else 0.0,
+                "statuses": dict(self.statuses[name]),
+            }
+        return result
+
+
+async def login(client: httpx.AsyncClient, username: str, password: str) -> str:
+    # The form-encoded login skips Turnstile, which a load test can't solve
+    resp = await client.post("/api/login", data={"username": username, "password": password})
+    resp.raise_for_status()
+    return resp.json()["access_token"]
+
+
+def build_mix(scenarios: List[str], member_names: List[str], authenticated: bool) -> List[Dict[str, Any]]:
+    """Weighted list of (name, path, needs_auth) requests the HTTP workers choose from"""
+    mix = []
+    if "members" in scenarios:
+        mix.append({"name": "GET /api/members", "paths": ["/api/members"], "weight": SCENARIO_WEIGHTS["members"]})
+    if "fronters" in scenarios:
+        mix.append({"name": "GET /api/fronters", "paths": ["/api/fronters"], "weight": SCENARIO_WEIGHTS["fronters"]})
+    if "metrics" in scenarios and authenticated:
+        for path in ("/api/metrics/fronting-time", "/api/metrics/switch-frequency"):
+            mix.append({"name": f"GET {path}", "paths": [path], "weight": SCENARIO_WEIGHTS["metrics"], "auth": True})
+    if "pages" in scenarios and member_names:
+        mix.append({
+            "name": "GET /{member_name}",
+            "paths": [f"/{quote(name)}" for name in member_names],
+            "weight": SCENARIO_WEIGHTS["pages"],
+        })
+    return mix
+
+
+async def http_worker(client: httpx.AsyncClient, mix: List[Dict[str, Any]], headers: Dict[str, str],
+                      deadline: float, recorder: Recorder, rng: random.Random):
+    weights = [entry["weight"] for entry in mix]
+    while time.perf_counter() < deadline:
+        entry = rng.choices(mix, weights)[0]
+        path = rng.choice(entry["paths"])
+        started = time.perf_counter()
+        try:
+            resp = await client.get(path, headers=headers if entry.get("auth") else None)
+            await resp.aread()
+            status, ok = str(resp.status_code), resp.status_code < 400
+        except httpx.HTTPError as e:
+            status, ok = type(e).__name__, False
+        recorder.record(entry["name"], (time.perf_counter() - started) * 1000, status, ok)
+
+
+class SwitchClock:
+    """When the latest switch was sent, so WebSocket clients can time its broadcast"""
+
+    def __init__(self):
+        self.sequence = 0
+        self.sent_at = 0.0
+
+
+async def ws_client(ws_url: str, deadline: float, recorder: Recorder, clock: SwitchClock):
+    started = time.perf_counter()
+    try:
+        async with websockets.connect(ws_url, open_timeout=15, max_size=None) as ws:
+            await ws.recv()  # connection_established
+            recorder.record("WS connect", (time.perf_counter() - started) * 1000, "open", True)
+
+            seen_sequence = clock.sequence
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(ws.recv(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                received = time.perf_counter()
+                if isinstance(message, bytes) or '"fronting_update"' not in message[:40]:
+                    continue
+                if clock.sequence != seen_sequence:
+                    # First fronting_update since the latest switch was sent
+                    seen_sequence = clock.sequence
+                    recorder.record("WS switch broadcast", (received - clock.sent_at) * 1000, "received", True)
+    except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+        recorder.record("WS connect", (time.perf_counter() - started) * 1000, type(e).__name__, False)
+
+
+async def switch_driver(client: httpx.AsyncClient, headers: Dict[str, str], member_ids: List[str],
+                        interval: float, deadline: float, recorder: Recorder, clock: SwitchClock,
+                        rng: random.Random):
+    while time.perf_counter() + interval < deadline:
+        await asyncio.sleep(interval)
+        clock.sequence += 1
+        clock.sent_at = time.perf_counter()
+        try:
+            resp = await client.post("/api/switch_front", json={"member_id": rng.choice(member_ids)}, headers=headers)
+            status, ok = str(resp.status_code), resp.status_code < 400
+        except httpx.HTTPError as e:
+            status, ok = type(e).__name__, False
+        recorder.record("POST /api/switch_front", (time.perf_counter() - clock.sent_at) * 1000, status, ok)
+
+
+async def fake_pluralkit_stats(url: str, reset: bool = False) -> Optional[Dict[str, Any]]:
+    try:
+        async with httpx.AsyncClient(base_url=url, timeout=5) as client:
+            if reset:
+                await client.post("/_fake/stats/reset")
+                return None
+            return (await client.get("/_fake/stats")).json()
+    except httpx.HTTPError as e:
+        print(f"Could not reach the fake PluralKit at {url}: {e}")
+        return None
+
+
+def print_report(summary: Dict[str, Dict[str, Any]], upstream: Optional[Dict[str, Any]], duration: float):
+    print()
+    print(f"{'request':<38} {'count':>8} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    print("-" * 104)
+    for name, row in summary.items():
+        print(f"{name:<38} {row['requests']:>8} {row['errors']:>7} {row['rps']:>9.1f} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['max_ms']:>9.1f}")
+    print("-" * 104)
+    total = sum(row["requests"] for name, row in summary.items() if not name.startswith("WS"))
+    print(f"HTTP throughput: {total / duration:.1f} req/s over {duration:.1f}s")
+    if upstream:
+        calls = upstream.get("requests", {})
+        # Endpoint counters are "METHOD /path"; the others count injected errors
+        total_calls = sum(count for key, count in calls.items() if " " in key)
+        print(f"Upstream PluralKit requests during the run: {total_calls} {calls}")
+
+
+def check_thresholds(summary: Dict[str, Dict[str, Any]], max_p95_ms: Optional[float],
+                     max_error_rate: Optional[float]) -> List[str]:
+    failures = []
+    for name, row in summary.items():
+        if max_p95_ms is not None and row["p95_ms"] > max_p95_ms:
+            failures.append(f"{name}: p95 {row['p95_ms']:.1f}ms > {max_p95_ms}ms")
+        if max_error_rate is not None and row["error_rate"] > max_error_rate:
+            failures.append(f"{name}: error rate {row['error_rate']:.2%} > {max_error_rate:.2%}")
+    return failures
+
+
+async def run(args: argparse.Namespace) -> int:
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(ALL_SCENARIOS)
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        return 2
+
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.concurrency + 2, max_keepalive_connections=args.concurrency + 2)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        headers = {}
+        if args.token:
+            headers["Authorization"] = f"Bearer {args.token}"
+        elif args.username and args.password:
+            headers["Authorization"] = f"Bearer {await login(client, args.username, args.password)}"
+        authenticated = bool(headers)
+        if "metrics" in scenarios and not authenticated:
+            print("Skipping the metrics scenario: it needs --token or --username/--password")
+        if args.switch_interval and not authenticated:
+            print("Not making switches: --switch-interval needs --token or --username/--password")
+
+        resp = await client.get("/api/members")
+        resp.raise_for_status()
+        members = resp.json()
+        member_names = [m["name"] for m in members if m.get("name")]
+        member_ids = [m["id"] for m in members if m.get("id")]
+
+        mix = build_mix(scenarios, member_names, authenticated)
+        if not mix and "ws" not in scenarios:
+            print("Nothing to run")
+            return 2
+
+        deadline = time.perf_counter() + args.warmup + args.duration
+        tasks = []
+        if mix:
+            tasks += [
+                asyncio.create_task(http_worker(client, mix, headers, deadline, recorder, random.Random(rng.random())))
+                for _ in range(args.concurrency)
+            ]
+        print(f"Running {', '.join(scenarios)} against {args.base_url} for {args.duration:g}s "
+              f"(+{args.warmup:g}s warm-up) with {args.concurrency} HTTP workers"
+              + (f" and {args.ws_clients} WebSocket clients" if "ws" in scenarios else ""))
+        await asyncio.sleep(args.warmup)
+        if args.fake_pk_url:
+            await fake_pluralkit_stats(args.fake_pk_url, reset=True)
+        recorder.start()
+
+        # Opened after the warm-up so their connect times are measured under load
+        clock = SwitchClock()
+        if "ws" in scenarios:
+            ws_url = args.base_url.replace("http://", "ws://", 1).replace("https://", "wss://", 1).rstrip("/") + "/ws"
+            tasks += [asyncio.create_task(ws_client(ws_url, deadline, recorder, clock)) for _ in range(args.ws_clients)]
+            if args.switch_interval and authenticated and member_ids:
+                tasks.append(asyncio.create_task(switch_driver(
+                    client, headers, member_ids, args.switch_interval, deadline, recorder, clock, rng
+                )))
+        await asyncio.gather(*tasks)
+        recorder.stop()
+
+    summary = recorder.summary()
+    upstream = await fake_pluralkit_stats(args.fake_pk_url) if args.fake_pk_url else None
+    print_report(summary, upstream, recorder.stopped_at - recorder.started_at)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"scenarios": scenarios, "duration": args.duration, "concurrency": args.concurrency,
+                       "results": summary, "upstream": upstream}, f, indent=2)
+        print(f"Wrote results to {args.json}")
+
+    failures = check_thresholds(summary, args.max_p95_ms, args.max_error_rate)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test the backend")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--scenarios", default=",".join(ALL_SCENARIOS),
+                        help=f"comma separated, from {', '.join(ALL_SCENARIOS)}")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to measure for")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of unmeasured load first")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent HTTP workers")
+    parser.add_argument("--ws-clients", type=int, default=50, help="WebSocket connections to hold open")
+    parser.add_argument("--switch-interval", type=float, default=0,
+                        help="make a switch every N seconds to time WebSocket broadcasts (0 = off)")
+    parser.add_argument("--timeout", type=float, default=30, help="per request timeout in seconds")
+    parser.add_argument("--username", help="login for the metrics and switch scenarios")
+    parser.add_argument("--password")
+    parser.add_argument("--token", help="JWT to use instead of logging in")
+    parser.add_argument("--fake-pk-url", help="fake PluralKit base URL, to report upstream requests made")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--max-p95-ms", type=float, help="fail if any request's p95 exceeds this")
+    parser.add_argument("--max-error-rate", type=float, help="fail if any request's error rate exceeds this (0-1)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
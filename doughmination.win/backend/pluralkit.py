@@ -1,17 +1,41 @@
-import httpx
+import asyncio
+import contextvars
 import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
-from cache import get_from_cache, set_in_cache
+from telemetry import record_refresh
+from pluralkit_client import PluralKitError, pk_request
+from switch_queue import SwitchQueue
+from disk_snapshot import last_known_good, load_snapshot, remember as remember_on_disk, shared_entry
+from cache import (
+    MISSING, DEPENDENCY_TTL, NEGATIVE_CACHE_TTL, content_hash, forget_failure,
+    get_cache_entry, get_dependents, invalidate_in_cache, lookup_in_cache, recent_failure,
+    remember_failure, set_in_cache
+)
 
 load_dotenv()
 
-BASE_URL = "https://api.pluralkit.me/v2"
-TOKEN = os.getenv("SYSTEM_TOKEN")
 CACHE_TTL = int(os.getenv("CACHE_TTL", 30))
 
-HEADERS = {
-    "Authorization": TOKEN
-}
+# After CACHE_TTL runs out, keep serving the previous value for up to
+# CACHE_STALE_TTL seconds while it is refreshed in the background
+STALE_WHILE_REVALIDATE = os.getenv("STALE_WHILE_REVALIDATE", "true").lower() == "true"
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", 300))
+
+# Content hash and last-change time of each stored value. A refresh that
+# returns identical data leaves derived keys alone; a changed one drops them.
+VERSION_NAMESPACE = "versions"
+
+# A switch is sent straight away, but switches made while it is being sent
+# or within this many seconds after it are sent to PluralKit as one switch
+# to the last state requested (0 to only merge switches made while another
+# is being sent)
+SWITCH_COALESCE_WINDOW = float(os.getenv("SWITCH_COALESCE_WINDOW", 0.5))
+
+# PluralKit error code for a switch to the members already fronting
+PK_ERROR_IDENTICAL_FRONTERS = 40004
 
 # Special member display names
 SPECIAL_DISPLAY_NAMES = {
@@ -20,32 +44,353 @@ SPECIAL_DISPLAY_NAMES = {
     "sleeping": "I am sleeping"
 }
 
-async def get_system():
-    cache_key = "system"
-    if (cached := get_from_cache(cache_key)):
-        return cached
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(f"{BASE_URL}/systems/@me", headers=HEADERS)
-        resp.raise_for_status()
-        data = resp.json()
-        set_in_cache(cache_key, data, CACHE_TTL)
-        return data
-
-async def get_members():
-    cache_key = "members"
-    if (cached := get_from_cache(cache_key)):
-        return cached
-    
+class MemberIndex:
+    """
+    Lookups into one version of the processed member list: by id or uuid,
+    by case-folded name, and by the SPECIAL_DISPLAY_NAMES aliases ("unsure").
+    Where names collide the first member wins, like a scan of the list would.
+    """
+
+    def __init__(self, members: List[Dict[str, Any]], version: Optional[str] = None):
+        self.members = members
+        self.version = version
+        self.by_id: Dict[str, Dict[str, Any]] = {}
+        self.by_name: Dict[str, Dict[str, Any]] = {}
+
+        for member in members:
+            self.by_id.setdefault(member.get("id"), member)
+            if member.get("uuid"):
+                self.by_id.setdefault(member["uuid"], member)
+            if member.get("name"):
+                self.by_name.setdefault(member["name"].casefold(), member)
+        for member in members:
+            alias = SPECIAL_DISPLAY_NAMES.get(member.get("name"))
+            if alias:
+                self.by_name.setdefault(alias.casefold(), member)
+
+    def get_by_id(self, member_id: str) -> Optional[Dict[str, Any]]:
+        return self.by_id.get(member_id)
+
+    def get_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+        return self.by_name.get(name.casefold())
+
+    def get(self, id_or_name: str) -> Optional[Dict[str, Any]]:
+        """Member with this id, or else this name or alias"""
+        return self.by_id.get(id_or_name) or self.get_by_name(id_or_name)
+
+# Index of the member list currently in the cache, rebuilt when its content changes
+_member_index: Optional[MemberIndex] = None
+
+# Keys whose last refresh failed, with the time it started failing. Their
+# cached or on-disk copy is what's being served until a refresh succeeds.
+_degraded: Dict[str, float] = {}
+
+# Called as listener(key, data) whenever a stored value's content changes
+_change_listeners: List[Callable[[str, Any], Awaitable[None]]] = []
+
+# id -> (content hash, member) for the last member list stored, to diff the next one against
+_member_state: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+
+# Upstream fetches currently running, keyed by cache key
+_inflight: Dict[str, asyncio.Task] = {}
+# Bumped whenever a key is invalidated so fetches started earlier don't store old data
+_generations: Dict[str, int] = {}
+# Keys whose fetch the current task is running, outermost first. Tasks
+# started from a fetch inherit it, so a source refreshed for a dependent
+# knows that dependent is already being rebuilt from the new data.
+_fetching: contextvars.ContextVar[Tuple[str, ...]] = contextvars.ContextVar("fetching", default=())
+
+def _on_fetch_done(key: str, task: asyncio.Task):
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    # Mark the exception as retrieved even if every waiter went away
+    if not task.cancelled():
+        task.exception()
+
+async def single_flight(key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Run fetch() at most once at a time per key.
+    Concurrent callers wait on the same upstream call and share its result or error.
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _on_fetch_done(key, t))
+    # Shield so one caller disconnecting doesn't cancel the fetch for everyone else
+    return await asyncio.shield(task)
+
+def _changed_at(key: str, data: Any, digest: str) -> float:
+    """
+    When this content of a key first appeared, as an epoch timestamp. Taken
+    from the data, or from the on-disk snapshot when a worker already wrote
+    it there, so every worker and restart agrees on it; otherwise the time
+    it was first seen.
+    """
+    if key == "fronters" and isinstance(data, dict) and isinstance(data.get("timestamp"), str):
+        try:
+            # The time of the switch that led to this front
+            return datetime.fromisoformat(data["timestamp"].replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            pass
+    stored = shared_entry(key)
+    if stored is not None and stored["hash"] == digest:
+        return stored["changed_at"]
+    return time.time()
+
+def _record_version(key: str, data: Any) -> bool:
+    """
+    Store the content hash of a freshly fetched value, returning True if it
+    changed. Without an earlier version (a cold cache, or one expired or
+    evicted) it counts as changed, so listeners aren't left without the update.
+    """
+    previous = lookup_in_cache(key, namespace=VERSION_NAMESPACE)
+    digest = content_hash(data)
+    if previous is not MISSING and previous["hash"] == digest:
+        set_in_cache(key, previous, DEPENDENCY_TTL, namespace=VERSION_NAMESPACE)
+        return False
+    version = {"hash": digest, "changed_at": _changed_at(key, data, digest)}
+    set_in_cache(key, version, DEPENDENCY_TTL, namespace=VERSION_NAMESPACE)
+    return True
+
+def add_change_listener(listener: Callable[[str, Any], Awaitable[None]]):
+    """
+    Run listener(key, data) in the background whenever a refresh changes a key's content.
+    A changed member list arrives as key "members_delta" with the diff from
+    diff_members() when the previous list is known, as "members" otherwise.
+    """
+    _change_listeners.append(listener)
+
+def _notify_change(key: str, data: Any):
+    async def run(listener):
+        try:
+            await listener(key, data)
+        except Exception as e:
+            print(f"Change listener for '{key}' failed: {e}")
+
+    for listener in _change_listeners:
+        asyncio.ensure_future(run(listener))
+
+def diff_members(members: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Compare a member list with the one seen before it by per-member content hash.
+    Returns {"added": [member], "removed": [id], "changed": [{"id", "fields"}]},
+    where fields holds the new value of every field that changed, or None
+    when there's no previous list to compare with.
+    """
+    global _member_state
+    previous = _member_state
+    _member_state = {member.get("id"): (content_hash(member), member) for member in members}
+    if not previous:
+        return None
+
+    added, changed = [], []
+    for member_id, (digest, member) in _member_state.items():
+        old = previous.get(member_id)
+        if old is None:
+            added.append(member)
+        elif old[0] != digest:
+            old_member = old[1]
+            fields = {
+                field: member.get(field)
+                for field in sorted(set(member) | set(old_member))
+                if member.get(field) != old_member.get(field)
+            }
+            changed.append({"id": member_id, "fields": fields})
+    removed = [member_id for member_id in previous if member_id not in _member_state]
+    return {"added": added, "removed": removed, "changed": changed}
+
+def get_data_version(key: str) -> Optional[Dict[str, Any]]:
+    """Content hash and last-change epoch time of a cached key, if known"""
+    version = lookup_in_cache(key, namespace=VERSION_NAMESPACE)
+    return None if version is MISSING else version
+
+async def _fetch_and_store(
+    key: str,
+    fetch: Callable[[], Awaitable[Any]],
+    ttl: int,
+    negative_ttl: Optional[float],
+    depends_on: Optional[List[str]]
+) -> Any:
+    generation = _generations.get(key, 0)
+    start = time.perf_counter()
+    token = _fetching.set(_fetching.get() + (key,))
+    try:
+        data = await fetch()
+    except Exception as e:
+        _degraded.setdefault(key, time.time())
+        if negative_ttl:
+            remember_failure(key, e, negative_ttl)
+        raise
+    finally:
+        _fetching.reset(token)
+        record_refresh(key, time.perf_counter() - start)
+    _degraded.pop(key, None)
+    if _generations.get(key, 0) == generation:
+        _store(key, data, ttl, depends_on)
+    return data
+
+def _store(key: str, data: Any, ttl: int, depends_on: Optional[List[str]]):
+    """Cache a value, dropping derived keys and telling listeners if its content changed"""
+    changed = _record_version(key, data)
+    if changed:
+        for dependent in get_dependents(key):
+            # A dependent that asked for this refresh is rebuilt from the new
+            # data, so its fetch is left to store the result
+            invalidate(dependent, rebuilding=_fetching.get())
+    set_in_cache(
+        key, data, ttl,
+        stale_ttl=CACHE_STALE_TTL if STALE_WHILE_REVALIDATE else 0,
+        depends_on=depends_on
+    )
+    version = get_data_version(key)
+    if version:
+        remember_on_disk(key, data, version)
+    delta = None
+    if key == "members" and (changed or not _member_state):
+        delta = diff_members(data)
+    if changed:
+        if delta is not None:
+            _notify_change("members_delta", delta)
+        else:
+            _notify_change(key, data)
+
+def _refresh_in_background(
+    key: str,
+    fetch: Callable[[], Awaitable[Any]],
+    ttl: int,
+    negative_ttl: Optional[float],
+    depends_on: Optional[List[str]]
+):
+    if key in _inflight:
+        return
+    if negative_ttl and recent_failure(key):
+        return
+
+    async def refresh():
+        try:
+            await single_flight(key, lambda: _fetch_and_store(key, fetch, ttl, negative_ttl, depends_on))
+        except Exception as e:
+            print(f"Background refresh of '{key}' failed: {e}")
+
+    asyncio.ensure_future(refresh())
+
+async def cached_fetch(
+    key: str,
+    fetch: Callable[[], Awaitable[Any]],
+    ttl: int = CACHE_TTL,
+    negative_ttl: Optional[float] = None,
+    depends_on: Optional[List[str]] = None,
+    refresh: bool = False
+) -> Any:
+    """
+    Return the cached value for key, calling fetch() on a miss, or always with refresh=True.
+    Concurrent misses share one fetch. With stale-while-revalidate enabled an
+    expired value is returned immediately and refreshed in the background.
+    With negative_ttl set, a failed fetch is remembered for that long (plus
+    jitter) and raised again as UpstreamFailure without calling upstream.
+    depends_on names the keys the value is derived from, see invalidate().
+    """
+    entry = MISSING if refresh else get_cache_entry(key)
+    if entry is not MISSING:
+        value, is_fresh = entry
+        if is_fresh:
+            return value
+        if STALE_WHILE_REVALIDATE:
+            _refresh_in_background(key, fetch, ttl, negative_ttl, depends_on)
+            return value
+
+    try:
+        if negative_ttl and (failure := recent_failure(key)):
+            raise failure
+        return await single_flight(key, lambda: _fetch_and_store(key, fetch, ttl, negative_ttl, depends_on))
+    except Exception as e:
+        fallback = last_known_good(key)
+        if fallback is None:
+            raise
+        # Answer from the on-disk snapshot, and keep doing so from the cache
+        # for a short while rather than retrying upstream on every request
+        print(f"Serving last known good '{key}' from disk: {e}")
+        set_in_cache(
+            key, fallback["data"], NEGATIVE_CACHE_TTL,
+            stale_ttl=CACHE_STALE_TTL if STALE_WHILE_REVALIDATE else 0,
+            depends_on=depends_on
+        )
+        return fallback["data"]
+
+def stale_since(*keys: str) -> Optional[float]:
+    """
+    Epoch time since which any of these keys has been failing to refresh,
+    meaning the data served for them is a stale or last-known-good copy
+    """
+    times = [_degraded[key] for key in keys if key in _degraded]
+    return min(times) if times else None
+
+def warm_start() -> int:
+    """
+    Load the on-disk snapshot into the cache as already-expired entries, so
+    the first requests after a restart are answered at once while they are
+    refreshed. Returns the number of keys restored.
+    """
+    entries = load_snapshot()
+    for key, entry in entries.items():
+        if lookup_in_cache(key, namespace=VERSION_NAMESPACE) is MISSING:
+            version = {"hash": entry["hash"], "changed_at": entry["changed_at"]}
+            set_in_cache(key, version, DEPENDENCY_TTL, namespace=VERSION_NAMESPACE)
+        if get_cache_entry(key) is MISSING:
+            # A ttl just above zero keeps it only as a stale copy
+            set_in_cache(key, entry["data"], 0.001, stale_ttl=CACHE_STALE_TTL)
+    return len(entries)
+
+def invalidate(key: str, rebuilding: Tuple[str, ...] = ()) -> List[str]:
+    """
+    Drop a cached key and every key derived from it, including stale copies,
+    and discard fetches for them that are already in flight, other than those
+    of the keys in rebuilding.
+    key doesn't have to hold a value itself: "switches", "member_tags" and
+    "member_status" are sources that only exist for others to depend on.
+    """
+    invalidated = invalidate_in_cache(key)
+    for dropped in invalidated:
+        forget_failure(dropped)
+        if dropped in rebuilding:
+            continue
+        _generations[dropped] = _generations.get(dropped, 0) + 1
+        _inflight.pop(dropped, None)
+    return invalidated
+
+async def _fetch_system():
+    resp = await pk_request("GET", "/systems/@me")
+    return resp.json()
+
+async def _fetch_members_raw():
+    resp = await pk_request("GET", "/systems/@me/members")
+    return resp.json()
+
+async def get_system(refresh: bool = False):
+    return await cached_fetch("system", _fetch_system, negative_ttl=NEGATIVE_CACHE_TTL, refresh=refresh)
+
+async def get_members(refresh: bool = False):
+    return await cached_fetch(
+        "members", lambda: _build_members(refresh), depends_on=["members_raw"], refresh=refresh
+    )
+
+async def get_member_index(refresh: bool = False) -> MemberIndex:
+    """Index of the current member list, built once per members version"""
+    global _member_index
+    members = await get_members(refresh=refresh)
+    version = get_data_version("members")
+    digest = version["hash"] if version else None
+
+    index = _member_index
+    if index is not None and (index.members is members or (digest and index.version == digest)):
+        return index
+    index = _member_index = MemberIndex(members, digest)
+    return index
+
+async def _build_members(refresh: bool = False):
     # Get all members from PluralKit
-    base_cache_key = "members_raw"
-    if not (cached_raw := get_from_cache(base_cache_key)):
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(f"{BASE_URL}/systems/@me/members", headers=HEADERS)
-            resp.raise_for_status()
-            cached_raw = resp.json()
-            set_in_cache(base_cache_key, cached_raw, CACHE_TTL)
-    
-    data = cached_raw
+    data = await cached_fetch("members_raw", _fetch_members_raw, refresh=refresh)
     
     # Process special members
     processed_members = []
@@ -67,61 +412,87 @@ async def get_members():
         else:
             processed_members.append(member)
     
-    set_in_cache(cache_key, processed_members, CACHE_TTL)
     return processed_members
 
-async def get_fronters():
-    cache_key = "fronters"
-    if (cached := get_from_cache(cache_key)):
-        return cached
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(f"{BASE_URL}/systems/@me/fronters", headers=HEADERS)
-        resp.raise_for_status()
-        data = resp.json()
-        
-        # Process special members in fronters
-        if "members" in data:
-            # Get all members for reference
-            all_members = await get_members()
-            
-            processed_fronters = []
-            for member in data["members"]:
-                # Find the processed member data from our get_members function
-                processed_member = None
-                for m in all_members:
-                    if m.get("id") == member.get("id"):
-                        processed_member = m
-                        break
-                
-                if processed_member:
-                    # Use the processed member data (which includes special display name handling)
-                    processed_fronters.append(processed_member)
-                else:
-                    # Fallback to original member data
-                    processed_fronters.append(member)
-            
-            data["members"] = processed_fronters
-        
-        set_in_cache(cache_key, data, CACHE_TTL)
-        return data
+async def get_fronters(refresh: bool = False):
+    # Fronters embed processed members, so a members refresh invalidates them too
+    return await cached_fetch("fronters", _fetch_fronters, depends_on=["members"], refresh=refresh)
+
+async def _fetch_fronters():
+    resp = await pk_request("GET", "/systems/@me/fronters")
+    data = resp.json()
+    
+    # Process special members in fronters
+    if "members" in data:
+        index = await get_member_index()
+        # Use the processed member data (which includes special display name handling),
+        # falling back to the original member data
+        data["members"] = [index.get_by_id(member.get("id")) or member for member in data["members"]]
+    
+    return data
+
+def _front_from_switch(member_ids: List[str], switch: Optional[Dict[str, Any]], index: MemberIndex) -> Dict[str, Any]:
+    """The fronters a successful switch leads to, shaped like GET /systems/@me/fronters"""
+    switch = switch or {}
+    fronters = []
+    # The switch response lists the members as objects; fall back to the IDs we sent
+    for entry in switch.get("members") or member_ids:
+        member_id = entry.get("id") if isinstance(entry, dict) else entry
+        member = index.get_by_id(member_id) or (entry if isinstance(entry, dict) else None)
+        if member:
+            fronters.append(member)
+    return {
+        "id": switch.get("id"),
+        "timestamp": switch.get("timestamp") or datetime.now(timezone.utc).isoformat(),
+        "members": fronters
+    }
+
+async def _commit_switch(member_ids: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    Send one switch to PluralKit and cache the fronters it leads to.
+
+    The new fronters are built from the switch response and the member index,
+    so change listeners can push them out without another round trip, and
+    are confirmed against PluralKit in the background. If another switch is
+    already queued behind this one nothing is cached, so only the front that
+    settles is broadcast.
+    """
+    try:
+        # Sent in order with other writes and retried through rate limits
+        resp = await pk_request("POST", "/systems/@me/switches", json={"members": member_ids})
+        switch = resp.json() if resp.content else None
+    except PluralKitError as e:
+        if e.code != PK_ERROR_IDENTICAL_FRONTERS:
+            raise
+        # Already fronting, e.g. after switching away and back within the window
+        _refresh_in_background("fronters", _fetch_fronters, CACHE_TTL, None, ["members"])
+        return None
+
+    # Drop the switch history and any fronters fetch that started before the switch landed
+    invalidate("switches")
+    invalidate("fronters")
+
+    if not _switch_queue.has_pending():
+        index = await get_member_index()
+        _store("fronters", _front_from_switch(member_ids, switch, index), CACHE_TTL, ["members"])
+        _refresh_in_background("fronters", _fetch_fronters, CACHE_TTL, None, ["members"])
+
+    return switch
+
+_switch_queue = SwitchQueue(_commit_switch, SWITCH_COALESCE_WINDOW)
 
 async def set_front(member_ids):
     """
     Sets the current front to the provided list of member IDs.
     Pass an empty list to clear the front.
+    Raises PluralKitError if the switch couldn't be made.
+
+    Switches are queued. A lone switch is sent right away; ones made in quick
+    succession after it are merged into a single switch to the last state
+    requested. Returns once that state is
+    committed, with PluralKit's switch object (None if nothing had to change).
     """
-    # Clear fronters cache since we're updating it
-    cache_key = "fronters"
-    set_in_cache(cache_key, None, 0)  # Invalidate cache
-    
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{BASE_URL}/systems/@me/switches",
-            headers=HEADERS,
-            json={"members": member_ids}
-        )
-        if resp.status_code not in (200, 204):
-            raise Exception(f"Failed to set front: {resp.status_code} - {resp.text}")
+    return await _switch_queue.submit(member_ids)
 
-        # If there's a response body, return it, otherwise return None
-        return resp.json() if resp.content else None
\ No newline at end of file
+def get_switch_queue_stats() -> Dict[str, Any]:
+    return _switch_queue.stats()
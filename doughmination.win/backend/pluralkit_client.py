@@ -0,0 +1,203 @@
+import asyncio
+import os
+import random
+import time
+from typing import Any, Optional
+import httpx
+from dotenv import load_dotenv
+from http_clients import get_client
+from telemetry import observe_upstream
+
+load_dotenv()
+
+# Point at perf/fake_pluralkit.py for offline development and load tests
+BASE_URL = os.getenv("PLURALKIT_BASE_URL", "https://api.pluralkit.me/v2").rstrip("/")
+TOKEN = os.getenv("SYSTEM_TOKEN")
+
+HEADERS = {
+    "Authorization": TOKEN
+}
+
+# PluralKit allows 10 reads and 3 writes per second; stay a little under
+PLURALKIT_READ_RATE = float(os.getenv("PLURALKIT_READ_RATE", 8))
+PLURALKIT_WRITE_RATE = float(os.getenv("PLURALKIT_WRITE_RATE", 2))
+# Idempotent GETs are retried on 429, 5xx and network errors
+PLURALKIT_MAX_RETRIES = int(os.getenv("PLURALKIT_MAX_RETRIES", 3))
+# Writes are only retried when PluralKit definitely didn't apply them (429, connect errors)
+PLURALKIT_WRITE_RETRIES = int(os.getenv("PLURALKIT_WRITE_RETRIES", 5))
+PLURALKIT_BACKOFF_BASE = float(os.getenv("PLURALKIT_BACKOFF_BASE", 0.5))
+PLURALKIT_BACKOFF_MAX = float(os.getenv("PLURALKIT_BACKOFF_MAX", 10))
+
+RETRYABLE_STATUS_CODES = (500, 502, 503, 504)
+
+
+class PluralKitError(Exception):
+    """A PluralKit request that failed after any retries"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        # PluralKit's own error code from the response body, e.g. 40004
+        self.code = code
+
+
+def _error_code(resp: httpx.Response) -> Optional[int]:
+    try:
+        body = resp.json()
+    except ValueError:
+        return None
+    return body.get("code") if isinstance(body, dict) else None
+
+
+class TokenBucket:
+    """
+    Local rate limiter, refilled at rate tokens per second. PluralKit's
+    rate-limit headers can drain it early or block it until the reset time.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Wait until a request may be sent"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block_for(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers: httpx.Headers):
+        """Sync with PluralKit's X-RateLimit-Remaining / X-RateLimit-Reset headers"""
+        try:
+            remaining = headers.get("x-ratelimit-remaining")
+            reset = headers.get("x-ratelimit-reset")
+            if remaining is None:
+                return
+            remaining = float(remaining)
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, remaining)
+            if remaining <= 0 and reset:
+                self.block_for(_seconds_until(float(reset)))
+        except ValueError:
+            pass
+
+
+def _seconds_until(reset: float) -> float:
+    # The reset time is a Unix timestamp, sent in milliseconds
+    if reset > 1e11:
+        reset /= 1000
+    return min(max(reset - time.time(), 0), PLURALKIT_BACKOFF_MAX)
+
+
+def _backoff(attempt: int) -> float:
+    """Jittered exponential backoff"""
+    delay = min(PLURALKIT_BACKOFF_BASE * (2 ** attempt), PLURALKIT_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def _retry_after(resp: httpx.Response, attempt: int) -> float:
+    retry_after = resp.headers.get("retry-after")
+    if retry_after:
+        try:
+            seconds = float(retry_after)
+            # Retry-After is in seconds, though PluralKit has sent milliseconds
+            return min(seconds / 1000 if seconds > 100 else seconds, PLURALKIT_BACKOFF_MAX)
+        except ValueError:
+            pass
+    reset = resp.headers.get("x-ratelimit-reset")
+    if reset:
+        try:
+            return _seconds_until(float(reset))
+        except ValueError:
+            pass
+    return _backoff(attempt)
+
+
+_read_bucket = TokenBucket(PLURALKIT_READ_RATE)
+_write_bucket = TokenBucket(PLURALKIT_WRITE_RATE)
+# Writes are sent one at a time in the order they were made
+_write_lock = asyncio.Lock()
+
+
+async def _send(method: str, path: str, endpoint: str, is_read: bool, **kwargs: Any) -> httpx.Response:
+    bucket = _read_bucket if is_read else _write_bucket
+    max_retries = PLURALKIT_MAX_RETRIES if is_read else PLURALKIT_WRITE_RETRIES
+    attempt = 0
+
+    while True:
+        await bucket.acquire()
+        try:
+            resp = await observe_upstream(
+                "pluralkit", endpoint,
+                get_client("pluralkit").request(method, f"{BASE_URL}{path}", headers=HEADERS, **kwargs)
+            )
+        except httpx.TransportError as e:
+            # A write may have reached PluralKit unless the connection never opened
+            retryable = is_read or isinstance(e, httpx.ConnectError)
+            if retryable and attempt < max_retries:
+                delay = _backoff(attempt)
+                print(f"PluralKit {endpoint} network error ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            raise PluralKitError(f"PluralKit {endpoint} failed: {e}") from e
+
+        bucket.update_from_headers(resp.headers)
+
+        if resp.status_code == 429 and attempt < max_retries:
+            delay = _retry_after(resp, attempt)
+            print(f"PluralKit {endpoint} rate limited, retrying in {delay:.1f}s")
+            bucket.block_for(delay)
+            attempt += 1
+            continue
+
+        if is_read and resp.status_code in RETRYABLE_STATUS_CODES and attempt < max_retries:
+            delay = _backoff(attempt)
+            print(f"PluralKit {endpoint} returned {resp.status_code}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+
+        if resp.is_error:
+            raise PluralKitError(
+                f"PluralKit {endpoint} failed: {resp.status_code} - {resp.text}",
+                status_code=resp.status_code,
+                code=_error_code(resp)
+            )
+        return resp
+
+
+async def pk_request(method: str, path: str, endpoint: Optional[str] = None, **kwargs: Any) -> httpx.Response:
+    """
+    Send a request to the PluralKit API, e.g. pk_request("GET", "/systems/@me").
+
+    Requests are paced by a local token bucket kept in sync with PluralKit's
+    rate-limit headers. GETs are retried with jittered exponential backoff;
+    writes are queued and sent in order, waiting out rate limits rather than
+    failing. Raises PluralKitError once retries are exhausted.
+    """
+    method = method.upper()
+    endpoint = endpoint or f"{method} {path.split('?')[0]}"
+    if method in ("GET", "HEAD"):
+        return await _send(method, path, endpoint, True, **kwargs)
+
+    async with _write_lock:
+        return await _send(method, path, endpoint, False, **kwargs)
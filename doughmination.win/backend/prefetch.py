@@ -0,0 +1,109 @@
+import asyncio
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+from dotenv import load_dotenv
+from cache import acquire_lease
+from pluralkit import get_system, get_members, get_fronters, CACHE_TTL
+from metrics import get_switches, refresh_running_metrics
+from metrics_aggregator import METRICS_EXPIRE_INTERVAL
+
+load_dotenv()
+
+# Refresh each key this many seconds before its CACHE_TTL runs out, so
+# requests keep hitting a warm cache instead of waiting on PluralKit
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_LEAD = float(os.getenv("PREFETCH_LEAD", 5))
+# Each run starts up to this many seconds early, so jobs don't line up
+PREFETCH_JITTER = float(os.getenv("PREFETCH_JITTER", 2))
+# Stop refreshing when no request has come in for this long
+PREFETCH_IDLE_TIMEOUT = float(os.getenv("PREFETCH_IDLE_TIMEOUT", 600))
+
+_DEFAULT_INTERVAL = max(CACHE_TTL - PREFETCH_LEAD, 1)
+
+# Per-job intervals in seconds, e.g. PREFETCH_INTERVAL_SWITCHES=120
+PREFETCH_INTERVALS = {
+    name: float(os.getenv(f"PREFETCH_INTERVAL_{name.upper()}", _DEFAULT_INTERVAL))
+    for name in ("system", "members", "fronters", "switches")
+}
+
+_last_activity = time.monotonic()
+
+
+def mark_activity():
+    """Record that a request came in, resuming prefetching if it was idle"""
+    global _last_activity
+    _last_activity = time.monotonic()
+
+
+def is_idle() -> bool:
+    return time.monotonic() - _last_activity > PREFETCH_IDLE_TIMEOUT
+
+
+class PrefetchScheduler:
+    """
+    Runs each refresh job in its own task on its own interval.
+
+    Jobs added with shared=True refresh data kept in the shared cache. With
+    the SQLite backend every worker runs the scheduler, so those jobs hold
+    a lease in the cache and only the worker holding it runs them. The
+    lease lasts two intervals, so if that worker stops or goes idle another
+    takes over.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[str, tuple] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def add_job(
+        self,
+        name: str,
+        refresh: Callable[[], Awaitable[object]],
+        interval: float,
+        shared: bool = False
+    ):
+        self._jobs[name] = (refresh, interval, shared)
+
+    def start(self):
+        if self._tasks:
+            return
+        for name, (refresh, interval, shared) in self._jobs.items():
+            self._tasks.append(asyncio.create_task(self._run(name, refresh, interval, shared)))
+        print(f"Prefetch scheduler started with jobs: {', '.join(self._jobs)}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        print("Prefetch scheduler stopped")
+
+    async def _run(self, name: str, refresh: Callable[[], Awaitable[object]], interval: float, shared: bool):
+        while True:
+            await asyncio.sleep(max(interval - random.uniform(0, PREFETCH_JITTER), 1))
+            if is_idle():
+                continue
+            try:
+                if shared and not acquire_lease(f"prefetch:{name}", interval * 2):
+                    continue
+                await refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Prefetch job '{name}' failed: {e}")
+
+
+def create_scheduler() -> Optional[PrefetchScheduler]:
+    """Scheduler for the PluralKit keys the public pages read, or None if disabled"""
+    if not PREFETCH_ENABLED:
+        return None
+
+    scheduler = PrefetchScheduler()
+    scheduler.add_job("system", lambda: get_system(refresh=True), PREFETCH_INTERVALS["system"], shared=True)
+    scheduler.add_job("members", lambda: get_members(refresh=True), PREFETCH_INTERVALS["members"], shared=True)
+    scheduler.add_job("fronters", lambda: get_fronters(refresh=True), PREFETCH_INTERVALS["fronters"], shared=True)
+    # The switch history and running metrics are held by each process
+    scheduler.add_job("switches", lambda: get_switches(refresh=True), PREFETCH_INTERVALS["switches"])
+    scheduler.add_job("metrics", refresh_running_metrics, METRICS_EXPIRE_INTERVAL)
+    return scheduler
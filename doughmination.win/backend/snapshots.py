@@ -0,0 +1,125 @@
+import hashlib
+import os
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from cache import DEPENDENCY_TTL, lookup_in_cache, set_in_cache
+from http_cache import encode_json
+from pluralkit import get_members, get_fronters, get_data_version
+from tags import enrich_members_with_tags, MEMBER_TAGS_FILE
+from member_status import enrich_members_with_status, MEMBER_STATUS_FILE
+
+
+class Snapshot(NamedTuple):
+    """A fully enriched response payload, encoded and ready to send"""
+    body: bytes
+    etag: str
+    last_modified: Optional[float]  # When the underlying data last changed
+
+
+# Built snapshots, kept per process by name. The cache holds a marker with
+# the current etag of each one that depends on the snapshot's inputs, so any
+# input change removes the marker and forces a rebuild.
+_snapshots: Dict[str, Snapshot] = {}
+
+# Tag and status file stamps each snapshot was built from. Those files are
+# written by whichever worker handled the request, and with a per-process
+# cache the others never see that worker's invalidation, so every worker
+# also compares the files themselves before reusing a snapshot.
+_file_stamps: Dict[str, Tuple] = {}
+
+
+def _data_file_stamps() -> Tuple:
+    """(mtime_ns, size) of the tag and status files, None for a missing one"""
+    stamps = []
+    for path in (MEMBER_TAGS_FILE, MEMBER_STATUS_FILE):
+        try:
+            stat = os.stat(path)
+            stamps.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stamps.append(None)
+    return tuple(stamps)
+
+
+def data_changed_at(keys: List[str]) -> Optional[float]:
+    """
+    Latest change time of the given PluralKit cache keys and of the tag
+    and status files, as an epoch timestamp
+    """
+    times = []
+    for key in keys:
+        if (version := get_data_version(key)):
+            times.append(version["changed_at"])
+    for path in (MEMBER_TAGS_FILE, MEMBER_STATUS_FILE):
+        if os.path.exists(path):
+            times.append(os.path.getmtime(path))
+    return max(times) if times else None
+
+
+def _encode(payload: Any, modified_keys: List[str]) -> Snapshot:
+    body = encode_json(payload)
+    return Snapshot(
+        body=body,
+        etag=hashlib.sha256(body).hexdigest(),
+        last_modified=data_changed_at(modified_keys)
+    )
+
+
+def _current(name: str) -> Optional[Snapshot]:
+    snapshot = _snapshots.get(name)
+    if snapshot is None:
+        return None
+    if lookup_in_cache(f"snapshot_{name}") != snapshot.etag:
+        return None
+    if _file_stamps.get(name) != _data_file_stamps():
+        return None
+    return snapshot
+
+
+def _publish(
+    name: str,
+    payload: Any,
+    source_keys: List[str],
+    modified_keys: List[str],
+    stamps: Tuple
+) -> Snapshot:
+    """
+    Encode and keep a snapshot. It is rebuilt when any of source_keys is
+    invalidated, and its Last-Modified is the newest change of
+    modified_keys: the raw PluralKit data, whose change times every worker
+    agrees on, rather than the keys derived from it in this process.
+    """
+    snapshot = _encode(payload, modified_keys)
+    _snapshots[name] = snapshot
+    _file_stamps[name] = stamps
+    set_in_cache(
+        f"snapshot_{name}", snapshot.etag, DEPENDENCY_TTL,
+        depends_on=source_keys + ["member_tags", "member_status"]
+    )
+    return snapshot
+
+
+async def get_members_snapshot() -> Snapshot:
+    """/api/members payload: members enriched with tags and status"""
+    # Refresh the inputs first; a changed member list drops the marker
+    members_data = await get_members()
+    if (snapshot := _current("members")):
+        return snapshot
+
+    # Stamped before reading, so a write made meanwhile triggers another rebuild
+    stamps = _data_file_stamps()
+    members_with_tags = enrich_members_with_tags(members_data)
+    members_with_status = enrich_members_with_status(members_with_tags)
+    return _publish("members", members_with_status, ["members"], ["members_raw"], stamps)
+
+
+async def get_fronters_snapshot() -> Snapshot:
+    """/api/fronters payload: current fronters enriched with tags and status"""
+    fronters_data = await get_fronters()
+    if (snapshot := _current("fronters")):
+        return snapshot
+
+    stamps = _data_file_stamps()
+    fronters_data = dict(fronters_data)
+    if "members" in fronters_data:
+        members_with_tags = enrich_members_with_tags(fronters_data["members"])
+        fronters_data["members"] = enrich_members_with_status(members_with_tags)
+    return _publish("fronters", fronters_data, ["fronters"], ["fronters", "members_raw"], stamps)
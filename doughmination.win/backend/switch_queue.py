@@ -0,0 +1,82 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class SwitchQueue:
+    """
+    Switches waiting to be sent to PluralKit, in the order they were made.
+
+    A switch made while nothing has been sent for `window` seconds is
+    committed straight away. Switches made while a commit is running, or
+    within `window` seconds after it finished, wait until that window has
+    passed and are then merged into a single switch to the last state
+    requested. Every caller in the batch gets the result once that state is
+    committed, or the error if it couldn't be.
+    """
+
+    def __init__(self, commit: Callable[[List[str]], Awaitable[Any]], window: float):
+        self._commit = commit
+        self.window = window
+        self._pending: List[Tuple[List[str], asyncio.Future]] = []
+        # When the last commit finished, successfully or not
+        self._last_commit_at = float("-inf")
+        self._worker: Optional[asyncio.Task] = None
+        self.submitted = 0
+        self.committed = 0
+        self.failed = 0
+        self.merged = 0
+
+    def has_pending(self) -> bool:
+        """Whether another switch is waiting to replace the one being committed"""
+        return bool(self._pending)
+
+    async def submit(self, member_ids: List[str]) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((list(member_ids), future))
+        self.submitted += 1
+
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        # A caller going away doesn't cancel the switch for everyone else
+        return await asyncio.shield(future)
+
+    async def _run(self):
+        while self._pending:
+            delay = self.window - (time.monotonic() - self._last_commit_at)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            batch, self._pending = self._pending, []
+            # The last switch requested is the state that wins
+            member_ids = batch[-1][0]
+            if len(batch) > 1:
+                self.merged += len(batch) - 1
+                print(f"Merging {len(batch)} switches into one, to {member_ids}")
+
+            try:
+                result = await self._commit(member_ids)
+            except Exception as e:
+                self._last_commit_at = time.monotonic()
+                self.failed += 1
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                        # Retrieved here too, in case the caller has gone away
+                        future.exception()
+            else:
+                self._last_commit_at = time.monotonic()
+                self.committed += 1
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_seconds": self.window,
+            "submitted": self.submitted,
+            "committed": self.committed,
+            "failed": self.failed,
+            "merged": self.merged,
+            "pending": len(self._pending),
+        }
@@ -0,0 +1,367 @@
+import asyncio
+import gzip
+import json
+import os
+import re
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+from cache import (
+    MISSING, NEGATIVE_CACHE_TTL, add_dependency, lookup_in_cache, recent_failure,
+    remember_failure, set_in_cache
+)
+from pluralkit import single_flight
+from pluralkit_client import pk_request
+
+load_dotenv()
+
+CACHE_TTL = int(os.getenv("CACHE_TTL", 30))
+
+# Complete switch history, backfilled once and then kept up to date with
+# small delta requests. Kept on disk so a restart doesn't backfill again.
+SWITCH_STORE_PATH = Path(os.getenv("SWITCH_STORE_PATH", str(Path("dough-data") / "switches.json.gz")))
+
+# PluralKit returns at most 100 switches per request
+PAGE_SIZE = 100
+# 2 added timestamp_us to every switch
+STORE_FORMAT = 2
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# Shared cache key holding the current generation of the history. It depends
+# on the "switches" source key and expires after CACHE_TTL; the next read after
+# either starts a new generation, and every worker syncs its own store once
+# for each generation it sees.
+SYNC_MARKER_KEY = "switch_history"
+# Shared cache key listing edited or deleted switches every worker has to page
+# back to, as [time_ns requested, epoch microseconds] pairs
+RESYNC_KEY = "switch_history_resync"
+# How long a resync request is kept for workers that haven't synced since
+SWITCH_RESYNC_TTL = int(os.getenv("SWITCH_RESYNC_TTL", 24 * 3600))
+
+
+def parse_timestamp(timestamp_str: str) -> datetime:
+    """Parse timestamp string into datetime with proper timezone handling"""
+    try:
+        # Handle Z timezone
+        if timestamp_str.endswith('Z'):
+            timestamp_str = timestamp_str[:-1] + '+00:00'
+
+        # Try direct parsing first
+        try:
+            dt = datetime.fromisoformat(timestamp_str)
+        except ValueError:
+            # If direct parsing fails, try handling microsecond precision issues
+            match = re.match(r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d+)(\+\d{2}:\d{2})', timestamp_str)
+            if match:
+                # Truncate microseconds to 6 digits and rebuild the string
+                base = match.group(1)
+                if len(base.split('.')[-1]) > 6:
+                    base = base.split('.')[0] + '.' + base.split('.')[-1][:6]
+                timestamp_str = f"{base}{match.group(2)}"
+                dt = datetime.fromisoformat(timestamp_str)
+            else:
+                # Try another approach for microsecond issues
+                parts = timestamp_str.split('.')
+                if len(parts) == 2 and '+' in parts[1]:
+                    ms_part, tz_part = parts[1].split('+', 1)
+                    if len(ms_part) > 6:
+                        ms_part = ms_part[:6]
+                    timestamp_str = f"{parts[0]}.{ms_part}+{tz_part}"
+                    dt = datetime.fromisoformat(timestamp_str)
+                else:
+                    raise ValueError(f"Could not parse timestamp: {timestamp_str}")
+
+        # Ensure it's timezone-aware
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+
+        return dt
+    except Exception as e:
+        print(f"Error parsing timestamp {timestamp_str}: {str(e)}")
+        raise
+
+
+def to_epoch_us(dt: datetime) -> int:
+    """Whole microseconds since the Unix epoch, exactly"""
+    return (dt - EPOCH) // ONE_MICROSECOND
+
+
+def timestamp_us(timestamp_str: str) -> int:
+    """
+    Epoch microseconds of a PluralKit timestamp. Switches get this once, as
+    timestamp_us, when they are stored; nothing downstream parses strings.
+    """
+    try:
+        # Handles PluralKit's "2025-01-01T12:00:00.123456Z" directly
+        dt = datetime.fromisoformat(timestamp_str)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+    except ValueError:
+        dt = parse_timestamp(timestamp_str)
+    return to_epoch_us(dt)
+
+
+def normalize_switch(switch: Dict[str, Any]) -> Dict[str, Any]:
+    """The fields of a PluralKit switch the store keeps, plus timestamp_us"""
+    return {
+        "id": switch.get("id"),
+        "timestamp": switch["timestamp"],
+        "timestamp_us": timestamp_us(switch["timestamp"]),
+        "members": switch.get("members", []),
+    }
+
+
+class SwitchStore:
+    """
+    Every switch of the system, newest first like PluralKit returns them,
+    each with its time as integer epoch microseconds in timestamp_us.
+
+    The first sync pages back through the whole history with the `before`
+    cursor. Later syncs fetch pages from the newest switch until they reach
+    one already held and replace everything from there on, so edits and
+    deletions among recent switches are picked up as well. An older switch
+    known to have changed is picked up by resync_from(), which makes the
+    next sync page back past it.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.switches: List[Dict[str, Any]] = []
+        self.backfilled = False
+        # Epoch microseconds the next sync has to page back to, if further than the newest switch
+        self.resync_before: Optional[int] = None
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    def _load(self):
+        self._loaded = True
+        if not self.path.exists():
+            return
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                stored = json.load(f)
+            if stored.get("format") == STORE_FORMAT:
+                self.switches = stored["switches"]
+                self.backfilled = stored["backfilled"]
+            elif stored.get("format") == 1:
+                # Same switches without timestamp_us, which only needs adding
+                self.switches = [normalize_switch(s) for s in stored["switches"]]
+                self.backfilled = stored["backfilled"]
+                self._save()
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not read switch store {self.path}, backfilling again: {e}")
+
+    def _save(self):
+        payload = {"format": STORE_FORMAT, "backfilled": self.backfilled, "switches": self.switches}
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                json.dump(payload, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not write switch store {self.path}: {e}")
+            tmp_path.unlink(missing_ok=True)
+
+    async def _fetch_page(self, before: Optional[str] = None) -> List[Dict[str, Any]]:
+        params = {"limit": PAGE_SIZE}
+        if before:
+            params["before"] = before
+        resp = await pk_request("GET", "/systems/@me/switches", params=params)
+        return [normalize_switch(s) for s in resp.json()]
+
+    async def _fetch_until(self, newest_held: Optional[int]) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Page back from the newest switch until reaching newest_held or the start
+        of history. Returns the switches and whether they are the complete history.
+        """
+        fetched: List[Dict[str, Any]] = []
+        before = None
+        while True:
+            page = await self._fetch_page(before)
+            fetched.extend(page)
+            if len(page) < PAGE_SIZE:
+                return fetched, True
+            if newest_held is not None and page[-1]["timestamp_us"] <= newest_held:
+                return fetched, False
+            before = page[-1]["timestamp"]
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self._load()
+
+    async def sync(self) -> int:
+        """Bring the store up to date, returning how many switches were new"""
+        async with self._lock:
+            self.ensure_loaded()
+
+            if not self.backfilled or not self.switches:
+                print("Backfilling the complete switch history from PluralKit")
+                fetched, _ = await self._fetch_until(None)
+                added = len(fetched)
+                self.switches = fetched
+                self.backfilled = True
+            else:
+                newest_held = self.switches[0]["timestamp_us"]
+                resync_before = self.resync_before
+                if resync_before is not None:
+                    newest_held = min(newest_held, resync_before)
+                fetched, complete = await self._fetch_until(newest_held)
+                # Unless another change came in meanwhile, which needs its own pass
+                if self.resync_before == resync_before:
+                    self.resync_before = None
+                known_ids = {s["id"] for s in self.switches}
+                added = sum(1 for s in fetched if s["id"] not in known_ids)
+
+                if complete:
+                    # Got everything there is, which replaces the store outright
+                    if fetched == self.switches:
+                        return 0
+                    self.switches = fetched
+                else:
+                    # Keep the held switches older than the oldest one just fetched
+                    boundary = fetched[-1]["timestamp_us"]
+                    start = 0
+                    while start < len(self.switches) and self.switches[start]["timestamp_us"] >= boundary:
+                        start += 1
+                    if fetched == self.switches[:start]:
+                        return 0
+                    self.switches = fetched + self.switches[start:]
+
+            await asyncio.to_thread(self._save)
+            if added:
+                print(f"Switch store now holds {len(self.switches)} switches ({added} new)")
+            return added
+
+    def resync_from(self, switch_id: Optional[str], timestamp: Optional[str] = None) -> bool:
+        """
+        Make the next sync fetch everything from switch_id on again, e.g.
+        after it was edited or deleted. timestamp is its new time, if it
+        moved. Returns False if neither is known, so it can't be located.
+        """
+        self.ensure_loaded()
+        times = [s["timestamp_us"] for s in self.switches if s["id"] == switch_id]
+        if timestamp:
+            try:
+                times.append(timestamp_us(timestamp))
+            except ValueError:
+                pass
+        if not times:
+            return False
+        self.resync_to(min(times))
+        return True
+
+    def resync_to(self, before_us: int):
+        """Make the next sync fetch every switch made at or after before_us again"""
+        if self.resync_before is not None:
+            before_us = min(before_us, self.resync_before)
+        self.resync_before = before_us
+
+    def reset(self):
+        """Forget everything, so the next sync backfills from scratch"""
+        self.switches = []
+        self.backfilled = False
+        self.resync_before = None
+        self._loaded = True
+
+
+_store = SwitchStore(SWITCH_STORE_PATH)
+# Each worker has its own store: the generation it last synced, and the
+# newest shared resync request it has applied
+_synced_generation: Optional[str] = None
+_applied_resync = 0
+
+
+def _apply_shared_resyncs() -> bool:
+    """Apply the resync requests other workers shared since the last call"""
+    global _applied_resync
+    requests = lookup_in_cache(RESYNC_KEY)
+    if requests is MISSING:
+        return False
+    pending = [before_us for requested, before_us in requests if requested > _applied_resync]
+    if not pending:
+        return False
+    _store.resync_to(min(pending))
+    _applied_resync = max(requested for requested, _ in requests)
+    return True
+
+
+def _share_resync(before_us: int):
+    """Make every worker's next sync page back to before_us"""
+    global _applied_resync
+    _apply_shared_resyncs()
+    now_ns = time.time_ns()
+    requests = lookup_in_cache(RESYNC_KEY)
+    requests = [] if requests is MISSING else requests
+    kept_after = now_ns - SWITCH_RESYNC_TTL * 1_000_000_000
+    requests = [[requested, b] for requested, b in requests if requested > kept_after]
+    requests.append([now_ns, before_us])
+    set_in_cache(RESYNC_KEY, requests, SWITCH_RESYNC_TTL)
+    _applied_resync = now_ns
+
+
+async def _sync_switch_history():
+    global _synced_generation
+    generation = lookup_in_cache(SYNC_MARKER_KEY)
+    if generation is MISSING:
+        # Started before syncing, so an invalidation during the sync starts another
+        generation = uuid.uuid4().hex
+        set_in_cache(SYNC_MARKER_KEY, generation, CACHE_TTL, depends_on=["switches"])
+    try:
+        await _store.sync()
+    except Exception as e:
+        # Back off like the other PluralKit keys, until invalidate("switches") at the latest
+        remember_failure(SYNC_MARKER_KEY, e, NEGATIVE_CACHE_TTL)
+        add_dependency("switches", SYNC_MARKER_KEY)
+        raise
+    _synced_generation = generation
+
+
+async def get_switch_history(refresh: bool = False) -> List[Dict[str, Any]]:
+    """
+    Complete switch history, newest first. Synced with PluralKit at most
+    once per CACHE_TTL, or right away after invalidate("switches") or a
+    resync in any worker, with concurrent callers sharing one sync. If
+    PluralKit can't be reached the history held so far is returned, without
+    trying again until NEGATIVE_CACHE_TTL has passed.
+    """
+    _store.ensure_loaded()
+    resync = _apply_shared_resyncs()
+    generation = lookup_in_cache(SYNC_MARKER_KEY)
+    if refresh or resync or generation is MISSING or generation != _synced_generation:
+        try:
+            if failure := recent_failure(SYNC_MARKER_KEY):
+                raise failure
+            await single_flight(SYNC_MARKER_KEY, _sync_switch_history)
+        except Exception as e:
+            print(f"Switch history sync failed, using the {len(_store.switches)} switches held: {e}")
+            if not _store.switches:
+                raise
+    return _store.switches
+
+
+def resync_switch(switch_id: Optional[str], timestamp: Optional[str] = None) -> bool:
+    """
+    Make the next sync refetch the history from a switch that was edited or
+    deleted on PluralKit, however old. A switch that isn't held yet is newer
+    than the history, which the next sync fetches anyway; returns False then.
+    The other workers page back as far on their next sync.
+    """
+    if not _store.resync_from(switch_id, timestamp):
+        return False
+    _share_resync(_store.resync_before)
+    return True
+
+
+def reset_switch_history():
+    """
+    Discard the local history, e.g. after every switch was deleted on
+    PluralKit. The other workers fetch the whole history again instead.
+    """
+    _store.reset()
+    _share_resync(0)
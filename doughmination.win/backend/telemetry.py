@@ -0,0 +1,179 @@
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Dict, List, Tuple
+
+# Latency histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+
+
+class Histogram:
+    """Cumulative latency histogram in the Prometheus style"""
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.last_observed = 0.0
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.last_observed = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum_seconds": self.sum,
+            "avg_seconds": self.sum / self.count if self.count else 0,
+            "max_seconds": self.max,
+            "last_age_seconds": time.time() - self.last_observed if self.count else None,
+            "buckets": {str(bound): n for bound, n in zip(LATENCY_BUCKETS, self.buckets)}
+        }
+
+
+# prefix -> event -> count, events are hit, miss, stale, eviction, expiration
+_cache_events: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+# prefix -> refresh duration histogram
+_refreshes: Dict[str, Histogram] = defaultdict(Histogram)
+# (upstream, endpoint) -> status -> count, status is the HTTP code or "error"
+_upstream_calls: Dict[Tuple[str, str], Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+# (upstream, endpoint) -> latency histogram
+_upstream_latency: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+
+
+def key_prefix(key: str, namespace: str = "default") -> str:
+    """
+    Group cache keys for reporting: "switches_1000" -> "switches",
+    keys outside the default namespace get it prepended ("versions:members")
+    """
+    prefix = re.sub(r"_\d+$", "", key.split(":")[0])
+    return prefix if namespace == "default" else f"{namespace}:{prefix}"
+
+
+def record_cache_event(key: str, event: str, namespace: str = "default"):
+    with _lock:
+        _cache_events[key_prefix(key, namespace)][event] += 1
+
+
+def record_refresh(key: str, seconds: float):
+    with _lock:
+        _refreshes[key_prefix(key)].observe(seconds)
+
+
+def record_upstream(upstream: str, endpoint: str, status: Any, seconds: float):
+    with _lock:
+        _upstream_calls[(upstream, endpoint)][str(status)] += 1
+        _upstream_latency[(upstream, endpoint)].observe(seconds)
+
+
+async def observe_upstream(upstream: str, endpoint: str, request: Awaitable[Any]) -> Any:
+    """
+    Await an httpx request and record its status code and latency,
+    e.g. await observe_upstream("pluralkit", "GET /systems/@me", client.get(url))
+    """
+    start = time.perf_counter()
+    try:
+        response = await request
+    except Exception:
+        record_upstream(upstream, endpoint, "error", time.perf_counter() - start)
+        raise
+    record_upstream(upstream, endpoint, response.status_code, time.perf_counter() - start)
+    return response
+
+
+def get_telemetry() -> Dict[str, Any]:
+    """Snapshot of every counter and histogram"""
+    with _lock:
+        cache_keys = {}
+        for prefix, events in _cache_events.items():
+            lookups = events.get("hit", 0) + events.get("miss", 0) + events.get("stale", 0)
+            cache_keys[prefix] = {
+                **events,
+                "hit_rate": (events.get("hit", 0) + events.get("stale", 0)) / lookups if lookups else None
+            }
+
+        upstream: Dict[str, Dict[str, Any]] = {}
+        for (name, endpoint), statuses in _upstream_calls.items():
+            upstream.setdefault(name, {})[endpoint] = {
+                "calls": sum(statuses.values()),
+                "status_codes": dict(statuses),
+                "latency": _upstream_latency[(name, endpoint)].to_dict()
+            }
+
+        return {
+            "cache_keys": cache_keys,
+            "refreshes": {prefix: hist.to_dict() for prefix, hist in _refreshes.items()},
+            "upstream": upstream
+        }
+
+
+def _label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram_lines(name: str, labels: str, hist: Histogram) -> List[str]:
+    lines = []
+    for bound, n in zip(LATENCY_BUCKETS, hist.buckets):
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {n}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {hist.count}')
+    lines.append(f"{name}_sum{{{labels}}} {hist.sum}")
+    lines.append(f"{name}_count{{{labels}}} {hist.count}")
+    return lines
+
+
+def render_prometheus(cache_stats: Dict[str, Any]) -> str:
+    """Every metric in the Prometheus text exposition format"""
+    lines = [
+        "# HELP dough_cache_entries Entries currently stored in the cache",
+        "# TYPE dough_cache_entries gauge",
+        f"dough_cache_entries {cache_stats.get('entries', 0)}",
+        "# HELP dough_cache_bytes Approximate bytes currently stored in the cache",
+        "# TYPE dough_cache_bytes gauge",
+        f"dough_cache_bytes {cache_stats.get('bytes', 0)}",
+    ]
+
+    with _lock:
+        lines += [
+            "# HELP dough_cache_events_total Cache hits, misses, stale serves, evictions and expirations by key prefix",
+            "# TYPE dough_cache_events_total counter",
+        ]
+        for prefix, events in sorted(_cache_events.items()):
+            for event, n in sorted(events.items()):
+                lines.append(f'dough_cache_events_total{{prefix="{_label(prefix)}",event="{_label(event)}"}} {n}')
+
+        lines += [
+            "# HELP dough_cache_refresh_seconds Time taken to refresh a cache key from upstream",
+            "# TYPE dough_cache_refresh_seconds histogram",
+        ]
+        for prefix, hist in sorted(_refreshes.items()):
+            lines += _histogram_lines("dough_cache_refresh_seconds", f'prefix="{_label(prefix)}"', hist)
+
+        lines += [
+            "# HELP dough_upstream_requests_total Outbound requests by upstream, endpoint and status code",
+            "# TYPE dough_upstream_requests_total counter",
+        ]
+        for (name, endpoint), statuses in sorted(_upstream_calls.items()):
+            for status, n in sorted(statuses.items()):
+                lines.append(
+                    f'dough_upstream_requests_total{{upstream="{_label(name)}",'
+                    f'endpoint="{_label(endpoint)}",status="{_label(status)}"}} {n}'
+                )
+
+        lines += [
+            "# HELP dough_upstream_request_seconds Outbound request latency",
+            "# TYPE dough_upstream_request_seconds histogram",
+        ]
+        for (name, endpoint), hist in sorted(_upstream_latency.items()):
+            labels = f'upstream="{_label(name)}",endpoint="{_label(endpoint)}"'
+            lines += _histogram_lines("dough_upstream_request_seconds", labels, hist)
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,65 @@
+import hmac
+import os
+from typing import Any, Dict, Set
+from dotenv import load_dotenv
+from pluralkit import invalidate
+from switch_store import reset_switch_history, resync_switch
+
+load_dotenv()
+
+# Signing token PluralKit shows when the dispatch webhook is set up with
+# "pk;s webhook <url>". The webhook endpoint is disabled while it's unset.
+PLURALKIT_WEBHOOK_TOKEN = os.getenv("PLURALKIT_WEBHOOK_TOKEN")
+
+SWITCH_EVENTS = {"CREATE_SWITCH", "UPDATE_SWITCH", "DELETE_SWITCH", "DELETE_ALL_SWITCHES"}
+MEMBER_EVENTS = {"CREATE_MEMBER", "UPDATE_MEMBER", "DELETE_MEMBER"}
+SYSTEM_EVENTS = {"UPDATE_SYSTEM"}
+
+
+def webhook_enabled() -> bool:
+    return bool(PLURALKIT_WEBHOOK_TOKEN)
+
+
+def verify_signing_token(event: Dict[str, Any]) -> bool:
+    """Check the signing_token PluralKit sends in every dispatch payload"""
+    token = event.get("signing_token")
+    if not PLURALKIT_WEBHOOK_TOKEN or not isinstance(token, str):
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), PLURALKIT_WEBHOOK_TOKEN.encode("utf-8"))
+
+
+def apply_dispatch(event: Dict[str, Any]) -> Set[str]:
+    """
+    Invalidate the cache keys a dispatch event affects.
+    Returns what changed for clients: "fronters", "members" and/or "system".
+    """
+    event_type = event.get("type")
+    changed: Set[str] = set()
+
+    if event_type in SWITCH_EVENTS:
+        if event_type == "DELETE_ALL_SWITCHES":
+            reset_switch_history()
+        elif event_type in ("UPDATE_SWITCH", "DELETE_SWITCH"):
+            # May be older than the newest switch, where a delta sync wouldn't look
+            data = event.get("data") if isinstance(event.get("data"), dict) else {}
+            resync_switch(event.get("id"), data.get("timestamp"))
+        invalidate("fronters")
+        invalidate("switches")
+        changed.add("fronters")
+    elif event_type in MEMBER_EVENTS:
+        # Cascades to the processed member list, fronters and their snapshots
+        invalidate("members_raw")
+        changed.update(("members", "fronters"))
+    elif event_type in SYSTEM_EVENTS:
+        invalidate("system")
+        changed.add("system")
+    elif event_type == "SUCCESSFUL_IMPORT":
+        reset_switch_history()
+        for key in ("system", "members_raw", "fronters", "switches"):
+            invalidate(key)
+        changed.update(("system", "members", "fronters"))
+    elif event_type != "PING":
+        # Groups, messages and settings don't affect anything we serve
+        print(f"Ignoring PluralKit dispatch event {event_type}")
+
+    return changed
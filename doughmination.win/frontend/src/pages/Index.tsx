@@ -25,6 +25,12 @@ interface Fronting {
   members: Member[];
 }
 
+interface MembersDelta {
+  added: Member[];
+  removed: Array<Member['id']>;
+  changed: Array<{ id: Member['id']; fields: Partial<Member> }>;
+}
+
 interface SystemInfo {
   mental_state?: MentalState;
 }
@@ -40,6 +46,12 @@ interface UserData {
   display_name?: string;
 }
 
+const FALLBACK_AVATAR = 'https://www.yuri-lover.win/cdn/pfp/fallback_avatar.png';
+
+// Resized copy served by the backend's avatar proxy, twice the display size for high-DPI screens
+const avatarSrc = (member: Member) =>
+  member.avatar_url ? `/api/avatars/member/${member.id}/128.webp` : FALLBACK_AVATAR;
+
 export default function Index() {
   const [theme] = useTheme();
   const navigate = useNavigate();
@@ -150,6 +162,38 @@ export default function Index() {
                 }
                 break;
 
+              case 'members_delta':
+                console.log('📋 Members delta received');
+                if (message.data) {
+                  const { added = [], removed = [], changed = [] } = message.data as MembersDelta;
+                  setMembers(prev => {
+                    const removedIds = new Set(removed.map(String));
+                    const changes = new Map(changed.map(c => [String(c.id), c.fields]));
+                    const addedIds = new Set(added.map(m => String(m.id)));
+                    return prev
+                      .filter(m => !removedIds.has(String(m.id)) && !addedIds.has(String(m.id)))
+                      .map(m => (changes.has(String(m.id)) ? { ...m, ...changes.get(String(m.id)) } : m))
+                      .concat(added)
+                      .sort((a: Member, b: Member) => {
+                        const nameA = (a.display_name || a.name).toLowerCase();
+                        const nameB = (b.display_name || b.name).toLowerCase();
+                        return nameA.localeCompare(nameB);
+                      });
+                  });
+
+                  // Tags only come in with new members
+                  if (added.length > 0) {
+                    setAvailableTags(prev => {
+                      const tags = new Set<string>(prev);
+                      added.forEach((member: Member) => {
+                        member.tags?.forEach(tag => tags.add(tag));
+                      });
+                      return Array.from(tags).sort((a, b) => a.localeCompare(b));
+                    });
+                  }
+                }
+                break;
+
               case 'force_refresh':
                 console.log('🔄 Force refresh received from admin');
                 window.location.reload();
@@ -693,7 +737,7 @@ export default function Index() {
                             <Link to={`/${member.name}`}>
                               <div className="relative">
                                 <img
-                                  src={member.avatar_url || 'https://www.yuri-lover.win/cdn/pfp/fallback_avatar.png'}
+                                  src={avatarSrc(member)}
                                   alt={member.display_name || member.name}
                                   className="w-16 h-16 rounded-full object-cover border-[3px] transition-all cursor-pointer hover:scale-105"
                                   style={{
@@ -829,7 +873,7 @@ export default function Index() {
                             <div className="text-center">
                               <div className="relative inline-block">
                                 <img
-                                  src={member.avatar_url || 'https://www.yuri-lover.win/cdn/pfp/fallback_avatar.png'}
+                                  src={avatarSrc(member)}
                                   alt={member.display_name || member.name}
                                   className="w-16 h-16 mx-auto rounded-full object-cover mb-2 border-[3px] transition-all hover:scale-105 member-avatar"
                                   style={{